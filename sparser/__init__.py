@@ -1,3 +1,6 @@
-from .sparser import parse, compile, match
-from .sparser_exceptions import SparserSyntaxError, SparserValueError, SparserError
-__all__ = ['parse', 'compile', 'match', 'SparserSyntaxError', 'SparserValueError', 'SparserError']
+from .sparser import parse, parse_parallel, compile, match, search, finditer, purge, set_cache_size, cache_info, \
+    Categorical, LazyLoop, Record, dumps, loads, TemplateSet
+from .sparser_exceptions import SparserSyntaxError, SparserValueError, SparserTimeoutError, SparserError
+__all__ = ['parse', 'parse_parallel', 'compile', 'match', 'search', 'finditer', 'purge', 'set_cache_size',
+           'cache_info', 'Categorical', 'LazyLoop', 'Record', 'dumps', 'loads', 'TemplateSet',
+           'SparserSyntaxError', 'SparserValueError', 'SparserTimeoutError', 'SparserError']
@@ -3,11 +3,38 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import codecs
+import glob
+import hashlib
+import importlib
+import io
 import json
+import mmap
+import multiprocessing
+import os
+import pickle
 import re
+import signal
 import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple, OrderedDict
+from itertools import repeat
 
-from .sparser_exceptions import SparserValueError, SparserSyntaxError, SparserUnexpectedError
+from .sparser_exceptions import SparserValueError, SparserSyntaxError, SparserUnexpectedError, SparserTimeoutError
+
+try:
+    from re import _parser as sre_parse  # python 3.11+
+except ImportError:
+    import sre_parse
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping  # python 2
 
 if sys.version_info[0] > 2:
     # python 3
@@ -16,10 +43,65 @@ if sys.version_info[0] > 2:
     from builtins import zip
     from builtins import str
     from builtins import object
+    # callbacks are retried with unicode when they reject a native python 2 string
+    unicode = str
 
 
 MATCHING_GROUP_RE = re.compile("\(([^\?][^:].*?)\)")
 QUOTE_HUGGED_STRING = re.compile("^('.*?'|\".*?\")$")
+NEWLINE_RE = re.compile("\r\n|\n|\r")
+NON_NEWLINE_RE = re.compile("[^\n]")
+# what loops find lines with in the input, which is bytes for patterns compiled with an encoding
+LineChars = namedtuple("LineChars", ["newline", "carriage_return", "newline_re", "non_newline_re"])
+STR_LINE_CHARS = LineChars('\n', '\r', NEWLINE_RE, NON_NEWLINE_RE)
+BYTES_LINE_CHARS = LineChars(b'\n', b'\r', re.compile(b"\r\n|\n|\r"), re.compile(b"[^\n]"))
+NON_NUMERIC_RE = re.compile('[^\w.-]')
+TAG_RE = re.compile("{{.*?}}|{\*.*?\*}", re.DOTALL)
+
+# whitespace rules for Text, applied in order before and after the text is escaped
+TEXT_RAW_RULES = (
+    (re.compile(' +'), ' '),
+    (re.compile('\n+'), '\n'),
+    (re.compile('\n $'), '\n'),
+    (re.compile('^ \n'), '\n'),
+)
+TEXT_ESCAPED_RULES = (
+    (re.compile('\\\n\\\ '), '\n *'),
+    (re.compile('[^\n] '), ' +'),
+    (re.compile('^\\\\\n'), '\n*'),
+    (re.compile('\\\\\n$'), '\n*'),
+    (re.compile('(.)\\\\\n(.)'), lambda x: x.group(1) + '\n+' + x.group(2)),
+)
+
+UNBOUNDED = float('inf')
+NAN = float('nan')
+DEFAULT_CACHE_SIZE = 512
+DEFAULT_CHUNK_SIZE = 1 << 20
+BATCH_SIZE = 1024
+# with fewer cases than this, trying each case's regex is as fast as looking up which ones to try
+MIN_INDEXED_CASES = 4
+# bump this whenever a change to the classes would break compiled patterns serialized by an older version
+SERIAL_VERSION = 11
+MATCH_TYPE = type(re.match('', ''))
+# for the timings in SparserStats
+_clock = getattr(time, 'perf_counter', time.time)
+# what NON_NUMERIC_RE strips from the strings that the built-in number types can match
+NUMBER_JUNK_TABLE = dict.fromkeys(map(ord, ' ,$'))
+ON_ERROR_OPTIONS = ('raise', 'skip', 'collect')
+# how much of a memory-mapped input an error shows
+MAX_MMAP_ERROR_BYTES = 1 << 10
+# an encoding has to encode these like ASCII does for patterns to be compiled with it
+ASCII_CHARS = ''.join(map(chr, range(128)))
+LOOP_OUTPUT_OPTIONS = ('rows', 'columns', 'lazy')
+DIAGNOSTICS_OPTIONS = ('basic', 'full')
+_REPEAT_OPS = tuple(getattr(sre_parse, op) for op in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                    if hasattr(sre_parse, op))
+_NEWLINE_FREE_CATEGORIES = (sre_parse.CATEGORY_DIGIT, sre_parse.CATEGORY_NOT_SPACE,
+                            sre_parse.CATEGORY_WORD, sre_parse.CATEGORY_NOT_LINEBREAK)
+# the ops that can see past where a regex's match ends, so they can act differently when endpos cuts the string short
+_LOOKAROUND_OPS = tuple(getattr(sre_parse, op) for op in ('AT', 'ASSERT', 'ASSERT_NOT', 'GROUPREF',
+                                                          'GROUPREF_EXISTS', 'GROUPREF_IGNORE')
+                        if hasattr(sre_parse, op))
 
 
 def _floatify(raw):
@@ -28,22 +110,128 @@ def _floatify(raw):
     :rtype: float
     """
     try:
-        return float(re.sub('[^\w.-]', '', raw))
+        return float(NON_NUMERIC_RE.sub('', raw))
     except ValueError:
         raise SparserValueError('Could not perform sparser float on "%s"' % raw)
 
 
+def _identity(raw):
+    """
+    :param str raw:
+    :rtype: str
+    """
+    return raw
+
+
 def _intify(raw):
     """
     :param str raw:
     :rtype: int
     """
     try:
-        return int(re.sub('[^\w.-]', '', raw))
+        return int(NON_NUMERIC_RE.sub('', raw))
     except ValueError:
         raise SparserValueError('Could not perform sparser int on "%s"' % raw)
 
 
+def _bulk_intify(raws):
+    """
+    _intify for many values of the built-in int type at once
+    :param [str, ...] raws:
+    :rtype: [int, ...]
+    """
+    if not raws:
+        return []
+    return list(map(int, '\0'.join(raws).translate(NUMBER_JUNK_TABLE).split('\0')))
+
+
+def _bulk_floatify(raws):
+    """
+    _floatify for many values of the built-in float or currency types at once
+    :param [str, ...] raws:
+    :rtype: [float, ...]
+    """
+    if not raws:
+        return []
+    return list(map(float, '\0'.join(raws).translate(NUMBER_JUNK_TABLE).split('\0')))
+
+
+def _bulk_strip(raws):
+    """
+    :param [str, ...] raws:
+    :rtype: [str, ...]
+    """
+    return list(map(str.strip, raws))
+
+
+def _decode(raw, encoding):
+    """
+    :param bytes raw: a value captured from bytes input
+    :param str encoding:
+    :rtype: str
+    """
+    try:
+        return raw.decode(encoding)
+    except UnicodeDecodeError:
+        raise SparserValueError("Could not decode %r as %s" % (raw, encoding))
+
+
+def _error_text(raw, encoding):
+    """
+    How part of the input is shown in an error. Input to patterns compiled with an encoding is decoded
+    so that errors read the same as they do for str input
+    :param str|bytes raw:
+    :param str encoding:
+    :rtype: str
+    """
+    if encoding is None or not isinstance(raw, bytes):
+        return raw
+    return raw.decode(encoding, 'replace')
+
+
+def _bulk_decode(raws, encoding):
+    """
+    _decode for many values at once
+    :param [bytes, ...] raws:
+    :param str encoding:
+    :rtype: [str, ...]
+    """
+    try:
+        ret = b'\0'.join(raws).decode(encoding).split('\0')
+    except UnicodeDecodeError:
+        ret = None
+    if ret is None or len(ret) != len(raws):
+        # one of them doesn't decode or has a \0 in it
+        return [_decode(raw, encoding) for raw in raws]
+    return ret
+
+
+def _error_slice(buf, start, end):
+    """
+    The part of the input that an error shows, which is all of it unless it's a memory-mapped file
+    that could be far too big to copy
+    :param str|bytes|mmap.mmap buf:
+    :param int start:
+    :param int end:
+    :rtype: str|bytes
+    """
+    if isinstance(buf, mmap.mmap):
+        end = min(end, start + MAX_MMAP_ERROR_BYTES)
+    return buf[start:end]
+
+
+def _compile_regex(patt, flags=0, encoding=None):
+    """
+    :param str patt:
+    :param int flags:
+    :param str encoding: if set, the regex is compiled to match bytes in this encoding
+    :rtype: re.Pattern
+    """
+    if encoding is not None:
+        patt = patt.encode(encoding)
+    return re.compile(patt, flags)
+
+
 BUILT_IN_TYPE_MAP = {
     "int": ("-? ?[0-9,]+", _intify),
     "float": ("-? ?[0-9,.]+", _floatify),
@@ -56,17 +244,33 @@ BUILT_IN_TYPE_MAP = {
     "spalphanum": ("[a-zA-Z0-9_ ]+", str.strip),
 }
 
+# the same conversions as BUILT_IN_TYPE_MAP for a whole list of captures at a time. They raise on
+# any bad value, without saying which, so the values are then converted one at a time instead.
+# The types whose regexes can't match whitespace don't need stripping
+BUILT_IN_BULK_MAP = {
+    "int": _bulk_intify,
+    "float": _bulk_floatify,
+    "currency": _bulk_floatify,
+    "str": list,
+    "spstr": _bulk_strip,
+    "alpha": list,
+    "spalpha": _bulk_strip,
+    "alphanum": list,
+    "spalphanum": _bulk_strip,
+}
+
 
 class TOKEN(object):
     def __init__(self, content):
         self.content = content
 
     def group(self, idx):
-        return re.match(self.patt, self.content).group(idx)
+        return self.regex.match(self.content).group(idx)
 
 
 class OPENLOOP(TOKEN):
     patt = "{\* *loop +(\w+) *\*}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<OPENLOOP %r>" % self.content
@@ -74,6 +278,7 @@ class OPENLOOP(TOKEN):
 
 class CLOSELOOP(TOKEN):
     patt = "{\* *endloop *\*}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<CLOSELOOP %r>" % self.content
@@ -81,6 +286,7 @@ class CLOSELOOP(TOKEN):
 
 class OPENSWITCH(TOKEN):
     patt = "{\* *switch +(\w+) *\*}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<OPENSWITCH %r>" % self.content
@@ -88,6 +294,7 @@ class OPENSWITCH(TOKEN):
 
 class CLOSESWITCH(TOKEN):
     patt = "{\* *endswitch *\*}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<CLOSESWITCH %r>" % self.content
@@ -95,6 +302,7 @@ class CLOSESWITCH(TOKEN):
 
 class OPENCASE(TOKEN):
     patt = "{\* *case( +\w+)? *\*}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<OPENCASE %r>" % self.content
@@ -102,6 +310,7 @@ class OPENCASE(TOKEN):
 
 class CLOSECASE(TOKEN):
     patt = "{\* *endcase *\*}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<CLOSECASE %r>" % self.content
@@ -109,6 +318,7 @@ class CLOSECASE(TOKEN):
 
 class INCLUDE(TOKEN):
     patt = "{\* *include +(\w+) *\*}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<INCLUDE %r>" % self.content
@@ -116,6 +326,7 @@ class INCLUDE(TOKEN):
 
 class VAR(TOKEN):
     patt = "{{ *(\w+|'.+?'|\".+?\")(?: +(\w+))? *}}"
+    regex = re.compile(patt)
 
     def __repr__(self):
         return "<VAR %s>" % self.content
@@ -135,7 +346,7 @@ def _switch_tokens(raw_token):
     :rtype: TOKEN
     """
     for TokenCls in OP_TOKENS:
-        if re.match(TokenCls.patt, raw_token):
+        if TokenCls.regex.match(raw_token):
             return TokenCls(raw_token)
     hint = ''
     if raw_token == "{*loop*}":
@@ -147,84 +358,328 @@ def _switch_tokens(raw_token):
 
 def _preprocess(tokens, includes_dict):
     """
-    Replaces {*include*} tokens with what they are supposed to include
+    Replaces {*include*} tokens with what they are supposed to include, in a single pass.
+    Each include is only tokenized and expanded once no matter how many times it is used
 
     :param [TOKEN, ...] tokens:
     :param {include_name: include_pattern, ...} includes_dict:
     :rtype: [TOKEN, ...]
     """
-    while True:
-        for i, token in enumerate(tokens):
-            if isinstance(token, INCLUDE):
-                template_name = token.group(1)
-                if template_name not in includes_dict:
-                    raise SparserValueError("Includes template %r not provided" % template_name)
-                include_patt = includes_dict[template_name]
-                tokens = tokens[:i] + _tokenize(include_patt, includes_dict) + tokens[i+1:]
-                break
-        else:
+    includes_dict = includes_dict or {}
+    expanded = {}  # include name -> its tokens with all of its own includes expanded
+    ret = []
+    # includes are expanded depth-first with a stack rather than recursion so that
+    # long chains of includes don't run into the recursion limit
+    stack = [(None, iter(tokens), ret)]
+    active = set()
+    while stack:
+        template_name, token_iter, out = stack[-1]
+        for token in token_iter:
+            if not isinstance(token, INCLUDE):
+                out.append(token)
+                continue
+            include_name = token.group(1)
+            if include_name in expanded:
+                out.extend(expanded[include_name])
+                continue
+            if include_name not in includes_dict:
+                raise SparserValueError("Includes template %r not provided" % include_name)
+            if include_name in active:
+                chain = [frame[0] for frame in stack[1:]]
+                chain = chain[chain.index(include_name):] + [include_name]
+                raise SparserSyntaxError("{*include*} cycle: %s" % " -> ".join(chain))
+            active.add(include_name)
+            stack.append((include_name, iter(_tokenize(includes_dict[include_name])), []))
             break
-    return tokens
+        else:
+            stack.pop()
+            if template_name is not None:
+                active.discard(template_name)
+                expanded[template_name] = out
+                stack[-1][2].extend(out)
+    return ret
 
 
-def _tokenize(raw, includes_dict):
+def _tokenize(raw):
     """
     :param str raw:
-    :param {include_name: include_pattern, ...} includes_dict:
-    :rtype: [TOKEN, ...]
+    :rtype: [TOKEN, ...] always alternating between TEXT and the other tokens, starting and ending with TEXT
     """
-    includes_dict = includes_dict or {}
-
-    remaining = raw
     tokens = []
-    while True:
-        match = re.match("^(.*?)({{.*?}}|{\*.*?\*})(.*?)\Z", remaining,
-                         re.DOTALL | re.MULTILINE)
-        if not match:
-            break
-        tokens.append(TEXT(match.group(1)))
-        tokens.append(_switch_tokens(match.group(2)))
-        remaining = match.group(3)
-    tokens.append(TEXT(remaining))
-    tokens = _preprocess(tokens, includes_dict)
+    pos = 0
+    for match in TAG_RE.finditer(raw):
+        tokens.append(TEXT(raw[pos:match.start()]))
+        tokens.append(_switch_tokens(match.group()))
+        pos = match.end()
+    tokens.append(TEXT(raw[pos:]))
     return tokens
 
 
 def _root_tokenize(raw, includes_dict=None):
     """
-    Tokenize but also merge together adjacent TEXT tokens. These are remnants of the {\*include\*} process
+    Tokenize but also merge together adjacent TEXT tokens. These are remnants of the {\*include\*} process.
+    Included tokens can be shared so merged TEXT tokens are always new ones
     :param str raw:
     :param {include_name: include_pattern, ...} includes_dict:
     :rtype: [TOKEN, ...]
     """
-    tokens = _tokenize(raw, includes_dict)
+    tokens = _preprocess(_tokenize(raw), includes_dict)
 
     ret_tokens = []
+    texts = []
     for token in tokens:
-        if ret_tokens and isinstance(token, TEXT) and isinstance(ret_tokens[-1], TEXT):
-            ret_tokens[-1].content += token.content
-        else:
-            ret_tokens.append(token)
+        if isinstance(token, TEXT):
+            texts.append(token.content)
+            continue
+        if texts:
+            ret_tokens.append(TEXT(''.join(texts)))
+            texts = []
+        ret_tokens.append(token)
+    if texts:
+        ret_tokens.append(TEXT(''.join(texts)))
     return ret_tokens
 
 
+def _in_matches_newline(items):
+    """
+    Whether a parsed regex character set can match a newline. Errs on the side of yes
+    :param [(op, av), ...] items:
+    :rtype: bool
+    """
+    negate = False
+    hit = False
+    for op, av in items:
+        if op == sre_parse.NEGATE:
+            negate = True
+        elif op == sre_parse.LITERAL:
+            hit = hit or av == 10
+        elif op == sre_parse.RANGE:
+            hit = hit or av[0] <= 10 <= av[1]
+        elif op == sre_parse.CATEGORY:
+            hit = hit or av not in _NEWLINE_FREE_CATEGORIES
+        else:
+            return True
+    return hit != negate
+
+
+def _newline_span(subpattern):
+    """
+    The fewest and the most newlines that a parsed regex (compiled with re.DOTALL) can consume.
+    Anything we don't recognize is assumed to consume any number of them
+    :param sre_parse.SubPattern subpattern:
+    :rtype: (int, int|float)
+    """
+    lo = hi = 0
+    for op, av in subpattern:
+        if op == sre_parse.LITERAL:
+            a = b = int(av == 10)
+        elif op == sre_parse.NOT_LITERAL:
+            a, b = 0, int(av != 10)
+        elif op == sre_parse.ANY:
+            a, b = 0, 1
+        elif op == sre_parse.IN:
+            a, b = 0, int(_in_matches_newline(av))
+        elif op in _REPEAT_OPS:
+            min_repeat, max_repeat, sub = av
+            sub_lo, sub_hi = _newline_span(sub)
+            a = sub_lo * min_repeat
+            if not sub_hi:
+                b = 0
+            elif max_repeat == sre_parse.MAXREPEAT:
+                b = UNBOUNDED
+            else:
+                b = sub_hi * max_repeat
+        elif op == sre_parse.SUBPATTERN:
+            a, b = _newline_span(av[-1])
+        elif op == sre_parse.BRANCH:
+            spans = [_newline_span(alt) for alt in av[1]]
+            a = min(span[0] for span in spans)
+            b = max(span[1] for span in spans)
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            a = b = 0
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            a, b = _newline_span(av)
+        else:
+            a, b = 0, UNBOUNDED
+        lo += a
+        hi += b
+    return lo, hi
+
+
+def _only_matches_newlines(subpattern):
+    """
+    :param sre_parse.SubPattern subpattern:
+    :rtype: bool
+    """
+    for op, av in subpattern:
+        if op == sre_parse.LITERAL and av == 10:
+            continue
+        if op == sre_parse.SUBPATTERN and _only_matches_newlines(av[-1]):
+            continue
+        return False
+    return True
+
+
+def _max_newline_runs(subpattern):
+    """
+    The most runs of consecutive newlines that a parsed regex (compiled with re.DOTALL) can consume.
+    Unlike newlines themselves, this is bounded for Text because "\n+" is a single run
+    :param sre_parse.SubPattern subpattern:
+    :rtype: int|float
+    """
+    runs = 0
+    for op, av in subpattern:
+        if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN):
+            runs += _newline_span([(op, av)])[1]
+        elif op in _REPEAT_OPS:
+            max_repeat, sub = av[1], av[2]
+            sub_runs = _max_newline_runs(sub)
+            if not sub_runs:
+                continue
+            if _only_matches_newlines(sub):
+                runs += 1
+            elif max_repeat == sre_parse.MAXREPEAT:
+                return UNBOUNDED
+            else:
+                runs += sub_runs * max_repeat
+        elif op == sre_parse.SUBPATTERN:
+            runs += _max_newline_runs(av[-1])
+        elif op == sre_parse.BRANCH:
+            runs += max(_max_newline_runs(alt) for alt in av[1])
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            continue
+        else:
+            return UNBOUNDED
+    return runs
+
+
+def _pattern_newline_span(patt):
+    """
+    :param str patt:
+    :rtype: (int, int|float)
+    """
+    return _newline_span(sre_parse.parse(patt, re.DOTALL))
+
+
+def _literal_prefix(subpattern):
+    """
+    The literal text that every match of a parsed regex starts with
+    :param sre_parse.SubPattern subpattern:
+    :rtype: (str prefix, bool whether the regex is nothing but the prefix)
+    """
+    chars = []
+    for op, av in subpattern:
+        if op == sre_parse.LITERAL:
+            chars.append(chr(av))
+            continue
+        if op == sre_parse.SUBPATTERN and av[1] == 0:
+            # only groups that don't add flags like (?i:...)
+            sub_prefix, is_literal = _literal_prefix(av[-1])
+            chars.append(sub_prefix)
+            if is_literal:
+                continue
+        return ''.join(chars), False
+    return ''.join(chars), True
+
+
+def _looks_around(subpattern):
+    """
+    :param sre_parse.SubPattern subpattern:
+    :rtype: bool
+    """
+    for op, av in subpattern:
+        if op in _LOOKAROUND_OPS:
+            return True
+        for item in av if isinstance(av, (tuple, list)) else (av,):
+            if isinstance(item, list):
+                if any(isinstance(alt, sre_parse.SubPattern) and _looks_around(alt) for alt in item):
+                    return True
+            elif isinstance(item, sre_parse.SubPattern) and _looks_around(item):
+                return True
+    return False
+
+
+def _parsed_flags(parsed):
+    """
+    :param sre_parse.SubPattern parsed:
+    :rtype: int the flags that the regex was parsed with, inline ones included
+    """
+    # SubPattern.pattern became SubPattern.state in python 3.8
+    return (getattr(parsed, 'state', None) or parsed.pattern).flags
+
+
+def _pattern_literal_prefix(patt):
+    """
+    :param str patt:
+    :rtype: str
+    """
+    parsed = sre_parse.parse(patt, re.DOTALL)
+    if _parsed_flags(parsed) & re.IGNORECASE:
+        return ''
+    return _literal_prefix(parsed)[0]
+
+
+def _literal_runs(subpattern):
+    """
+    The runs of literal text that every match of a parsed regex contains
+    :param sre_parse.SubPattern subpattern:
+    :rtype: [str, ...]
+    """
+    runs = []
+    chars = []
+    for op, av in subpattern:
+        if op == sre_parse.LITERAL:
+            chars.append(chr(av))
+            continue
+        runs.append(''.join(chars))
+        chars = []
+        if op == sre_parse.SUBPATTERN and av[1] == 0:
+            runs.extend(_literal_runs(av[-1]))
+        elif op in _REPEAT_OPS and av[0] > 0:
+            runs.extend(_literal_runs(av[2]))
+    runs.append(''.join(chars))
+    return [run for run in runs if run]
+
+
+def _pattern_required_literal(patt):
+    """
+    :param str patt:
+    :rtype: str the longest piece of literal text that every match of patt contains
+    """
+    parsed = sre_parse.parse(patt, re.DOTALL)
+    if _parsed_flags(parsed) & re.IGNORECASE:
+        return ''
+    runs = _literal_runs(parsed)
+    return max(runs, key=len) if runs else ''
+
+
 class DictEntry(object):
-    def __init__(self, name, cb):
+    def __init__(self, name, cb, container=None, bulk_cb=None):
+        """
+        :param str name:
+        :param func cb: called with the captured string
+        :param Loop|Switch container: if set, its parse_span is called instead of cb so that
+                                      loops and switches can work in-place on the input
+        :param func bulk_cb: if set, does what cb does for a list of captured strings
+        """
         self.name = name
         self.cb = cb
+        self.container = container
+        self.bulk_cb = bulk_cb
 
 
 def _make_loop(tokens, ctx):
     loop_tokens = [tokens.pop(0)]
+    depth = 1
     while True:
         token = tokens.pop(0)
         loop_tokens.append(token)
         if isinstance(token, OPENLOOP):
-            raise SparserSyntaxError("Nested loops are not supported in Sparser v0.1")
-        if isinstance(token, OPENSWITCH):
-            raise SparserSyntaxError("Switches in loops are not supported in Sparser v0.1")
-        if isinstance(token, CLOSELOOP):
-            break
+            depth += 1
+        elif isinstance(token, CLOSELOOP):
+            depth -= 1
+            if not depth:
+                break
         if not tokens:
             raise SparserSyntaxError("{*loop*} not closed with a matching {*endloop*}")
     return tokens, Loop(loop_tokens, ctx)
@@ -232,15 +687,16 @@ def _make_loop(tokens, ctx):
 
 def _make_switch(tokens, ctx):
     switch_tokens = [tokens.pop(0)]
+    depth = 1
     while True:
         token = tokens.pop(0)
         switch_tokens.append(token)
         if isinstance(token, OPENSWITCH):
-            raise SparserSyntaxError("Nested switches are not supported in Sparser v0.1")
-        if isinstance(token, OPENLOOP):
-            raise SparserSyntaxError("Loops in switches are not supported in Sparser v0.1")
-        if isinstance(token, CLOSESWITCH):
-            break
+            depth += 1
+        elif isinstance(token, CLOSESWITCH):
+            depth -= 1
+            if not depth:
+                break
         if not tokens:
             raise SparserSyntaxError("{*switch*} not closed with a matching {*endswitch*}")
     return tokens, Switch(switch_tokens, ctx)
@@ -248,13 +704,16 @@ def _make_switch(tokens, ctx):
 
 def _make_case(tokens, ctx):
     case_tokens = [tokens.pop(0)]
+    depth = 1
     while True:
         token = tokens.pop(0)
         case_tokens.append(token)
         if isinstance(token, OPENCASE):
-            raise SparserSyntaxError("Sparser v0.1 does not support nesting")
-        if isinstance(token, CLOSECASE):
-            break
+            depth += 1
+        elif isinstance(token, CLOSECASE):
+            depth -= 1
+            if not depth:
+                break
         if not tokens:
             raise SparserSyntaxError("{*case*} not closed with a matching {*endcase*}")
     return tokens, Case(case_tokens, ctx)
@@ -294,294 +753,3030 @@ class Dict(SIS):
             else:
                 raise SparserSyntaxError("Token %r cannot be here" % token)
 
+        self.encoding = ctx.encoding
         self._set_pattern(all_members)
+        # Case swaps in a class with its case name
+        self.record_class = _record_class(self.names) if ctx.records else None
+
+    @classmethod
+    def from_members(cls, members, anchored=True, encoding=None):
+        """
+        Make a dict out of a slice of another dict's members
+        :param [SIS, ...] members:
+        :param bool anchored: whether the dict has to match to the end of input
+        :param str encoding: the encoding that the members were compiled with
+        :rtype: Dict
+        """
+        ret = cls.__new__(cls)
+        ret.encoding = encoding
+        ret.record_class = None
+        ret._set_pattern(members, anchored)
+        return ret
 
-    def _set_pattern(self, members):
+    def _set_pattern(self, members, anchored=True):
         """
         :param [SIS, ...] members:
+        :param bool anchored:
         """
-        self.translated_patt = ''
+        self.members = members
+        patts = []
         self.d_entries = []
+        sections = [[]]
         for member in members:
             patt, name, cb = member.translate()
-            self.translated_patt += patt
+            patts.append(patt)
+            is_container = isinstance(member, (Loop, Switch))
             if name is not None:
-                self.d_entries.append(DictEntry(name, cb))
-        self.translated_patt += "$"  # dicts always need to match to the end of input
+                self.d_entries.append(DictEntry(name, cb, member if is_container else None,
+                                                getattr(member, 'bulk_cb', None)))
+            if is_container:
+                sections.append([])
+            else:
+                sections[-1].append(patt)
+        if anchored:
+            patts.append("$")  # dicts always need to match to the end of input
+            sections[-1].append("$")
+        self.translated_patt = ''.join(patts)
+        sections = [''.join(section) for section in sections]
+        self.names = [d_entry.name for d_entry in self.d_entries]
+        self._match_checks = [(idx, d_entry.container, d_entry.cb) for idx, d_entry in enumerate(self.d_entries, 1)
+                              if d_entry.container is not None or d_entry.cb in (_intify, _floatify)]
+        self.regex = _compile_regex(self.translated_patt, re.DOTALL, self.encoding)
+        self._section_patts = sections
+        self._section_regexes = None
+        self._start_regexes = None
+        self._search_plan = None
+        if len(sections) > 1:
+            self._section_regexes = [_compile_regex(section, re.DOTALL, self.encoding) for section in sections]
+            # each section but the last is matched with endpos cut short when the first try doesn't work out,
+            # so if anything in them looks past where they end the full regex is used instead
+            if not any(_looks_around(sre_parse.parse(section, re.DOTALL)) for section in sections[:-1]):
+                # matches up to the last place in the input where the section can start
+                self._start_regexes = [_compile_regex(".*(?=%s)" % section, re.DOTALL, self.encoding)
+                                       for section in sections[1:]]
+        self._bind_match()
 
-    def parse(self, string, do_error=True):
+    def _bind_match(self):
         """
-        :param str string: the string captured within the dict
-        :rtype: {var_name: var_val}
+        self.match(string, pos=0, endpos=None) works like re.Pattern.match
         """
-        match = re.match(self.translated_patt, string, re.DOTALL)
-        if not match:
-            if not do_error:
-                return None
-            # separate by loops so that we can point closer to the place that doesn't work
-            for section in self.translated_patt.split('(?P<.*?>.*?)'):
-                if not re.search(section, string, re.DOTALL):
-                    raise SparserValueError("%r is unmatched for string %r" % (section, string))
-            raise SparserValueError("%r is unmatched" % string)
+        self.match = self.regex.match if len(self._section_patts) == 1 else self._match_sections
 
-        ret = {}
-        for sub_match, d_entry in zip(match.groups(), self.d_entries):
-            try:
-                ret[d_entry.name] = d_entry.cb(sub_match)
-            except TypeError:
-                ret[d_entry.name] = d_entry.cb(unicode(sub_match))
+    @property
+    def section_regexes(self):
+        """
+        The patterns between loops/switches. Dicts without any only use them to point closer to the place
+        that doesn't match so they aren't compiled until the first time that something doesn't
+        :rtype: [re.Pattern, ...]
+        """
+        if self._section_regexes is None:
+            self._section_regexes = [_compile_regex(section, re.DOTALL, self.encoding)
+                                     for section in self._section_patts]
+        return self._section_regexes
 
-        return ret
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['match']
+        if len(self._section_patts) == 1:
+            state['_section_regexes'] = None
+        # record classes are made on the fly so they can't be pickled by name
+        record_class = state.pop('record_class')
+        state['_record_key'] = (record_class._fields, record_class._case) if record_class is not None else None
+        return state
 
+    def __setstate__(self, state):
+        record_key = state.pop('_record_key')
+        self.__dict__.update(state)
+        self.record_class = _record_class(*record_key) if record_key is not None else None
+        self._bind_match()
 
-class Case(SIS):
-    def __init__(self, tokens, ctx):
+    def _match_sections(self, string, pos=0, endpos=None):
         """
-        :param [TOKEN, ...] token:
-        :param SparserCompilationContext ctx:
+        Same as self.regex.match, which is what self.match is for dicts without loops or switches. The loops
+        and switches are each "(?P<name>.*?)" which, when the input almost matches, backtracks through every
+        way of splitting the input between them. Instead, the sections between them are matched one after
+        the other, each at the first place that the full regex would try. When that doesn't work out, the
+        last place that each loop or switch can start and still have the rest of the dict match is found
+        first, working backwards, and the sections are matched again without going past those
+        :param str string:
+        :param int pos:
+        :param int endpos:
+        :rtype: SectionMatch or None
         """
-        match = re.search(tokens[0].patt, tokens[0].content)
-        if match and match.group(1) is not None:
-            self.var_name = match.group(1).strip()
-        else:
-            self.var_name = None
-        self.dict = Dict(tokens[1:-1], ctx)
+        if endpos is None:
+            endpos = len(string)
+        spans = self._section_spans(string, pos, [endpos] * len(self._section_regexes))
+        if spans is not None:
+            return SectionMatch(string, spans)
+        if self._start_regexes is None:
+            return self.regex.match(string, pos, endpos)
 
-    def parse(self, entry):
+        bounds = [endpos]
+        for start_regex in reversed(self._start_regexes):
+            start_match = start_regex.match(string, pos, bounds[-1])
+            if start_match is None:
+                return None
+            bounds.append(start_match.end())
+        bounds.reverse()
+        spans = self._section_spans(string, pos, bounds)
+        return None if spans is None else SectionMatch(string, spans)
+
+    def _section_spans(self, string, pos, bounds):
         """
-        :param str entry:
-        :rtype: {var_name: var_val, ...}
+        :param str string:
+        :param int pos:
+        :param [int, ...] bounds: the endpos for each section
+        :rtype: [(int, int), ...] the spans of the whole match and then of each group, or None
         """
-        ret = self.dict.parse(entry, do_error=False)
-        if ret is not None and self.var_name is not None:
-            ret["case"] = self.var_name
-        return ret
-
+        section_regexes = self._section_regexes
+        section_match = section_regexes[0].match(string, pos, bounds[0])
+        if section_match is None:
+            return None
+        spans = [None]
+        spans.extend(section_match.regs[1:])
+        for section_regex, bound in zip(section_regexes[1:], bounds[1:]):
+            container_start = section_match.end()
+            section_match = section_regex.search(string, container_start, bound)
+            if section_match is None:
+                return None
+            spans.append((container_start, section_match.start()))
+            spans.extend(section_match.regs[1:])
+        spans[0] = (pos, section_match.end())
+        return spans
 
-class Loop(SIS):
-    def __init__(self, tokens, ctx):
+    def parse(self, string, do_error=True, pos=0, endpos=None, loop_output=None, diagnostics='basic'):
         """
-        :param [TOKEN, ...] token:
-        :param SparserCompilationContext ctx:
+        :param str string: the string captured within the dict
+        :param int pos: where in string the dict starts
+        :param int endpos: where in string the dict ends. Defaults to the end of string
+        :param str loop_output: overrides the loop_output that the loops were compiled with
+        :param str diagnostics: "full" to search for the first part of the pattern that isn't in the string
+                                when it doesn't match, to say which part that is in the error
+        :rtype: {var_name: var_val}
         """
-        assert isinstance(tokens[0], OPENLOOP)
-        assert isinstance(tokens[-1], CLOSELOOP)
-        self.loop_name = tokens[0].content[2:-2].split(' ')[1]
-        tokens = tokens[1:-1]  # pop off LOOPSTART LOOPEND
-        self.cases = []
-        while tokens:
-            if isinstance(tokens[0], OPENCASE):
-                tokens, case = _make_case(tokens, ctx)
-                self.cases.append(case)
-            elif isinstance(tokens[0], TEXT):
-                token = tokens.pop(0)
-                if token.content.strip():
-                    raise SparserSyntaxError("{*loop*} tags can only contain {*case*}s")
-            else:
-                raise SparserSyntaxError("{*loop*} tags can only contain {*case*}s")
-        if not self.cases:
-            raise SparserSyntaxError("{*loop*} tags must contain at least one {*case*}")
+        if endpos is None:
+            endpos = len(string)
+        budget = _current_budget()
+        if budget is not None:
+            budget.step()
+        match = self.match(string, pos, endpos)
+        if not match:
+            if not do_error:
+                return None
+            raise self.unmatched_error(string, pos, endpos, diagnostics)
+        return self.convert(match, string, loop_output)
 
-    def translate(self):
+    def unmatched_error(self, string, pos, endpos, diagnostics='basic'):
         """
-        :rtype: (str patt, str loop_name, func cb)
+        :param str string: that this dict's regex doesn't match between pos and endpos
+        :param int pos:
+        :param int endpos:
+        :param str diagnostics: see parse
+        :rtype: SparserValueError
         """
-        patt = "(?P<%s>.*?)" % self.loop_name
-        return patt, self.loop_name, self.cb
+        if isinstance(string, mmap.mmap):
+            searched = string
+            string = _error_slice(string, pos, endpos)
+        else:
+            string = searched = string[pos:endpos]
+            pos, endpos = 0, len(string)
+        string = _error_text(string, self.encoding)
+        if diagnostics == 'full':
+            for section_re in self.section_regexes:
+                if not section_re.search(searched, pos, endpos):
+                    return SparserValueError("%r is unmatched for string %r"
+                                             % (_error_text(section_re.pattern, self.encoding), string))
+        return SparserValueError("%r is unmatched" % string)
 
-    def cb(self, string_input):
+    @property
+    def search_plan(self):
         """
-        :param str string_input: the string captured within the loop
-        :rtype: [{var_name: var_val, ...}, ...]
+        What iter_occurrences needs, worked out the first time it's called: the regexes of the sections
+        between the loops and switches, without "$" and with "." not matching newlines so that a variable like
+        spstr stays on its own line, the loop or switch that the dict ends with, if it does, and the loop that
+        it starts with, if it does and the loop's records are all single lines. A dict that starts with a loop
+        or switch can only start at the start of a line
+        :rtype: ([re.Pattern, ...], Loop|Switch|None, Loop|None)
         """
-        string_lines = re.split("\r\n|\n|\r", string_input)  # split into lines by any common newline type
-        if not [l for l in string_lines if l]:
-            return []
-
-        ret = []
-        while string_lines:
-            string_lines, parsed_case = self._generate_combs(string_lines)
-            if parsed_case is not None:
-                ret.append(parsed_case)
+        if self._search_plan is None:
+            sections = []
+            patts = []
+            trailing = None
+            for member in self.members:
+                if isinstance(member, (Loop, Switch)):
+                    sections.append(''.join(patts))
+                    patts = []
+                    trailing = member
+                else:
+                    patts.append(member.translate()[0])
+            sections.append(''.join(patts))
+            if sections[-1] or len(sections) == 1:
+                trailing = None
             else:
-                line = '\n'.join(string_lines)
-                err_msg = '%r unmatched for loop %r: [' % (line, self.loop_name)
-                err_msg += ', '.join("%r" % case_obj.dict.translated_patt for case_obj in self.cases)
-                err_msg += ']'
-                raise SparserValueError(err_msg)
-        return ret
-
-    def _generate_combs(self, string_lines):
-        i = 1
-        while i <= len(string_lines):
-            line = '\n'.join(string_lines[:i])
-            for case_obj in self.cases:
-                parsed_case = case_obj.parse(line)
-                if parsed_case is not None:
-                    return string_lines[i:], parsed_case
-            i += 1
-        return string_lines, None
+                sections.pop()
+            section_regexes = [_compile_regex(section, 0, self.encoding) for section in sections]
+            leading_loop = None
+            if not sections[0] and self.d_entries:
+                section_regexes[0] = _compile_regex('^', re.MULTILINE, self.encoding)
+                leading = self.d_entries[0].container
+                # when every record is a single line, the records of a loop are the same lines wherever it starts
+                if isinstance(leading, Loop) and leading.single_line_records:
+                    leading_loop = leading
+            self._search_plan = (section_regexes, trailing, leading_loop)
+        return self._search_plan
 
-
-class Switch(SIS):
-    def __init__(self, tokens, ctx):
+    def iter_occurrences(self, string, pos=0, endpos=None):
         """
-        :param [TOKEN, ...] token:
-        :param SparserCompilationContext ctx:
+        Find the places in string that this dict parses, without having to match all of string, like
+        re.finditer. Each section between the loops and switches is matched at the first place after the one
+        before it, and a loop at the end takes as many records as follow it. Where that doesn't parse, the
+        later sections are tried at each of the places after that they match, in the order that the full
+        regex would try them, and then the search goes on from the next place that the first section matches.
+        Empty occurrences are left out
+        :param str string:
+        :param int pos:
+        :param int endpos:
+        :rtype: generator of ((int start, int end), {var_name: var_val})
         """
-        assert isinstance(tokens[0], OPENSWITCH)
-        assert isinstance(tokens[-1], CLOSESWITCH)
-        self.switch_name = tokens[0].content[2:-2].split(' ')[1]
-        tokens = tokens[1:-1]  # pop off LOOPSTART LOOPEND
-        self.cases = []
-        while tokens:
-            if isinstance(tokens[0], OPENCASE):
-                tokens, case = _make_case(tokens, ctx)
-                self.cases.append(case)
-            elif isinstance(tokens[0], TEXT):
-                token = tokens.pop(0)
-                if token.content.strip():
-                    raise SparserSyntaxError("{*switch*} tags can only contain {*case*}s")
-            else:
-                raise SparserSyntaxError("{*switch*} tags can only contain {*case*}s")
-        if not self.cases:
-            raise SparserSyntaxError("{*switch*} tags must contain at least one {*case*}")
+        if endpos is None:
+            endpos = len(string)
+        section_regexes, trailing, leading_loop = self.search_plan
+        first_regex = section_regexes[0]
+        searches = [(UNBOUNDED, None, None)] * len(section_regexes)
+        budget = _current_budget()
+        failed = set()
+        while pos < endpos:
+            first_match = first_regex.search(string, pos, endpos)
+            if first_match is None:
+                return
+            if budget is not None:
+                budget.step()
+            match = self._occurrence_match(first_match, string, endpos, searches, budget)
+            occurrence = self._occurrence(match, string)
+            if occurrence is None:
+                pos = first_match.start() + 1
+                if leading_loop is not None and match is not None:
+                    # starting anywhere up to a whole line that the loop couldn't parse gets stuck on that same
+                    # line, and so does giving the loop more of the input
+                    loop_start, loop_end = match.span(1)
+                    if string.find(leading_loop.line_chars.carriage_return, loop_start, loop_end) == -1:
+                        unmatched = leading_loop.first_unmatched(string, loop_start, loop_end)
+                        if unmatched is not None and string.find(leading_loop.line_chars.newline, unmatched,
+                                                                 loop_end) != -1:
+                            pos = unmatched + 1
+                            continue
+                if len(section_regexes) > 1:
+                    occurrence = self._occurrence(self._occurrence_retry(first_match, string, endpos, failed,
+                                                                         budget), string)
+                if occurrence is None:
+                    continue
+            yield occurrence
+            pos = occurrence[0][1]
 
-    def translate(self):
+    def _occurrence(self, match, string):
         """
-        :rtype: (str regex, str switch_name, func cb)
+        :param re.Match|SectionMatch match: from _occurrence_match or _occurrence_retry
+        :param str string:
+        :rtype: ((int start, int end), {var_name: var_val}) or None if match is empty or doesn't parse
         """
-        return "(?P<%s>.*?)" % self.switch_name, self.switch_name, self.cb
+        if match is None or match.end() == match.start() or not self.match_is_valid(match, string):
+            return None
+        try:
+            return match.span(), self.convert(match, string)
+        except SparserValueError:
+            return None
 
-    def cb(self, string_input):
+    def _occurrence_retry(self, first_match, string, endpos, failed, budget=None):
         """
-        :param str string_input: the string passed into the loop
-        :rtype: [{var_name: var_val, ...}, ...]
+        For when the first places that the sections match after first_match don't parse. Each section is
+        tried at each of the places after the one before it that it matches, earliest first like the full
+        regex, and each loop, switch and number is checked as soon as its span is known
+        :param re.Match first_match:
+        :param str string:
+        :param int endpos:
+        :param set failed: (section index, where the loop or switch before it starts) for the places that
+                           nothing after parses from. What comes after doesn't depend on what comes before,
+                           so this is shared by every search in the same string and nothing is tried twice
+        :param SparserBudget budget:
+        :rtype: SectionMatch or None
         """
-        for case_obj in self.cases:
-            parsed_case = case_obj.parse(string_input)
-            if parsed_case is not None:
-                return parsed_case
-        err_msg = '%r unmatched for switch %r: [' % (string_input, self.switch_name)
-        err_msg += ', '.join("%r" % case_obj.dict.translated_patt for case_obj in self.cases)
-        err_msg += ']'
-        raise SparserValueError(err_msg)
+        checks = dict((idx, (container, cb)) for idx, container, cb in self._match_checks)
+        spans = [None]
+        spans.extend(first_match.regs[1:])
+        if not self._spans_are_valid(string, spans[1:], 1, checks):
+            return None
+        rest = self._rest_spans(string, first_match.start(), first_match.end(), 1, endpos, len(spans), checks,
+                                failed, budget)
+        if rest is None:
+            return None
+        rest_spans, end = rest
+        spans[0] = (first_match.start(), end)
+        spans.extend(rest_spans)
+        return SectionMatch(string, spans)
 
-
-class Text(SIS):
-    def __init__(self, tokens, ctx):
+    def _rest_spans(self, string, start, container_start, idx, endpos, first_group, checks, failed, budget):
         """
-        "    " -> " +"
-        "\n\n\n" -> "\n+"
-        :param [TOKEN, ...] tokens:
-        :param SparserCompilationContext ctx:
+        :param str string:
+        :param int start: where the match starts. Empty matches are left out
+        :param int container_start: where the loop or switch before section idx starts
+        :param int idx: the section to match next
+        :param int endpos:
+        :param int first_group: the group that the loop or switch before section idx is
+        :param {int: (Loop|Switch|None, func), ...} checks: what to check each group with
+        :param set failed: see _occurrence_retry
+        :param SparserBudget budget:
+        :rtype: ([(int, int), ...], int) the spans from first_group on and where the match ends, or None
         """
-        assert len(tokens) == 1
-        self.patt = tokens[0].content
-        self.patt = re.sub(' +', ' ', self.patt)
-        self.patt = re.sub('\n+', '\n', self.patt)
-        self.patt = re.sub('\n $', '\n', self.patt)
-        self.patt = re.sub('^ \n', '\n', self.patt)
-        self.patt = re.escape(self.patt)
-        self.patt = re.sub('\\\n\\\ ', '\n *', self.patt)
-        self.patt = re.sub('[^\n] ', ' +', self.patt)
-        self.patt = re.sub('^\\\\\n', '\n*', self.patt)
-        self.patt = re.sub('\\\\\n$', '\n*', self.patt)
-        self.patt = re.sub('(.)\\\\\n(.)', lambda x: x.group(1) + '\n+' + x.group(2), self.patt)
+        section_regexes, trailing = self.search_plan[:2]
+        key = (idx, container_start)
+        if key in failed:
+            return None
+        if idx == len(section_regexes):
+            if trailing is None:
+                if container_start > start:
+                    return [], container_start
+            else:
+                end = self._trailing_end(trailing, string, container_start, endpos, budget)
+                spans = [(container_start, end)]
+                if end is not None and end > start and self._spans_are_valid(string, spans, first_group, checks):
+                    return spans, end
+            failed.add(key)
+            return None
+        section_regex = section_regexes[idx]
+        container = checks[first_group][0]
+        pos = container_start
+        while pos <= endpos:
+            section_match = section_regex.search(string, pos, endpos)
+            if section_match is None:
+                break
+            if budget is not None:
+                budget.step()
+            spans = [(container_start, section_match.start())]
+            spans.extend(section_match.regs[1:])
+            if self._spans_are_valid(string, spans, first_group, checks):
+                rest = self._rest_spans(string, start, section_match.end(), idx + 1, endpos,
+                                        first_group + len(spans), checks, failed, budget)
+                if rest is not None:
+                    spans.extend(rest[0])
+                    return spans, rest[1]
+            elif isinstance(container, Switch):
+                # giving the switch more of the input only gives it more lines
+                if string.count(container.line_chars.newline, *spans[0]) > container.max_newlines:
+                    break
+            elif container.single_line_records and string.find(container.line_chars.carriage_return,
+                                                                 *spans[0]) == -1:
+                # a whole line that the loop can't parse is still there when the loop is given more of the input
+                unmatched = container.first_unmatched(string, *spans[0])
+                if unmatched is not None and string.find(container.line_chars.newline, unmatched,
+                                                         spans[0][1]) != -1:
+                    break
+            pos = section_match.start() + 1
+        failed.add(key)
+        return None
 
-    def translate(self):
+    def _spans_are_valid(self, string, spans, first_group, checks):
         """
-        :rtype: (str regex, str var_name=None, func cb=None)
+        The same checks as match_is_valid, for some of the groups
+        :param str string:
+        :param [(int, int), ...] spans: of the groups from first_group on
+        :param int first_group:
+        :param {int: (Loop|Switch|None, func), ...} checks:
+        :rtype: bool
+        """
+        encoding = self.encoding
+        for group, (start, end) in enumerate(spans, first_group):
+            check = checks.get(group)
+            if check is None or start == -1:
+                continue
+            container, cb = check
+            if container is not None:
+                if not container.span_matches(string, start, end):
+                    return False
+                continue
+            try:
+                if encoding is not None:
+                    cb(_decode(string[start:end], encoding))
+                else:
+                    cb(string[start:end])
+            except SparserValueError:
+                return False
+        return True
+
+    def _occurrence_match(self, first_match, string, endpos, searches, budget=None):
+        """
+        Match the rest of the sections after where the first one matched, like the first pass of
+        _match_sections but without the end of the dict having to be at endpos
+        :param re.Match first_match:
+        :param str string:
+        :param int endpos:
+        :param [(int pos, int|None end, re.Match|None), ...] searches: the last search for each section, which
+                                                                        is updated. A search from anywhere in
+                                                                        pos..end finds the same match, so each
+                                                                        part of string is only searched once
+        :param SparserBudget budget:
+        :rtype: re.Match|SectionMatch or None
+        """
+        section_regexes, trailing = self.search_plan[:2]
+        if len(section_regexes) == 1 and trailing is None:
+            return first_match
+        section_match = first_match
+        spans = [None]
+        spans.extend(first_match.regs[1:])
+        for idx in range(1, len(section_regexes)):
+            container_start = section_match.end()
+            searched_from, searched_to, section_match = searches[idx]
+            if not searched_from <= container_start <= searched_to:
+                section_match = section_regexes[idx].search(string, container_start, endpos)
+                searched_to = endpos if section_match is None else section_match.start()
+                searches[idx] = (container_start, searched_to, section_match)
+            if section_match is None:
+                return None
+            spans.append((container_start, section_match.start()))
+            spans.extend(section_match.regs[1:])
+        end = section_match.end()
+        if trailing is not None:
+            container_start = end
+            end = self._trailing_end(trailing, string, container_start, endpos, budget)
+            if end is None:
+                return None
+            spans.append((container_start, end))
+        spans[0] = (first_match.start(), end)
+        return SectionMatch(string, spans)
+
+    @staticmethod
+    def _trailing_end(container, string, start, endpos, budget=None):
+        """
+        Where a loop or switch that a dict ends with ends when the dict is searched for. A loop takes every
+        record that follows in a row and a switch takes the shortest run of lines that it parses
+        :param Loop|Switch container:
+        :param str string:
+        :param int start:
+        :param int endpos:
+        :param SparserBudget budget:
+        :rtype: int or None
+        """
+        end = start
+        if isinstance(container, Loop):
+            pos = start
+            while True:
+                record_end, case_obj, match = container._scan(string, pos, endpos, budget)
+                if case_obj is None or record_end == pos:
+                    return end
+                end = record_end
+                if record_end == endpos:
+                    return end
+                pos = record_end + 1
+
+        newline = b'\n' if container.encoding is not None else '\n'
+        n_newlines = 0
+        while True:
+            end = string.find(newline, end, endpos)
+            if end == -1:
+                end = endpos
+            if container.span_matches(string, start, end):
+                return end
+            if end == endpos or n_newlines >= container.max_newlines:
+                return None
+            end += 1
+            n_newlines += 1
+
+    def matches(self, string, pos=0, endpos=None):
+        """
+        Whether parse would succeed, without building any errors or running custom type callbacks
+        :param str string:
+        :param int pos:
+        :param int endpos:
+        :rtype: bool
+        """
+        if endpos is None:
+            endpos = len(string)
+        budget = _current_budget()
+        if budget is not None:
+            budget.step()
+        match = self.match(string, pos, endpos)
+        return match is not None and self.match_is_valid(match, string)
+
+    def match_is_valid(self, match, string):
+        """
+        Whether every loop and switch in a match of this dict's regex parses, and every value of the built-in
+        number types converts. Custom type callbacks aren't run
+        :param re.Match match:
+        :param str string: the string that was matched
+        :rtype: bool
+        """
+        encoding = self.encoding
+        scanned = match.scanned if type(match) is SectionMatch else None
+        for idx, container, cb in self._match_checks:
+            if container is not None:
+                if scanned is not None:
+                    if not container.scanned_is_valid(scanned[idx], string):
+                        return False
+                elif not container.span_matches(string, match.start(idx), match.end(idx)):
+                    return False
+                continue
+            try:
+                if encoding is not None:
+                    cb(_decode(match.group(idx), encoding))
+                else:
+                    cb(match.group(idx))
+            except SparserValueError:
+                return False
+        return True
+
+    def convert(self, match, string, loop_output=None, parse_loop=None):
+        """
+        Run the callbacks over a match of this dict's regex
+        :param re.Match match:
+        :param str string: the string that was matched
+        :param str loop_output: overrides the loop_output that the loops were compiled with
+        :param func parse_loop: if set, loops are parsed with parse_loop(loop, string, start, end)
+                                instead of with Loop.parse_span
+        :rtype: {var_name: var_val} or a Record if compiled with records=True
+        """
+        values = self.values(match, string, loop_output, parse_loop)
+        if self.record_class is not None:
+            return self.record_class(values)
+        return dict(zip(self.names, values))
+
+    def values(self, match, string, loop_output=None, parse_loop=None):
+        """
+        What convert is made of: the values in the same order as d_entries
+        :param re.Match match:
+        :param str string: the string that was matched
+        :param str loop_output: overrides the loop_output that the loops were compiled with
+        :param func parse_loop: see convert
+        :rtype: [var_val, ...]
+        """
+        ret = []
+        append = ret.append
+        encoding = self.encoding
+        scanned = match.scanned if type(match) is SectionMatch else None
+        for idx, d_entry in enumerate(self.d_entries, 1):
+            container = d_entry.container
+            if container is not None:
+                if scanned is not None:
+                    append(container.convert_scanned(string, match.span(idx), scanned[idx], loop_output))
+                elif parse_loop is not None and isinstance(container, Loop):
+                    append(parse_loop(container, string, match.start(idx), match.end(idx)))
+                else:
+                    append(container.parse_span(string, match.start(idx), match.end(idx), loop_output))
+                continue
+            sub_match = match.group(idx)
+            if encoding is not None:
+                sub_match = _decode(sub_match, encoding)
+            try:
+                append(d_entry.cb(sub_match))
+            except TypeError:
+                append(d_entry.cb(unicode(sub_match)))
+        return ret
+
+
+class SectionMatch(object):
+    """
+    The parts of re.Match that the rest of sparser uses, for a Dict matched a section at a time
+    """
+    def __init__(self, string, spans, scanned=None):
+        """
+        :param str string:
+        :param [(int, int), ...] spans: of the whole match and then of each group
+        :param dict scanned: {group: what Loop.nested_ends or Switch.nested_ends found in it} for a record
+                             matched by Case.match_record, so that its loops and switches aren't matched again
+        """
+        self.string = string
+        self._spans = spans
+        self.scanned = scanned
+
+    def group(self, idx=0):
+        start, end = self._spans[idx]
+        return self.string[start:end]
+
+    def groups(self):
+        return tuple(self.string[start:end] for start, end in self._spans[1:])
+
+    def start(self, idx=0):
+        return self._spans[idx][0]
+
+    def end(self, idx=0):
+        return self._spans[idx][1]
+
+    def span(self, idx=0):
+        return self._spans[idx]
+
+
+class Case(SIS):
+    def __init__(self, tokens, ctx):
+        """
+        :param [TOKEN, ...] token:
+        :param SparserCompilationContext ctx:
+        """
+        match = tokens[0].regex.search(tokens[0].content)
+        if match and match.group(1) is not None:
+            self.var_name = match.group(1).strip()
+        else:
+            self.var_name = None
+        self.dict = Dict(tokens[1:-1], ctx)
+        if ctx.records:
+            self.dict.record_class = _record_class(self.dict.names, self.var_name)
+
+        # Dict patterns end in "$" which also matches before a trailing newline that it never consumes
+        self.min_newlines, self.max_newlines = _pattern_newline_span(self.dict.translated_patt)
+        self.max_newlines += 1
+        self.prefix = _pattern_literal_prefix(self.dict.translated_patt)
+        if ctx.encoding is not None:
+            self.prefix = self.prefix.encode(ctx.encoding)
+
+        # a case with loops or switches in it is matched with match_record, which works out where they end
+        # as it goes. In a loop, it also works out where the record ends. A switch sets anchored since its
+        # span is known ahead of time
+        self._containers = [member for member in self.dict.members if isinstance(member, (Loop, Switch))]
+        self.nested = bool(self._containers)
+        self.anchored = False
+        self._record_regexes = None
+        if self.nested:
+            sections = self.dict._section_patts
+            self._record_regexes = [_compile_regex(section, re.DOTALL, ctx.encoding) for section in sections[:-1]]
+            # "$" is swapped for the end of any line since the record's end isn't known ahead of time
+            self._record_regexes.append(_compile_regex(sections[-1][:-1] + r"(?=\n|\Z)", re.DOTALL, ctx.encoding))
+
+    def match_record(self, buf, pos, endpos, budget=None):
+        """
+        Match this case at pos when it has loops or switches in it, in a single pass. The sections between
+        them are matched one after the other. A loop takes as many records as it can, giving them back one
+        at a time from the last until the section after it matches, and a switch ends at the first place
+        that the section after it matches where it parses what comes before. In a loop, the record ends at
+        the end of whichever line the last section ends on
+        :param str buf: only \n newlines are allowed
+        :param int pos: the start of a line, or where the switch starts if anchored
+        :param int endpos: where the loop that the record is in ends, or where the switch ends if anchored
+        :param SparserBudget budget:
+        :rtype: SectionMatch or None
+        """
+        regexes = self.dict.section_regexes if self.anchored else self._record_regexes
+        section_match = regexes[0].match(buf, pos, endpos)
+        if section_match is None:
+            return None
+        spans = [None]
+        spans.extend(section_match.regs[1:])
+        scanned = {}
+        end = self._match_containers(buf, regexes, 0, section_match.end(), endpos, spans, scanned, budget)
+        if end is None:
+            return None
+        spans[0] = (pos, end)
+        return SectionMatch(buf, spans, scanned)
+
+    def _match_containers(self, buf, regexes, idx, start, endpos, spans, scanned, budget):
+        """
+        Match the idx'th loop or switch at start and everything after it, trying each place that it can
+        end in turn until the rest matches too
+        :param str buf:
+        :param [re.Pattern, ...] regexes: of the sections between the loops and switches
+        :param int idx:
+        :param int start:
+        :param int endpos:
+        :param [(int, int), ...] spans: of the groups matched so far, which is added to
+        :param dict scanned: see SectionMatch, which is added to
+        :param SparserBudget budget:
+        :rtype: int where the record ends or None
+        """
+        container = self._containers[idx]
+        is_last = idx + 1 == len(self._containers)
+        group = len(spans)
+        for end, found, section_match in container.nested_ends(buf, start, endpos, regexes[idx + 1], budget):
+            del spans[group:]
+            spans.append((start, end))
+            spans.extend(section_match.regs[1:])
+            scanned[group] = found
+            if is_last:
+                return section_match.end()
+            record_end = self._match_containers(buf, regexes, idx + 1, section_match.end(), endpos, spans, scanned,
+                                                budget)
+            if record_end is not None:
+                return record_end
+        return None
+
+    def parse(self, entry, pos=0, endpos=None, loop_output=None):
+        """
+        :param str entry:
+        :param int pos:
+        :param int endpos:
+        :param str loop_output:
+        :rtype: {var_name: var_val, ...}
+        """
+        if endpos is None:
+            endpos = len(entry)
+        match = self.dict.match(entry, pos, endpos)
+        if match is None:
+            return None
+        return self.convert(match, entry, loop_output)
+
+    def convert(self, match, entry, loop_output=None):
+        """
+        :param re.Match match: a match of this case's regex
+        :param str entry:
+        :param str loop_output:
+        :rtype: {var_name: var_val, ...}
+        """
+        ret = self.dict.convert(match, entry, loop_output)
+        if self.var_name is not None and self.dict.record_class is None:
+            ret["case"] = self.var_name
+        return ret
+
+    def record(self, values):
+        """
+        :param [var_val, ...] values: from Dict.values
+        :rtype: {var_name: var_val, ...} or a Record
+        """
+        if self.dict.record_class is not None:
+            return self.dict.record_class(values)
+        ret = dict(zip(self.dict.names, values))
+        if self.var_name is not None:
+            ret["case"] = self.var_name
+        return ret
+
+
+class CaseIndex(object):
+    """
+    Narrows down the cases of a loop or switch to the ones whose literal prefix is at the start of the input,
+    so that only those run their regex. The cases that are left are still tried in order. Anything else with
+    a prefix, like the templates of a TemplateSet, can be indexed the same way
+    """
+    @classmethod
+    def for_cases(cls, cases):
+        """
+        :param [Case, ...] cases:
+        :rtype: CaseIndex or None if it wouldn't narrow the cases down enough to be worth it
+        """
+        if len(cases) < MIN_INDEXED_CASES or not any(case_obj.prefix for case_obj in cases):
+            return None
+        return cls(cases)
+
+    def __init__(self, cases):
+        """
+        :param [Case, ...] cases:
+        """
+        self.cases = cases
+        self._unprefixed = [case_obj for case_obj in cases if not case_obj.prefix]
+        # the longest prefix at the start of the input decides which of the others are there too
+        self._by_prefix = {}
+        for case_obj in cases:
+            prefix = case_obj.prefix
+            if prefix and prefix not in self._by_prefix:
+                self._by_prefix[prefix] = [other for other in cases
+                                           if not other.prefix or prefix.startswith(other.prefix)]
+        self._prefix_lens = sorted(set(len(prefix) for prefix in self._by_prefix), reverse=True)
+
+    def candidates(self, buf, pos, endpos):
+        """
+        :param str buf:
+        :param int pos:
+        :param int endpos:
+        :rtype: [Case, ...] the cases that could match buf[pos:endpos], in order
+        """
+        for prefix_len in self._prefix_lens:
+            candidates = self._by_prefix.get(buf[pos:pos + prefix_len])
+            if candidates is not None and pos + prefix_len <= endpos:
+                return candidates
+        return self._unprefixed
+
+
+class Categorical(object):
+    """
+    A column of labels that repeat a lot, stored as small integer codes into a list of categories.
+    A code of -1 means no label. This is the layout that
+    pandas.Categorical.from_codes(column.codes, column.categories) expects
+    """
+    def __init__(self, categories, codes):
+        """
+        :param [str, ...] categories:
+        :param array.array codes:
+        """
+        self.categories = categories
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.categories[code] if code >= 0 else None for code in self.codes[idx]]
+        code = self.codes[idx]
+        return self.categories[code] if code >= 0 else None
+
+    def __iter__(self):
+        categories = self.categories
+        return (categories[code] if code >= 0 else None for code in self.codes)
+
+    def __eq__(self, other):
+        if isinstance(other, Categorical):
+            return list(self) == list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Categorical(%r)" % list(self)
+
+    def tolist(self):
+        """
+        :rtype: [str, ...]
+        """
+        return list(self)
+
+
+class LazyLoop(object):
+    """
+    What a loop parses into with loop_output="lazy". Nothing is parsed until it is iterated over, and then
+    the records come out of the loop's part of the input a batch at a time. Each iteration parses them again
+    """
+    def __init__(self, loop, buf, start, end):
+        """
+        :param Loop loop:
+        :param str buf: the input that the loop was captured from
+        :param int start:
+        :param int end:
+        """
+        self.loop = loop
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        loop, buf, start, end = self.loop, self.buf, self.start, self.end
+        line_chars = loop.line_chars
+        if buf.find(line_chars.carriage_return, start, end) != -1:
+            buf = line_chars.newline_re.sub(line_chars.newline, buf[start:end])
+            start, end = 0, len(buf)
+        if not line_chars.non_newline_re.search(buf, start, end):
+            return iter(())
+        return loop.iter_rows(buf, start, end)
+
+    def __repr__(self):
+        return "<LazyLoop %r at %d:%d>" % (self.loop.loop_name, self.start, self.end)
+
+    def tolist(self):
+        """
+        :rtype: [{var_name: var_val, ...}, ...]
+        """
+        return list(self)
+
+
+class Record(tuple):
+    """
+    What a pattern and each of its cases parse into with records=True instead of a dict. Every case, and
+    the pattern itself, has its own subclass (see _record_class) that keeps the values in a tuple in the
+    order that the variables come in, with the case name on the class instead of in every record.
+    Records read like a dict that can't be changed: record["qty"], keys(), items(), get(), "qty" in record.
+    Iterating over one gives its names. todict() turns it back into a dict, e.g. for json.dumps
+    """
+    __slots__ = ()
+    _fields = ()
+    _case = None
+    _keys = ()
+    _index = {}
+
+    def __getitem__(self, name):
+        try:
+            return tuple.__getitem__(self, self._index[name])
+        except KeyError:
+            if name == "case" and self._case is not None:
+                return self._case
+            raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, name):
+        return name in self._index or (name == "case" and self._case is not None)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._keys == other._keys and self._case == other._case and tuple.__eq__(self, other)
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return "Record({%s})" % ", ".join("%r: %r" % item for item in self.items())
+
+    def __reduce__(self):
+        # the subclasses are made on the fly so they are pickled by what they were made from
+        return _make_record, (self._fields, self._case, tuple(tuple.__iter__(self)))
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        if self._case is None:
+            return list(tuple.__iter__(self))
+        return [self[name] for name in self._keys]
+
+    def items(self):
+        return list(zip(self._keys, self.values()))
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def todict(self):
+        """
+        :rtype: {var_name: var_val, ...} with the records of loops and switches turned into dicts as well
+        """
+        return dict((name, _record_to_dict(value)) for name, value in self.items())
+
+
+Mapping.register(Record)
+
+_record_classes = {}
+
+
+def _record_class(fields, case=None):
+    """
+    The Record subclass for the given variables and case name. They are made once and then shared
+    :param [str, ...] fields: the variable names, in the order that their values are given in
+    :param str case: the name of the case
+    :rtype: type
+    """
+    key = (tuple(fields), case)
+    cls = _record_classes.get(key)
+    if cls is None:
+        # like a dict, the case name wins over a variable that is also called "case"
+        index = dict((name, i) for i, name in enumerate(key[0]) if case is None or name != "case")
+        keys = key[0] if case is None or "case" in key[0] else key[0] + ("case",)
+        cls = type("Record", (Record,), {"__slots__": (), "_fields": key[0], "_case": case, "_keys": keys,
+                                         "_index": index})
+        cls = _record_classes.setdefault(key, cls)
+    return cls
+
+
+def _make_record(fields, case, values):
+    """
+    :param (str, ...) fields:
+    :param str case:
+    :param (var_val, ...) values:
+    :rtype: Record
+    """
+    return _record_class(fields, case)(values)
+
+
+def _record_to_dict(value):
+    """
+    :param value: a parsed value
+    :rtype: the value with the Records in it turned into dicts
+    """
+    if isinstance(value, Record):
+        return value.todict()
+    if isinstance(value, (list, LazyLoop)):
+        return [_record_to_dict(item) for item in value]
+    return value
+
+
+class Loop(SIS):
+    def __init__(self, tokens, ctx):
+        """
+        :param [TOKEN, ...] token:
+        :param SparserCompilationContext ctx:
+        """
+        assert isinstance(tokens[0], OPENLOOP)
+        assert isinstance(tokens[-1], CLOSELOOP)
+        self.loop_name = tokens[0].content[2:-2].split(' ')[1]
+        self.loop_output = ctx.loop_output
+        self.encoding = ctx.encoding
+        self.line_chars = BYTES_LINE_CHARS if ctx.encoding is not None else STR_LINE_CHARS
+        tokens = tokens[1:-1]  # pop off LOOPSTART LOOPEND
+        self.cases = []
+        while tokens:
+            if isinstance(tokens[0], OPENCASE):
+                tokens, case = _make_case(tokens, ctx)
+                self.cases.append(case)
+            elif isinstance(tokens[0], TEXT):
+                token = tokens.pop(0)
+                if token.content.strip():
+                    raise SparserSyntaxError("{*loop*} tags can only contain {*case*}s")
+            else:
+                raise SparserSyntaxError("{*loop*} tags can only contain {*case*}s")
+        if not self.cases:
+            raise SparserSyntaxError("{*loop*} tags must contain at least one {*case*}")
+        self.case_index = CaseIndex.for_cases(self.cases)
+        self.max_newlines = max(case_obj.max_newlines for case_obj in self.cases)
+        self.nested = any(case_obj.nested for case_obj in self.cases)
+        # a nested case is only tried once, at the fewest lines that it could take, and works out its own end
+        self._scan_newlines = max(case_obj.min_newlines if case_obj.nested else case_obj.max_newlines
+                                  for case_obj in self.cases)
+        # loops and switches inside of the cases have to be parsed in place, a record at a time
+        self._can_batch = not any(d_entry.container is not None
+                                  for case_obj in self.cases for d_entry in case_obj.dict.d_entries)
+        self._plan_columns()
+
+    def translate(self):
+        """
+        :rtype: (str patt, str loop_name, func cb)
+        """
+        patt = "(?P<%s>.*?)" % self.loop_name
+        return patt, self.loop_name, self.cb
+
+    def cb(self, string_input):
+        """
+        :param str string_input: the string captured within the loop
+        :rtype: [{var_name: var_val, ...}, ...]
+        """
+        return self.parse_span(string_input, 0, len(string_input))
+
+    def parse_span(self, buf, start, end, loop_output=None):
+        """
+        Parse buf[start:end] in a single forward pass
+        :param str buf: the input that the loop was captured from
+        :param int start:
+        :param int end:
+        :param str loop_output: "rows", "columns" or "lazy". Defaults to what the loop was compiled with
+        :rtype: [{var_name: var_val, ...}, ...] or {var_name: column, ...} or LazyLoop
+        """
+        if (loop_output or self.loop_output) == 'lazy':
+            return LazyLoop(self, buf, start, end)
+        line_chars = self.line_chars
+        if buf.find(line_chars.carriage_return, start, end) != -1:
+            # only \n newlines are matched against the cases
+            buf = line_chars.newline_re.sub(line_chars.newline, buf[start:end])
+            start, end = 0, len(buf)
+        if (loop_output or self.loop_output) == 'columns':
+            return self.parse_columns(buf, start, end)
+        if not line_chars.non_newline_re.search(buf, start, end):
+            return []
+        return self.convert_batches(buf, self.iter_batches(buf, start, end))
+
+    def convert_scanned(self, buf, span, batch, loop_output=None):
+        """
+        Same as parse_span for the records that nested_ends found in buf[span[0]:span[1]]
+        :param str buf:
+        :param (int, int) span:
+        :param ([Case, ...], [re.Match, ...]) batch:
+        :param str loop_output:
+        :rtype: [{var_name: var_val, ...}, ...] or {var_name: column, ...} or LazyLoop
+        """
+        loop_output = loop_output or self.loop_output
+        if loop_output == 'lazy':
+            return LazyLoop(self, buf, span[0], span[1])
+        return self.convert_batches(buf, [batch] if batch[0] else (), columns=loop_output == 'columns')
+
+    def scanned_is_valid(self, batch, buf):
+        """
+        Same as span_matches for the records that nested_ends found
+        :param ([Case, ...], [re.Match, ...]) batch:
+        :param str buf:
+        :rtype: bool
+        """
+        return all(not case_obj.dict._match_checks or case_obj.dict.match_is_valid(match, buf)
+                   for case_obj, match in zip(*batch))
+
+    def nested_ends(self, buf, start, endpos, next_regex, budget=None):
+        """
+        Where this loop can end when it is inside a record of another loop, for Case.match_record. It takes
+        as many records as follow start in a row and then gives them back one at a time, last first
+        :param str buf: only \n newlines are allowed
+        :param int start:
+        :param int endpos:
+        :param re.Pattern next_regex: the section after the loop, which has to match where it ends
+        :param SparserBudget budget:
+        :rtype: generator of (int end, ([Case, ...], [re.Match, ...]) records, re.Match of next_regex)
+        """
+        ends = [start]
+        cases, matches = [], []
+        pos = start
+        while True:
+            record_end, case_obj, match = self._scan(buf, pos, endpos, budget)
+            if case_obj is None:
+                break
+            ends.append(record_end)
+            cases.append(case_obj)
+            matches.append(match)
+            if record_end == endpos:
+                break
+            pos = record_end + 1
+        section_match = next_regex.match(buf, ends[-1], endpos)
+        if section_match is not None:
+            yield ends[-1], (cases, matches), section_match
+        for n_records in range(len(cases) - 1, -1, -1):
+            section_match = next_regex.match(buf, ends[n_records], endpos)
+            if section_match is not None:
+                yield ends[n_records], (cases[:n_records], matches[:n_records]), section_match
+
+    def span_matches(self, buf, start, end):
+        """
+        Whether parse_span would succeed, leaving out the callbacks
+        :param str buf:
+        :param int start:
+        :param int end:
+        :rtype: bool
+        """
+        line_chars = self.line_chars
+        if buf.find(line_chars.carriage_return, start, end) != -1:
+            buf = line_chars.newline_re.sub(line_chars.newline, buf[start:end])
+            start, end = 0, len(buf)
+        return self.first_unmatched(buf, start, end) is None
+
+    @property
+    def single_line_records(self):
+        """
+        Whether every record is a single line, so that the records in a span are the same lines wherever
+        the span starts and ends
+        :rtype: bool
+        """
+        return all(case_obj.min_newlines == 0 and case_obj.max_newlines == 1 for case_obj in self.cases)
+
+    def first_unmatched(self, buf, start, end):
+        """
+        Where the first record in buf[start:end] that doesn't parse starts, leaving out the callbacks
+        :param str buf: only \n newlines are allowed
+        :param int start:
+        :param int end:
+        :rtype: int or None if every record parses
+        """
+        if not self.line_chars.non_newline_re.search(buf, start, end):
+            return None
+        budget = _current_budget()
+        pos = start
+        while True:
+            record_end, case_obj, match = self._scan(buf, pos, end, budget)
+            if case_obj is None:
+                return pos
+            if case_obj.dict._match_checks and not case_obj.dict.match_is_valid(match, buf):
+                return pos
+            if record_end == end:
+                return None
+            pos = record_end + 1
+
+    def iter_records(self, buf, pos, end):
+        """
+        Yield the records in buf[pos:end] one at a time
+        :param str buf: only \n newlines are allowed
+        :param int pos:
+        :param int end:
+        :rtype: generator of {var_name: var_val, ...}
+        """
+        for case_obj, match in self.iter_matches(buf, pos, end):
+            yield case_obj.convert(match, buf)
+
+    def iter_matches(self, buf, pos, end):
+        """
+        Like iter_records but yields the raw matches without running any callbacks
+        :param str buf: only \n newlines are allowed
+        :param int pos:
+        :param int end:
+        :rtype: generator of (Case, re.Match)
+        """
+        budget = _current_budget()
+        while True:
+            record_end, case_obj, match = self._scan(buf, pos, end, budget)
+            if case_obj is None:
+                raise self.unmatched_error(_error_slice(buf, pos, end))
+            yield case_obj, match
+            if record_end == end:
+                return
+            pos = record_end + 1
+
+    def iter_rows(self, buf, pos, end):
+        """
+        Like iter_records but the callbacks run a batch at a time. The first batch is a single record and
+        each one after that is twice as big, up to BATCH_SIZE, so that the first few records come out quickly
+        :param str buf: only \n newlines are allowed
+        :param int pos:
+        :param int end:
+        :rtype: generator of {var_name: var_val, ...}
+        """
+        for cases, matches in self.iter_batches(buf, pos, end, batch_size=1):
+            try:
+                rows = self._batch_rows(buf, cases, matches)
+            except SparserTimeoutError:
+                # an alarm can go off anywhere, so it isn't the batch's fault
+                raise
+            except Exception:
+                # yield the records before the one that doesn't convert and then raise its error
+                rows = (case_obj.convert(match, buf) for case_obj, match in zip(cases, matches))
+            for row in rows:
+                yield row
+
+    def iter_batches(self, buf, pos, end, batch_size=BATCH_SIZE):
+        """
+        Like iter_matches but yields up to BATCH_SIZE matches at a time. The records before a line
+        that doesn't match are yielded before it is reported so that errors come out in the same
+        order as with iter_records. Records with loops or switches in them are converted one at a time
+        anyway, so they are yielded one at a time instead of keeping everything that they matched around
+        :param str buf: only \n newlines are allowed
+        :param int pos:
+        :param int end:
+        :param int batch_size: the size of the first batch. Each batch after it is twice as big, up to BATCH_SIZE
+        :rtype: generator of ([Case, ...], [re.Match, ...])
+        """
+        budget = _current_budget()
+        max_batch_size = BATCH_SIZE if self._can_batch else 1
+        batch_size = min(batch_size, max_batch_size)
+        cases, matches = [], []
+        while True:
+            record_end, case_obj, match = self._scan(buf, pos, end, budget)
+            if case_obj is None:
+                if cases:
+                    yield cases, matches
+                raise self.unmatched_error(_error_slice(buf, pos, end))
+            cases.append(case_obj)
+            matches.append(match)
+            if record_end == end:
+                yield cases, matches
+                return
+            if len(cases) == batch_size:
+                yield cases, matches
+                cases, matches = [], []
+                batch_size = min(batch_size * 2, max_batch_size)
+            pos = record_end + 1
+
+    def convert_batches(self, buf, batches, columns=False):
+        """
+        :param str buf:
+        :param iterable batches: from iter_batches
+        :param bool columns: whether to return columns instead of rows
+        :rtype: [{var_name: var_val, ...}, ...] or {var_name: column, ...}
+        """
+        if columns:
+            ret = self._new_columns()
+            for cases, matches in batches:
+                self._extend_columns(ret, buf, cases, matches)
+            return self._finish_columns(ret)
+        ret = []
+        for cases, matches in batches:
+            ret.extend(self._batch_rows(buf, cases, matches))
+        return ret
+
+    def parse_columns(self, buf, start, end):
+        """
+        Parse buf[start:end] into one column per variable instead of one dict per record.
+        int columns become array('q') and float and currency columns become array('d') with
+        NaN where a record's case doesn't have the variable. int columns with gaps stay lists
+        with None in the gaps, as do the other types. Case names become a Categorical column
+        :param str buf: only \n newlines are allowed
+        :param int start:
+        :param int end:
+        :rtype: {var_name: list|array.array|Categorical, ...}
+        """
+        batches = ()
+        if self.line_chars.non_newline_re.search(buf, start, end):
+            batches = self.iter_batches(buf, start, end)
+        return self.convert_batches(buf, batches, columns=True)
+
+    def build_columns(self, records):
+        """
+        :param iterable records: (Case, [var_val, ...]) pairs with the values from Dict.values
+        :rtype: {var_name: list|array.array|Categorical, ...}
+        """
+        columns = self._new_columns()
+        self._append_records(columns, records)
+        return self._finish_columns(columns)
+
+    def _convert_batch(self, cases, matches):
+        """
+        Run the callbacks over a batch of matches a whole variable at a time instead of a value at a time
+        :param [Case, ...] cases:
+        :param [re.Match, ...] matches:
+        :rtype: {Case: (int n_records, [[var_val, ...], ...])} a list of values for each of the case's d_entries
+        """
+        groups = list(map(MATCH_TYPE.groups, matches))
+        if cases.count(cases[0]) == len(cases):
+            groups_by_case = {cases[0]: groups}
+        else:
+            groups_by_case = {}
+            for record_case, record_groups in zip(cases, groups):
+                try:
+                    groups_by_case[record_case].append(record_groups)
+                except KeyError:
+                    groups_by_case[record_case] = [record_groups]
+
+        ret = {}
+        encoding = self.encoding
+        budget = _current_budget()
+        stats = budget.stats if budget is not None else None
+        for case_obj, case_groups in groups_by_case.items():
+            if stats is not None:
+                started = _clock()
+            values = []
+            for d_entry, raws in zip(case_obj.dict.d_entries, zip(*case_groups)):
+                if encoding is not None:
+                    raws = _bulk_decode(raws, encoding)
+                if d_entry.bulk_cb is not None:
+                    values.append(d_entry.bulk_cb(raws))
+                else:
+                    values.append(list(map(d_entry.cb, raws)))
+            ret[case_obj] = (len(case_groups), values)
+            if stats is not None:
+                stats.cases[case_obj][4] += _clock() - started
+        return ret
+
+    def _batch_rows(self, buf, cases, matches):
+        """
+        :param str buf:
+        :param [Case, ...] cases:
+        :param [re.Match, ...] matches:
+        :rtype: [{var_name: var_val, ...}, ...]
+        """
+        try:
+            converted = self._convert_batch(cases, matches) if self._can_batch else None
+        except SparserTimeoutError:
+            raise
+        except Exception:
+            converted = None
+        if converted is None:
+            # this also raises the same error, for the same record, that parsing record by record would
+            budget = _current_budget()
+            if budget is not None and budget.stats is not None:
+                return [budget.stats.convert_case(case_obj, match, buf) for case_obj, match in zip(cases, matches)]
+            return [case_obj.convert(match, buf) for case_obj, match in zip(cases, matches)]
+
+        rows_by_case = {}
+        for case_obj, (n_records, values) in converted.items():
+            record_class = case_obj.dict.record_class
+            if record_class is not None:
+                # a record's values are in a tuple already, so zip makes them in one go
+                rows_by_case[case_obj] = (list(map(record_class, zip(*values))) if values
+                                          else [record_class()] * n_records)
+                continue
+            names = case_obj.dict.names
+            if case_obj.var_name is not None:
+                names = names + ["case"]
+                values = values + [repeat(case_obj.var_name, n_records)]
+            if values:
+                rows_by_case[case_obj] = list(map(dict, map(zip, repeat(names), zip(*values))))
+            else:
+                rows_by_case[case_obj] = [{} for _ in range(n_records)]
+        if len(rows_by_case) == 1:
+            return rows_by_case.popitem()[1]
+        row_iters = dict((case_obj, iter(rows)) for case_obj, rows in rows_by_case.items())
+        return list(map(next, map(row_iters.__getitem__, cases)))
+
+    def _new_columns(self):
+        """
+        :rtype: ([list|array.array, ...], array.array codes)
+        """
+        return [array(typecode) if typecode else [] for typecode in self._column_typecodes], array(self._code_typecode)
+
+    def _finish_columns(self, new_columns):
+        """
+        :param new_columns: from _new_columns
+        :rtype: {var_name: list|array.array|Categorical, ...}
+        """
+        columns, codes = new_columns
+        ret = dict(zip(self.column_names, columns))
+        if self._case_categories:
+            ret["case"] = Categorical(self._case_categories, codes)
+        return ret
+
+    def _append_records(self, new_columns, records):
+        """
+        :param new_columns: from _new_columns
+        :param iterable records: (Case, [var_val, ...]) pairs with the values from Dict.values
+        """
+        columns, codes = new_columns
+        plans = self._column_plans
+        for case_obj, values in records:
+            code, column_idxs, missing = plans[case_obj]
+            codes.append(code)
+            for column_idx, value in zip(column_idxs, values):
+                try:
+                    columns[column_idx].append(value)
+                except OverflowError:
+                    columns[column_idx] = columns[column_idx].tolist()
+                    columns[column_idx].append(value)
+            for column_idx in missing:
+                column = columns[column_idx]
+                if type(column) is array:
+                    if column.typecode == 'd':
+                        column.append(NAN)
+                        continue
+                    column = columns[column_idx] = column.tolist()
+                column.append(None)
+
+    def _extend_columns(self, new_columns, buf, cases, matches):
+        """
+        :param new_columns: from _new_columns
+        :param str buf:
+        :param [Case, ...] cases:
+        :param [re.Match, ...] matches:
+        """
+        try:
+            converted = self._convert_batch(cases, matches) if self._can_batch else None
+        except SparserTimeoutError:
+            raise
+        except Exception:
+            converted = None
+        if converted is None:
+            self._append_records(new_columns, [(case_obj, case_obj.dict.values(match, buf))
+                                               for case_obj, match in zip(cases, matches)])
+            return
+
+        columns, codes = new_columns
+        plans = self._column_plans
+        codes.extend([plans[case_obj][0] for case_obj in cases])
+        values_by_case = dict((case_obj, dict(zip(plans[case_obj][1], values)))
+                              for case_obj, (_, values) in converted.items())
+        for column_idx, column in enumerate(columns):
+            gap = NAN if self._column_typecodes[column_idx] == 'd' else None
+            if len(converted) == 1:
+                case_obj, (n_records, _) = next(iter(converted.items()))
+                values = values_by_case[case_obj].get(column_idx)
+                if values is None:
+                    values = [gap] * n_records
+            else:
+                value_iters = dict((case_obj, iter(case_values[column_idx]) if column_idx in case_values
+                                    else repeat(gap))
+                                   for case_obj, case_values in values_by_case.items())
+                values = list(map(next, map(value_iters.__getitem__, cases)))
+
+            if type(column) is array:
+                n_before = len(column)
+                try:
+                    column.extend(values)
+                    continue
+                except (OverflowError, TypeError):
+                    # too big for array('q') or None in an int column
+                    del column[n_before:]
+                    column = columns[column_idx] = column.tolist()
+            column.extend(values)
+
+    def parse_span_parallel(self, pool, buf, start, end, chunk_size, loop_output=None):
+        """
+        Same as parse_span but the matching and the callbacks are farmed out to pool.
+        buf[start:end] is split into chunks at line ends. Every chunk is scanned on its own as if
+        a record started at its first line and the chunks are then stitched back together in order.
+        Wherever a chunk's records don't line up with the records before it, the records are
+        re-scanned here until they do, so the result and any error are the same as parse_span's
+        :param multiprocessing.Pool pool: its workers were started with _init_parallel_worker
+        :param str buf:
+        :param int start:
+        :param int end:
+        :param int chunk_size: roughly how many characters go to a worker at a time
+        :param str loop_output:
+        :rtype: [{var_name: var_val, ...}, ...] or {var_name: column, ...}
+        """
+        if end - start <= chunk_size or self.nested:
+            # a chunk can't tell where a record with a nested loop in it ends
+            return self.parse_span(buf, start, end, loop_output)
+        if buf.find('\r', start, end) != -1:
+            buf = NEWLINE_RE.sub('\n', buf[start:end])
+            start, end = 0, len(buf)
+
+        columns = (loop_output or self.loop_output) == 'columns'
+        segments = ()
+        if NON_NEWLINE_RE.search(buf, start, end):
+            chunk_starts = []
+            tasks = []
+            chunk_start = start
+            while True:
+                chunk_end = buf.find('\n', chunk_start + chunk_size, end)
+                if chunk_end == -1:
+                    chunk_end = end
+                chunk_starts.append(chunk_start)
+                tasks.append((self.loop_name, chunk_start, buf[chunk_start:chunk_end], chunk_end == end, columns))
+                if chunk_end == end:
+                    break
+                chunk_start = chunk_end + 1
+            segments = self._stitch(buf, start, end, chunk_starts, pool.imap(_scan_chunk, tasks))
+
+        if not columns:
+            ret = []
+            for chunk_records, record_idx, serial_record in segments:
+                if chunk_records is None:
+                    case_obj, match = serial_record
+                    ret.append(case_obj.convert(match, buf))
+                else:
+                    ret.extend(chunk_records[record_idx:] if record_idx else chunk_records)
+            return ret
+
+        parts = []
+        serial_records = []
+        for chunk_columns, record_idx, serial_record in segments:
+            if chunk_columns is None:
+                case_obj, match = serial_record
+                serial_records.append((case_obj, case_obj.dict.values(match, buf)))
+                continue
+            if serial_records:
+                parts.append(self.build_columns(serial_records))
+                serial_records = []
+            parts.append(_slice_columns(chunk_columns, record_idx) if record_idx else chunk_columns)
+        if serial_records or not parts:
+            parts.append(self.build_columns(serial_records))
+        return _concat_columns(parts)
+
+    def _stitch(self, buf, start, end, chunk_starts, chunk_results):
+        """
+        :param str buf:
+        :param int start:
+        :param int end:
+        :param [int, ...] chunk_starts:
+        :param iterable chunk_results: what _scan_chunk returned for each chunk, in order
+        :rtype: generator of (chunk_records, int record_idx, None) for the records of a chunk from
+                record_idx on or (None, None, (Case, re.Match)) for records that were re-scanned here
+        """
+        chunk_results = iter(chunk_results)
+        next_chunk_idx = 0
+        next_chunk_start = start
+        pos = start
+        while pos <= end:
+            while pos >= next_chunk_start:
+                record_starts, chunk_records, stop, failed, error = next(chunk_results)
+                next_chunk_idx += 1
+                next_chunk_start = chunk_starts[next_chunk_idx] if next_chunk_idx < len(chunk_starts) else end + 1
+
+            record_idx = bisect_left(record_starts, pos)
+            synced = record_idx < len(record_starts) and record_starts[record_idx] == pos
+            if synced:
+                # from here on, this chunk's records are exactly what a serial scan would find
+                yield chunk_records, record_idx, None
+                pos = stop
+            if pos == stop and error is not None:
+                raise error
+            if pos == stop and failed:
+                raise self.unmatched_error(_error_slice(buf, pos, end))
+            if synced:
+                continue
+
+            record_end, case_obj, match = self._scan(buf, pos, end)
+            if case_obj is None:
+                raise self.unmatched_error(_error_slice(buf, pos, end))
+            yield None, None, (case_obj, match)
+            pos = record_end + 1
+
+    def unmatched_error(self, remaining):
+        """
+        :param str remaining: the rest of the loop starting at the line that no case matched
+        :rtype: SparserValueError
+        """
+        err_msg = '%r unmatched for loop %r: [' % (_error_text(remaining, self.encoding), self.loop_name)
+        err_msg += ', '.join("%r" % case_obj.dict.translated_patt for case_obj in self.cases)
+        err_msg += ']'
+        return SparserValueError(err_msg)
+
+    def _plan_columns(self):
+        """
+        Work out the columns for parse_columns ahead of time. Every variable name in any case
+        gets a column, in the order that they first appear
+        """
+        self.column_names = []
+        column_idxs = {}
+        column_cbs = []
+        self._case_categories = []
+        self._column_plans = {}
+        self._case_idxs = dict((case_obj, i) for i, case_obj in enumerate(self.cases))
+        for case_obj in self.cases:
+            column_idxs_of_case = []
+            for d_entry in case_obj.dict.d_entries:
+                if d_entry.name not in column_idxs:
+                    column_idxs[d_entry.name] = len(self.column_names)
+                    self.column_names.append(d_entry.name)
+                    column_cbs.append(set())
+                column_cbs[column_idxs[d_entry.name]].add(d_entry.cb)
+                column_idxs_of_case.append(column_idxs[d_entry.name])
+            self._column_plans[case_obj] = [-1, column_idxs_of_case, set(column_idxs_of_case)]
+            if case_obj.var_name is not None and case_obj.var_name not in self._case_categories:
+                self._case_categories.append(case_obj.var_name)
+
+        for case_obj, plan in self._column_plans.items():
+            if case_obj.var_name is not None:
+                plan[0] = self._case_categories.index(case_obj.var_name)
+            plan[2] = [column_idx for column_idx in range(len(self.column_names)) if column_idx not in plan[2]]
+        self._code_typecode = 'b' if len(self._case_categories) < 128 else 'h'
+        self._column_typecodes = []
+        for cbs in column_cbs:
+            if cbs == set([_intify]):
+                self._column_typecodes.append('q')
+            elif cbs == set([_floatify]):
+                self._column_typecodes.append('d')
+            else:
+                self._column_typecodes.append(None)
+
+    def _scan(self, buf, pos, endpos, budget=None):
+        """
+        Find the shortest run of whole lines starting at pos that one of the cases matches.
+        Runs longer than any case could possibly match are never tried, and neither are cases
+        whose literal prefix isn't at pos
+        :param str buf:
+        :param int pos: the start of a line
+        :param int endpos:
+        :param SparserBudget budget: takes a step for every case that is tried
+        :rtype: (int record_end, Case, re.Match) or (None, None, None)
+        """
+        candidates = self.cases
+        if self.case_index is not None:
+            candidates = self.case_index.candidates(buf, pos, endpos)
+            if budget is not None and budget.stats is not None:
+                budget.stats.skip_cases(self.cases, candidates)
+            if not candidates:
+                return None, None, None
+        if self.nested:
+            return self._scan_nested(buf, pos, endpos, candidates, budget)
+        newline = self.line_chars.newline
+        n_newlines = 0
+        line_end = pos
+        while True:
+            line_end = buf.find(newline, line_end, endpos)
+            if line_end == -1:
+                line_end = endpos
+            for case_obj in candidates:
+                if case_obj.min_newlines <= n_newlines <= case_obj.max_newlines:
+                    if budget is not None:
+                        match = budget.match_case(case_obj, buf, pos, line_end)
+                    else:
+                        match = case_obj.dict.match(buf, pos, line_end)
+                    if match is not None:
+                        return line_end, case_obj, match
+            if line_end == endpos or n_newlines >= self.max_newlines:
+                return None, None, None
+            line_end += 1
+            n_newlines += 1
+
+    def _scan_nested(self, buf, pos, endpos, candidates, budget=None):
+        """
+        Same as _scan for a loop with nested cases. Each of those is tried once, in turn with the others,
+        when the run reaches the fewest lines that it could take, and the record ends wherever it says
+        :param str buf:
+        :param int pos: the start of a line
+        :param int endpos:
+        :param [Case, ...] candidates:
+        :param SparserBudget budget:
+        :rtype: (int record_end, Case, SectionMatch|re.Match) or (None, None, None)
+        """
+        newline = self.line_chars.newline
+        n_newlines = 0
+        line_end = pos
+        while True:
+            line_end = buf.find(newline, line_end, endpos)
+            if line_end == -1:
+                line_end = endpos
+            for case_obj in candidates:
+                if case_obj.nested:
+                    if n_newlines != case_obj.min_newlines:
+                        continue
+                    if budget is not None:
+                        match = budget.match_case(case_obj, buf, pos, endpos, record=True)
+                    else:
+                        match = case_obj.match_record(buf, pos, endpos)
+                    if match is not None:
+                        return match.end(), case_obj, match
+                elif case_obj.min_newlines <= n_newlines <= case_obj.max_newlines:
+                    if budget is not None:
+                        match = budget.match_case(case_obj, buf, pos, line_end)
+                    else:
+                        match = case_obj.dict.match(buf, pos, line_end)
+                    if match is not None:
+                        return line_end, case_obj, match
+            if line_end == endpos or n_newlines >= self._scan_newlines:
+                return None, None, None
+            line_end += 1
+            n_newlines += 1
+
+
+class Switch(SIS):
+    def __init__(self, tokens, ctx):
+        """
+        :param [TOKEN, ...] token:
+        :param SparserCompilationContext ctx:
+        """
+        assert isinstance(tokens[0], OPENSWITCH)
+        assert isinstance(tokens[-1], CLOSESWITCH)
+        self.switch_name = tokens[0].content[2:-2].split(' ')[1]
+        self.encoding = ctx.encoding
+        self.line_chars = BYTES_LINE_CHARS if ctx.encoding is not None else STR_LINE_CHARS
+        tokens = tokens[1:-1]  # pop off LOOPSTART LOOPEND
+        self.cases = []
+        while tokens:
+            if isinstance(tokens[0], OPENCASE):
+                tokens, case = _make_case(tokens, ctx)
+                self.cases.append(case)
+            elif isinstance(tokens[0], TEXT):
+                token = tokens.pop(0)
+                if token.content.strip():
+                    raise SparserSyntaxError("{*switch*} tags can only contain {*case*}s")
+            else:
+                raise SparserSyntaxError("{*switch*} tags can only contain {*case*}s")
+        if not self.cases:
+            raise SparserSyntaxError("{*switch*} tags must contain at least one {*case*}")
+        self.case_index = CaseIndex.for_cases(self.cases)
+        self.max_newlines = max(case_obj.max_newlines for case_obj in self.cases)
+        self.nested = any(case_obj.nested for case_obj in self.cases)
+        for case_obj in self.cases:
+            case_obj.anchored = True
+
+    def translate(self):
+        """
+        :rtype: (str regex, str switch_name, func cb)
+        """
+        return "(?P<%s>.*?)" % self.switch_name, self.switch_name, self.cb
+
+    def cb(self, string_input):
+        """
+        :param str string_input: the string passed into the loop
+        :rtype: [{var_name: var_val, ...}, ...]
+        """
+        return self.parse_span(string_input, 0, len(string_input))
+
+    def parse_span(self, buf, start, end, loop_output=None):
+        """
+        :param str buf: the input that the switch was captured from
+        :param int start:
+        :param int end:
+        :param str loop_output:
+        :rtype: {var_name: var_val, ...}
+        """
+        line_chars = self.line_chars
+        if self.nested and buf.find(line_chars.carriage_return, start, end) != -1:
+            # the loops in the cases only match \n newlines
+            buf = line_chars.newline_re.sub(line_chars.newline, buf[start:end])
+            start, end = 0, len(buf)
+        case_obj, match = self.match_span(buf, start, end)
+        if case_obj is None:
+            err_msg = '%r unmatched for switch %r: [' % (_error_text(_error_slice(buf, start, end), self.encoding),
+                                                         self.switch_name)
+            err_msg += ', '.join("%r" % case_obj.dict.translated_patt for case_obj in self.cases)
+            err_msg += ']'
+            raise SparserValueError(err_msg)
+        return self.convert_scanned(buf, (start, end), (case_obj, match), loop_output)
+
+    def match_span(self, buf, start, end):
+        """
+        :param str buf:
+        :param int start:
+        :param int end:
+        :rtype: (Case, re.Match|SectionMatch) of the first case that matches buf[start:end] or (None, None)
+        """
+        candidates = self.cases
+        if self.case_index is not None:
+            candidates = self.case_index.candidates(buf, start, end)
+        budget = _current_budget()
+        if budget is not None and budget.stats is not None:
+            budget.stats.skip_cases(self.cases, candidates)
+        for case_obj in candidates:
+            if budget is not None:
+                match = budget.match_case(case_obj, buf, start, end, record=case_obj.nested)
+            elif case_obj.nested:
+                match = case_obj.match_record(buf, start, end)
+            else:
+                match = case_obj.dict.match(buf, start, end)
+            if match is not None:
+                return case_obj, match
+        return None, None
+
+    def convert_scanned(self, buf, span, found, loop_output=None):
+        """
+        :param str buf:
+        :param (int, int) span:
+        :param (Case, re.Match) found: from match_span
+        :param str loop_output:
+        :rtype: {var_name: var_val, ...}
+        """
+        case_obj, match = found
+        budget = _current_budget()
+        if budget is not None and budget.stats is not None:
+            return budget.stats.convert_case(case_obj, match, buf, loop_output)
+        return case_obj.convert(match, buf, loop_output)
+
+    def scanned_is_valid(self, found, buf):
+        """
+        :param (Case, re.Match) found: from match_span
+        :param str buf:
+        :rtype: bool
+        """
+        case_obj, match = found
+        return case_obj.dict.match_is_valid(match, buf)
+
+    def span_matches(self, buf, start, end):
+        """
+        Whether parse_span would succeed, leaving out the callbacks
+        :param str buf:
+        :param int start:
+        :param int end:
+        :rtype: bool
+        """
+        line_chars = self.line_chars
+        if self.nested and buf.find(line_chars.carriage_return, start, end) != -1:
+            buf = line_chars.newline_re.sub(line_chars.newline, buf[start:end])
+            start, end = 0, len(buf)
+        case_obj, match = self.match_span(buf, start, end)
+        return case_obj is not None and case_obj.dict.match_is_valid(match, buf)
+
+    def nested_ends(self, buf, start, endpos, next_regex, budget=None):
+        """
+        Where this switch can end when it is inside a record of a loop, for Case.match_record: each place
+        that the section after it matches, nearest first, where the switch parses what comes before it
+        :param str buf:
+        :param int start:
+        :param int endpos:
+        :param re.Pattern next_regex: the section after the switch
+        :param SparserBudget budget: unused since match_span takes its steps
+        :rtype: generator of (int end, (Case, re.Match), re.Match of next_regex)
+        """
+        newline = self.line_chars.newline
+        n_newlines = 0
+        line_end = buf.find(newline, start, endpos)
+        pos = start
+        while pos <= endpos:
+            section_match = next_regex.search(buf, pos, endpos)
+            if section_match is None:
+                return
+            end = section_match.start()
+            while line_end != -1 and line_end < end:
+                n_newlines += 1
+                line_end = buf.find(newline, line_end + 1, endpos)
+            if n_newlines > self.max_newlines:
+                return
+            found = self.match_span(buf, start, end)
+            if found[0] is not None and self.scanned_is_valid(found, buf):
+                yield end, found, section_match
+            pos = end + 1
+
+
+class Text(SIS):
+    def __init__(self, tokens, ctx):
+        """
+        "    " -> " +"
+        "\n\n\n" -> "\n+"
+        :param [TOKEN, ...] tokens:
+        :param SparserCompilationContext ctx:
+        """
+        assert len(tokens) == 1
+        self.text = tokens[0].content
+        self.patt = self.text
+        for rule_re, replacement in TEXT_RAW_RULES:
+            self.patt = rule_re.sub(replacement, self.patt)
+        self.patt = re.escape(self.patt)
+        for rule_re, replacement in TEXT_ESCAPED_RULES:
+            self.patt = rule_re.sub(replacement, self.patt)
+
+    def translate(self):
+        """
+        :rtype: (str regex, str var_name=None, func cb=None)
         """
         return self.patt, None, None
 
 
-class Var(SIS):
-    def __init__(self, tokens, ctx):
+class Var(SIS):
+    def __init__(self, tokens, ctx):
+        """
+        :param [TOKEN, ...] tokens:
+        :param SparserCompilationContext ctx:
+        """
+        assert len(tokens) == 1
+        elements = tokens[0].content[2:-2].split(' ')
+        if len(elements) == 2:
+            var_type, self.var_name = elements
+        elif len(elements) == 1:
+            var_type = elements[0]
+            self.var_name = None
+        else:
+            raise SparserUnexpectedError("Unexpected error: Variables should be one or two elements.")
+
+        self.bulk_cb = None
+        if var_type in ctx.type_map:
+            re_patt, self.cb = ctx.type_map[var_type]
+            if ctx.type_map[var_type] is BUILT_IN_TYPE_MAP.get(var_type):
+                self.bulk_cb = BUILT_IN_BULK_MAP[var_type]
+            elif self.cb is not None and self.var_name is not None:
+                ctx.has_custom_callbacks = True
+        elif QUOTE_HUGGED_STRING.match(var_type):
+            re_patt = var_type[1:-1]
+            _assert_no_group_syntax(re_patt)
+            re_patt = "(?:" + re_patt + ")"
+            self.cb = None
+        else:
+            supported = json.dumps(list(ctx.type_map.keys()))
+            raise SparserSyntaxError("%s not a known type (%r supported)" % (var_type, supported))
+
+        if self.cb is None:
+            self.cb = _identity
+            self.bulk_cb = list
+
+        if self.var_name is not None:
+            self.patt = "(?P<%s>%s)" % (self.var_name, re_patt)
+        else:
+            self.patt = re_patt
+
+    def translate(self):
+        """
+        :rtype: (str regex, str var_name, func cb)
+        """
+        return self.patt, self.var_name, self.cb
+
+
+_worker_loops = {}
+
+
+def _init_parallel_worker(compiled):
+    """
+    Runs once in each worker process of SparserCompiledObject.parse_parallel's pool
+    :param SparserCompiledObject compiled:
+    """
+    _worker_loops.clear()
+    for d_entry in compiled.dict.d_entries:
+        if isinstance(d_entry.container, Loop):
+            _worker_loops[d_entry.name] = d_entry.container
+
+
+def _scan_chunk(task):
+    """
+    Scan a chunk of a loop in a worker process, starting at its first line.
+    Scanning stops at the first line that no case matches, at the first callback
+    that raises or at the end of the chunk
+    :param (str loop_name, int offset, str chunk, bool is_last, bool columns) task:
+        offset is where the chunk starts in the loop's input
+    :rtype: (array record_starts, records, int stop, bool failed, SparserValueError error)
+        records is a list of dicts or a dict of columns. stop is where the scan stopped and
+        failed means that a serial scan from stop would fail there too
+    """
+    loop_name, offset, chunk, is_last, columns = task
+    loop = _worker_loops[loop_name]
+    record_starts = array('q')
+    cases, matches = [], []
+    failed = False
+    error = None
+    pos = 0
+    end = len(chunk)
+    while True:
+        record_end, case_obj, match = loop._scan(chunk, pos, end)
+        if case_obj is None:
+            # a record that runs into the next chunk can't be told apart from a bad line
+            failed = is_last or chunk.count('\n', pos, end) >= loop.max_newlines
+            stop = offset + pos
+            break
+        record_starts.append(offset + pos)
+        cases.append(case_obj)
+        matches.append(match)
+        if record_end == end:
+            stop = offset + end + 1
+            break
+        pos = record_end + 1
+
+    batches = [(cases[i:i + BATCH_SIZE], matches[i:i + BATCH_SIZE]) for i in range(0, len(cases), BATCH_SIZE)]
+    try:
+        records = loop.convert_batches(chunk, batches, columns)
+    except SparserValueError:
+        # keep the records before the first one that can't be converted
+        for idx, (case_obj, match) in enumerate(zip(cases, matches)):
+            try:
+                case_obj.dict.values(match, chunk)
+            except SparserValueError as e:
+                error = e
+                break
+        stop = record_starts[idx]
+        failed = False
+        del record_starts[idx:]
+        batches = [(cases[i:min(i + BATCH_SIZE, idx)], matches[i:min(i + BATCH_SIZE, idx)])
+                   for i in range(0, idx, BATCH_SIZE)]
+        records = loop.convert_batches(chunk, batches, columns)
+    return record_starts, records, stop, failed, error
+
+
+def _slice_columns(columns, start):
+    """
+    :param {var_name: column} columns: from Loop.build_columns
+    :param int start: the first record to keep
+    :rtype: {var_name: column}
+    """
+    ret = {}
+    for name, column in columns.items():
+        if isinstance(column, Categorical):
+            ret[name] = Categorical(column.categories, column.codes[start:])
+        else:
+            ret[name] = column[start:]
+    return ret
+
+
+def _concat_columns(parts):
+    """
+    :param [{var_name: column}, ...] parts: from Loop.build_columns for the same loop
+    :rtype: {var_name: column}
+    """
+    ret = {}
+    for name, first in parts[0].items():
+        columns = [part[name] for part in parts]
+        if isinstance(first, Categorical):
+            codes = array(first.codes.typecode)
+            for column in columns:
+                codes.extend(column.codes)
+            ret[name] = Categorical(first.categories, codes)
+            continue
+        if all(type(column) is array and column.typecode == first.typecode for column in columns):
+            merged = array(first.typecode)
+        else:
+            merged = []
+        for column in columns:
+            merged.extend(column)
+        ret[name] = merged
+    return ret
+
+
+_budgets = threading.local()
+
+
+def _current_budget():
+    """
+    :rtype: SparserBudget or None if the parse running in this thread doesn't have one
+    """
+    return getattr(_budgets, 'current', None)
+
+
+def _can_use_alarm():
+    """
+    Whether a SIGALRM timer can be used without getting in the way of anybody else's. Signal handlers can
+    only be set in the main thread
+    :rtype: bool
+    """
+    if not hasattr(signal, 'setitimer'):
+        return False
+    main_thread = getattr(threading, 'main_thread', None)  # python 3 only
+    if main_thread is not None:
+        in_main_thread = threading.current_thread() is main_thread()
+    else:
+        in_main_thread = isinstance(threading.current_thread(), threading._MainThread)
+    return (in_main_thread and signal.getsignal(signal.SIGALRM) == signal.SIG_DFL and
+            signal.getitimer(signal.ITIMER_REAL)[0] == 0)
+
+
+class SparserBudget(object):
+    """
+    Limits on how much work a single parse can do. A step is one try of the whole pattern, or of a case,
+    against part of the input. The timeout is only checked at every step, in between regex matches and
+    callbacks, so a single one that runs long can overrun it. With alarm, in the main thread a SIGALRM timer
+    also interrupts a single regex match or callback that runs past the timeout. A budget can be entered
+    again after it exits, like finditer does for each occurrence, and the time in between doesn't count
+    """
+    def __init__(self, timeout=None, max_steps=None, stats=None, alarm=False):
+        """
+        :param float timeout: seconds
+        :param int max_steps:
+        :param SparserStats stats: where to record the cases that are tried, if anywhere
+        :param bool alarm: whether to also enforce the timeout with a SIGALRM timer when that's possible
+        """
+        if timeout is not None and timeout <= 0:
+            raise SparserValueError("timeout must be more than 0")
+        if max_steps is not None and max_steps < 0:
+            raise SparserValueError("max_steps can't be negative")
+        self.timeout = timeout
+        self.max_steps = max_steps
+        self.stats = stats
+        self.alarm = alarm
+        self.steps = 0
+        self.deadline = None
+        self._remaining = timeout
+        self._previous = None
+        self._alarm = False
+
+    def __enter__(self):
+        if self.timeout is not None and self._remaining <= 0:
+            raise SparserTimeoutError("Parsing took longer than the timeout of %ss" % self.timeout)
+        self._previous = _current_budget()
+        _budgets.current = self
+        if self.timeout is not None:
+            self.deadline = time.time() + self._remaining
+            self._alarm = self.alarm and _can_use_alarm()
+            if self._alarm:
+                signal.signal(signal.SIGALRM, self._on_alarm)
+                signal.setitimer(signal.ITIMER_REAL, self._remaining)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            self._alarm = False
+        if self.deadline is not None:
+            self._remaining = self.deadline - time.time()
+        _budgets.current = self._previous
+
+    def _on_alarm(self, signum, frame):
+        raise SparserTimeoutError("Parsing took longer than the timeout of %ss" % self.timeout)
+
+    def step(self):
+        """
+        Use up a step, raising a SparserTimeoutError if that goes over the budget
+        """
+        self.steps += 1
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise SparserTimeoutError("Parsing took more than max_steps=%d steps" % self.max_steps)
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SparserTimeoutError("Parsing took longer than the timeout of %ss" % self.timeout)
+
+    def match_case(self, case_obj, buf, pos, endpos, record=False):
+        """
+        Use up a step to try a case against buf[pos:endpos]
+        :param Case case_obj:
+        :param str buf:
+        :param int pos:
+        :param int endpos:
+        :param bool record: whether to match the case with Case.match_record
+        :rtype: re.Match or None
+        """
+        self.step()
+        if self.stats is None:
+            if record:
+                return case_obj.match_record(buf, pos, endpos, self)
+            return case_obj.dict.match(buf, pos, endpos)
+        return self.stats.match_case(case_obj, buf, pos, endpos, record, self)
+
+
+class SparserStats(object):
+    """
+    What a compiled pattern has been doing since its stats were enabled. The pattern counts how many times
+    it was tried and how many of those it matched and parsed, and times its own regex apart from the
+    conversion of what it captured. Each case of a loop or switch counts how many times it was tried, how many
+    of those tries matched and how many times the prefix index skipped it without trying it, and times its regex
+    apart from its callbacks. search and finditer count as a call each, and each occurrence that they find
+    as a match that parsed, with the time spent finding and parsing it all counted as match time. Counts
+    from several threads using the same pattern at once can come up short
+    """
+    def __init__(self, dict_):
+        """
+        :param Dict dict_: the compiled pattern's
+        """
+        self.calls = 0
+        self.matched = 0
+        self.parsed = 0
+        self.match_seconds = 0.0
+        self.convert_seconds = 0.0
+        # {Case: [attempts, hits, skipped, match_seconds, convert_seconds]}
+        self.cases = OrderedDict()
+        self._case_labels = {}
+        self._add_cases(dict_)
+
+    def _add_cases(self, dict_):
+        """
+        :param Dict dict_:
+        """
+        for d_entry in dict_.d_entries:
+            container = d_entry.container
+            if container is None:
+                continue
+            for idx, case_obj in enumerate(container.cases):
+                self.cases[case_obj] = [0, 0, 0, 0.0, 0.0]
+                self._case_labels[case_obj] = (d_entry.name, idx, case_obj.var_name)
+                self._add_cases(case_obj.dict)
+
+    def match(self, dict_, string):
+        """
+        :param Dict dict_: the compiled pattern's
+        :param str string:
+        :rtype: re.Match or None
+        """
+        started = _clock()
+        match = dict_.match(string)
+        self.match_seconds += _clock() - started
+        self.calls += 1
+        if match is not None:
+            self.matched += 1
+        return match
+
+    def matches(self, dict_, string):
+        """
+        :param Dict dict_: the compiled pattern's
+        :param str string:
+        :rtype: bool
+        """
+        started = _clock()
+        ret = dict_.matches(string)
+        self.match_seconds += _clock() - started
+        self.calls += 1
+        if ret:
+            self.matched += 1
+        return ret
+
+    def next_occurrence(self, occurrences):
+        """
+        :param generator occurrences: from Dict.iter_occurrences
+        :rtype: ((int start, int end), dict) or None
+        """
+        started = _clock()
+        occurrence = next(occurrences, None)
+        self.match_seconds += _clock() - started
+        if occurrence is not None:
+            self.matched += 1
+            self.parsed += 1
+        return occurrence
+
+    def convert(self, dict_, match, string):
+        """
+        :param Dict dict_: the compiled pattern's
+        :param re.Match match:
+        :param str string:
+        :rtype: dict
+        """
+        started = _clock()
+        try:
+            ret = dict_.convert(match, string)
+        finally:
+            self.convert_seconds += _clock() - started
+        self.parsed += 1
+        return ret
+
+    def match_case(self, case_obj, buf, pos, endpos, record=False, budget=None):
+        """
+        :param Case case_obj:
+        :param str buf:
+        :param int pos:
+        :param int endpos:
+        :param bool record: see SparserBudget.match_case
+        :param SparserBudget budget: what a record's nested loops and switches are matched with
+        :rtype: re.Match or None
+        """
+        started = _clock()
+        if record:
+            match = case_obj.match_record(buf, pos, endpos, budget)
+        else:
+            match = case_obj.dict.match(buf, pos, endpos)
+        counts = self.cases[case_obj]
+        counts[3] += _clock() - started
+        counts[0] += 1
+        if match is not None:
+            counts[1] += 1
+        return match
+
+    def convert_case(self, case_obj, match, buf, loop_output=None):
+        """
+        :param Case case_obj:
+        :param re.Match match:
+        :param str buf:
+        :param str loop_output:
+        :rtype: {var_name: var_val, ...}
+        """
+        started = _clock()
+        try:
+            return case_obj.convert(match, buf, loop_output)
+        finally:
+            self.cases[case_obj][4] += _clock() - started
+
+    def skip_cases(self, cases, candidates):
+        """
+        :param [Case, ...] cases: all of a loop's or switch's cases
+        :param [Case, ...] candidates: the ones that its prefix index left to try
+        """
+        if len(candidates) == len(cases):
+            return
+        case_counts = self.cases
+        candidates = set(candidates)
+        for case_obj in cases:
+            if case_obj not in candidates:
+                case_counts[case_obj][2] += 1
+
+    def snapshot(self):
+        """
+        :rtype: dict
+        """
+        cases = []
+        for case_obj, (attempts, hits, skipped, match_seconds, convert_seconds) in self.cases.items():
+            container, idx, case_name = self._case_labels[case_obj]
+            cases.append({"container": container, "index": idx, "case": case_name, "attempts": attempts,
+                          "hits": hits, "skipped": skipped, "match_seconds": match_seconds,
+                          "convert_seconds": convert_seconds})
+        return {"calls": self.calls, "matched": self.matched, "parsed": self.parsed,
+                "match_seconds": self.match_seconds, "convert_seconds": self.convert_seconds, "cases": cases}
+
+
+class SparserCompilationContext(object):
+    def __init__(self, custom_types, loop_output='rows', encoding=None, records=False):
+        """
+        :param {type_name: (regex, cb)} custom_types:
+        :param str loop_output: "rows", "columns" or "lazy"
+        :param str encoding: compile the regexes to match bytes in this encoding instead of str
+        :param bool records: parse into Records instead of dicts
+        """
+        if loop_output not in LOOP_OUTPUT_OPTIONS:
+            raise SparserValueError("loop_output must be one of %r" % (LOOP_OUTPUT_OPTIONS,))
+        self.loop_output = loop_output
+        self.records = bool(records)
+        if encoding is not None:
+            try:
+                ascii_compatible = codecs.lookup(encoding).encode(ASCII_CHARS)[0] == ASCII_CHARS.encode('ascii')
+            except (LookupError, UnicodeError):
+                raise SparserValueError("Unknown encoding %r" % (encoding,))
+            if not ascii_compatible:
+                # the regexes are encoded along with everything else, so they'd stop meaning the same thing
+                raise SparserValueError("Encoding %r is not ASCII compatible" % (encoding,))
+        self.encoding = encoding
+        # set by the vars that have one
+        self.has_custom_callbacks = False
+        if custom_types is not None:
+            for type_name, (pattern, cb) in custom_types.items():
+                _assert_no_group_syntax(pattern)
+
+            self.type_map = dict(list(BUILT_IN_TYPE_MAP.items()))
+            self.type_map.update(custom_types)
+            for type_name, (pattern, cb) in custom_types.items():
+                if cb is not None and not callable(cb):
+                    self.type_map[type_name] = (pattern, _resolve_callback(cb))
+        else:
+            self.type_map = BUILT_IN_TYPE_MAP
+
+
+class SparserCompiledObject(object):
+    """
+    This is just for the sake of a nicer interface object
+    """
+    def __init__(self, tokens, custom_types, loop_output='rows', encoding=None, records=False):
+        """
+        :param [TOKEN, ...] tokens:
+        :param {type_name: (regex, cb)} custom_types:
+        :param str loop_output: "rows", "columns" or "lazy"
+        :param str encoding: to parse bytes-like input in this encoding instead of str
+        :param bool records: to parse into Records instead of dicts
+        """
+        ctx = SparserCompilationContext(custom_types, loop_output, encoding, records)
+        self.encoding = encoding
+        self.loop_output = loop_output
+        self.records = ctx.records
+        self.dict = Dict(tokens, ctx)
+        self.has_custom_callbacks = ctx.has_custom_callbacks
+        self._stats = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_stats'] = None
+        return state
+
+    def enable_stats(self):
+        """
+        Start recording a SparserStats for parse, match, search, finditer and parse_many, starting from zero.
+        This slows them down, so it's off until it's turned on
+        """
+        self._stats = SparserStats(self.dict)
+
+    def disable_stats(self):
+        self._stats = None
+
+    def stats(self):
+        """
+        :rtype: dict or None if stats aren't enabled. See SparserStats
+        """
+        if self._stats is None:
+            return None
+        return self._stats.snapshot()
+
+    def _input(self, string):
+        """
+        What the regexes run over. Patterns compiled with an encoding run over bytes and mmaps in place, only
+        decoding what they capture. Other bytes-like input is copied to bytes first
+        :param str|bytes|bytearray|memoryview|mmap.mmap string:
+        :rtype: str|bytes|mmap.mmap
+        """
+        if self.encoding is None:
+            if isinstance(string, (bytes, bytearray, memoryview, mmap.mmap)):
+                raise SparserValueError("Compile the pattern with an encoding to parse %s input"
+                                        % type(string).__name__)
+            return str(string)
+        if isinstance(string, (bytes, mmap.mmap)):
+            return string
+        if isinstance(string, str):
+            return string.encode(self.encoding)
+        if isinstance(string, memoryview):
+            obj = string.obj
+            if isinstance(obj, (bytes, mmap.mmap)) and string.contiguous and string.nbytes == len(obj):
+                return obj
+            return string.tobytes()
+        if isinstance(string, bytearray):
+            return bytes(string)
+        raise SparserValueError("Can't parse %s input" % type(string).__name__)
+
+    def _assert_str_only(self, method_name):
+        """
+        :param str method_name:
+        """
+        if self.encoding is not None:
+            raise SparserValueError("%s only works on patterns compiled without an encoding" % method_name)
+
+    def parse(self, string, timeout=None, max_steps=None, diagnostics='basic', alarm=False):
+        """
+        :param str string:
+        :param float timeout: seconds before giving up with a SparserTimeoutError. It's checked in between
+                              regex matches and callbacks, so a single one that runs long can overrun it
+        :param int max_steps: how many times the pattern and its cases can be tried against part of the input
+                              before giving up with a SparserTimeoutError
+        :param str diagnostics: "basic" or "full". See Dict.parse
+        :param bool alarm: to have the timeout interrupt a single regex match or callback too, by raising
+                           SparserTimeoutError from a SIGALRM handler. Only in the main thread and only if
+                           SIGALRM isn't already in use
+        :rtype: dict
+        """
+        if diagnostics not in DIAGNOSTICS_OPTIONS:
+            raise SparserValueError("diagnostics must be one of %r" % (DIAGNOSTICS_OPTIONS,))
+        if self._stats is not None:
+            return self._parse_with_stats(self._input(string), timeout, max_steps, diagnostics, alarm)
+        if timeout is None and max_steps is None:
+            return self.dict.parse(self._input(string), diagnostics=diagnostics)
+        with SparserBudget(timeout, max_steps, alarm=alarm):
+            return self.dict.parse(self._input(string), diagnostics=diagnostics)
+
+    def _parse_with_stats(self, string, timeout=None, max_steps=None, diagnostics='basic', alarm=False):
+        """
+        The same as Dict.parse, recording what it does in self._stats
+        :param str string: from _input
+        :param float timeout:
+        :param int max_steps:
+        :param str diagnostics:
+        :param bool alarm:
+        :rtype: dict
+        """
+        stats = self._stats
+        with SparserBudget(timeout, max_steps, stats, alarm) as budget:
+            budget.step()
+            match = stats.match(self.dict, string)
+            if match is None:
+                raise self.dict.unmatched_error(string, 0, len(string), diagnostics)
+            return stats.convert(self.dict, match, string)
+
+    def match(self, string, timeout=None, max_steps=None, alarm=False):
+        """
+        Whether parse would succeed. Unless the pattern has custom type callbacks, which could reject a value
+        that fits their regex, this doesn't build any errors or results
+        :param str string:
+        :param float timeout: see parse
+        :param int max_steps: see parse
+        :param bool alarm: see parse
+        :rtype: bool
+        """
+        if self.has_custom_callbacks:
+            try:
+                self.parse(string, timeout, max_steps, alarm=alarm)
+                return True
+            except SparserValueError:
+                return False
+        stats = self._stats
+        if stats is not None:
+            with SparserBudget(timeout, max_steps, stats, alarm):
+                return stats.matches(self.dict, self._input(string))
+        if timeout is None and max_steps is None:
+            return self.dict.matches(self._input(string))
+        with SparserBudget(timeout, max_steps, alarm=alarm):
+            return self.dict.matches(self._input(string))
+
+    def search(self, string, timeout=None, max_steps=None, alarm=False):
+        """
+        Find the first place in string that the pattern parses, instead of parsing all of string.
+        See Dict.iter_occurrences for where occurrences start and end
+        :param str string:
+        :param float timeout: see parse
+        :param int max_steps: see parse
+        :param bool alarm: see parse
+        :rtype: ((int start, int end), dict) or None
+        """
+        stats = self._stats
+        occurrences = self.dict.iter_occurrences(self._input(string))
+        if timeout is None and max_steps is None and stats is None:
+            return next(occurrences, None)
+        with SparserBudget(timeout, max_steps, stats, alarm):
+            if stats is None:
+                return next(occurrences, None)
+            stats.calls += 1
+            return stats.next_occurrence(occurrences)
+
+    def finditer(self, string, timeout=None, max_steps=None, alarm=False):
+        """
+        Scan string once for every non-overlapping place that the pattern parses, like re.finditer
+        :param str string:
+        :param float timeout: see parse. Only the time spent scanning counts, not the time between occurrences
+        :param int max_steps: see parse. For the whole scan
+        :param bool alarm: see parse
+        :rtype: generator of ((int start, int end), dict)
+        """
+        occurrences = self.dict.iter_occurrences(self._input(string))
+        if timeout is None and max_steps is None and self._stats is None:
+            return occurrences
+        return self._budgeted_occurrences(occurrences, SparserBudget(timeout, max_steps, self._stats, alarm))
+
+    @staticmethod
+    def _budgeted_occurrences(occurrences, budget):
+        """
+        finditer with a budget, which is only in effect while the next occurrence is being looked for
+        :param generator occurrences: from Dict.iter_occurrences
+        :param SparserBudget budget: and budget.stats to record the occurrences in, if it's set
+        :rtype: generator of ((int start, int end), dict)
+        """
+        stats = budget.stats
+        if stats is not None:
+            stats.calls += 1
+        while True:
+            with budget:
+                occurrence = next(occurrences, None) if stats is None else stats.next_occurrence(occurrences)
+            if occurrence is None:
+                return
+            yield occurrence
+
+    def parse_parallel(self, string, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Same as parse but top-level loops that are bigger than chunk_size are parsed by a pool of
+        worker processes. Each worker gets a pickled copy of this object once, when it starts.
+        The result and any error are the same as parse's
+        :param str string:
+        :param int workers: defaults to the number of CPUs
+        :param int chunk_size: roughly how many characters of a loop go to a worker at a time
+        :rtype: dict
+        """
+        self._assert_str_only("parse_parallel")
+        string = str(string)
+        dict_ = self.dict
+        match = dict_.match(string)
+        if match is None:
+            return dict_.parse(string)  # raises the same error that parse would
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        big_loop = any(isinstance(d_entry.container, Loop) and not d_entry.container.nested and
+                       match.end(idx) - match.start(idx) > chunk_size for idx, d_entry in enumerate(dict_.d_entries, 1))
+        if workers < 2 or not big_loop or self.loop_output == 'lazy':
+            return dict_.convert(match, string)
+
+        pool = multiprocessing.Pool(workers, _init_parallel_worker, (self,))
+        try:
+            return dict_.convert(match, string, parse_loop=lambda loop, buf, start, end:
+                                 loop.parse_span_parallel(pool, buf, start, end, chunk_size))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def parse_many(self, strings, on_error='raise'):
+        """
+        Parse every string in strings. This is faster than calling parse in a loop because all of
+        the per-call setup is done once and strings that don't match never raise internally
+        :param iterable strings:
+        :param str on_error: "raise" the error for the first string that doesn't parse, "skip" those
+                             strings, or "collect" their SparserValueErrors in place of results
+        :rtype: [dict|SparserValueError, ...]
+        """
+        if on_error not in ON_ERROR_OPTIONS:
+            raise SparserValueError("on_error must be one of %r" % (ON_ERROR_OPTIONS,))
+        if self._stats is not None:
+            return self._parse_many_with_stats(strings, on_error)
+        dict_ = self.dict
+        dict_match = dict_.match
+        convert = dict_.convert
+        named_cbs = [(d_entry.name, d_entry.cb) for d_entry in dict_.d_entries]
+        encoded = self.encoding is not None
+        # values captured from bytes have to be decoded, which convert does
+        use_convert = encoded or any(d_entry.container is not None for d_entry in dict_.d_entries)
+        to_input = self._input
+        raise_errors = on_error == 'raise'
+        collect_errors = on_error == 'collect'
+
+        ret = []
+        append = ret.append
+        for string in strings:
+            if encoded or type(string) is not str:
+                string = to_input(string)
+            match = dict_match(string)
+            if match is None:
+                if raise_errors:
+                    dict_.parse(string)  # raises the same error that parse would
+                if collect_errors:
+                    append(SparserValueError("%r is unmatched" % _error_text(string, self.encoding)))
+                continue
+            try:
+                if use_convert:
+                    append(convert(match, string))
+                    continue
+                result = {}
+                try:
+                    for (name, cb), sub_match in zip(named_cbs, match.groups()):
+                        result[name] = cb(sub_match)
+                except TypeError:
+                    result = convert(match, string)
+                append(result)
+            except SparserValueError as e:
+                if raise_errors:
+                    raise
+                if collect_errors:
+                    append(e)
+        return ret
+
+    def _parse_many_with_stats(self, strings, on_error):
+        """
+        parse_many a string at a time, so that each one is recorded in self._stats
+        :param iterable strings:
+        :param str on_error:
+        :rtype: [dict|SparserValueError, ...]
+        """
+        ret = []
+        for string in strings:
+            try:
+                ret.append(self._parse_with_stats(self._input(string)))
+            except SparserValueError as e:
+                if on_error == 'raise':
+                    raise
+                if on_error == 'collect':
+                    ret.append(e)
+        return ret
+
+    def iter_parse(self, lines):
+        """
+        Parse a file object or any other iterable of lines without reading all of it into memory.
+        Each top-level loop record is yielded as a (loop_name, record) pair as soon as it is
+        recognized. The rest of the fields are yielded as (var_name, var_val) pairs at the end.
+        Lines are joined with "\n" whether or not they come with their own line endings
+        :param file|iterable lines:
+        :rtype: generator of (str name, value)
+        """
+        self._assert_str_only("iter_parse")
+        if isinstance(lines, str):
+            lines = lines.splitlines(True)
+        stream = SparserStream(self)
+        for line in lines:
+            for item in stream.push_line(line):
+                yield item
+        for item in stream.close():
+            yield item
+
+    def stream(self):
+        """
+        A SparserStream to push input into as it arrives, like a log file that is being appended to.
+        stream.feed(text) returns the records that the new text settles, only parsing the new text,
+        and stream.close() returns what is left once the input is complete. See SparserStream
+        :rtype: SparserStream
+        """
+        self._assert_str_only("stream")
+        return SparserStream(self)
+
+    def parse_async(self, string, timeout=None, max_steps=None, diagnostics='basic', executor=None):
+        """
+        Same as parse but awaitable. Short inputs are parsed on the event loop and long ones in an executor
+        so the loop isn't stalled. python 3 only
+        :param str|bytes|async iterable string: or an async iterable of chunks, which are joined first
+        :param float timeout:
+        :param int max_steps:
+        :param str diagnostics:
+        :param concurrent.futures.Executor executor: None for the event loop's default executor
+        :rtype: coroutine of dict
+        """
+        from .sparser_async import parse_async
+        if diagnostics not in DIAGNOSTICS_OPTIONS:
+            raise SparserValueError("diagnostics must be one of %r" % (DIAGNOSTICS_OPTIONS,))
+        return parse_async(self, string, timeout, max_steps, diagnostics, executor)
+
+    def aiter_parse(self, lines, encoding='utf-8', executor=None):
+        """
+        Same as iter_parse but for an async iterable of lines, like an asyncio.StreamReader.
+        Use it with "async for". python 3 only
+        :param async iterable lines: of str or bytes
+        :param str encoding: what bytes lines are decoded with
+        :param concurrent.futures.Executor executor: where the input is parsed if it has to be buffered
+        :rtype: async generator of (str name, value)
+        """
+        from .sparser_async import aiter_parse
+        self._assert_str_only("aiter_parse")
+        return aiter_parse(self, lines, encoding, executor)
+
+
+class SparserStream(object):
+    """
+    Parses input that arrives a line (push_line) or a chunk (feed) at a time. If the pattern has a single
+    top-level loop without loops or switches in its cases, on lines of its own, and what comes before and
+    after that loop can only span a bounded number of lines, records are handed back as soon as no later
+    input could change them and only the unparsed remainder of the input is kept in memory. Any other
+    pattern is buffered and parsed once the input is closed. Either way, the lines are joined with \n
+    whatever they ended with, so the result doesn't depend on where the input was split into lines or chunks
+    """
+    COMPACT_SIZE = 1 << 16
+
+    def __init__(self, compiled):
         """
-        :param [TOKEN, ...] tokens:
-        :param SparserCompilationContext ctx:
+        :param SparserCompiledObject compiled:
         """
-        assert len(tokens) == 1
-        elements = tokens[0].content[2:-2].split(' ')
-        if len(elements) == 2:
-            var_type, self.var_name = elements
-        elif len(elements) == 1:
-            var_type = elements[0]
-            self.var_name = None
-        else:
-            raise SparserUnexpectedError("Unexpected error: Variables should be one or two elements.")
+        self.dict = compiled.dict
+        self.loop = None
+        self._buf = ''
+        self._lines = []  # everything that has been pushed when the pattern can't be streamed
+        self._pos = 0  # where the unparsed remainder of the loop starts in _buf
+        self._runs = deque()  # where each run of newlines in _buf starts
+        self._n_lines = 0
+        self._last_line_ended = False
+        self._partial = ''  # what feed got of a line that hasn't ended yet
+        self._head_fields = None
+        self._loop_has_content = False
 
-        if var_type in ctx.type_map:
-            re_patt, self.cb = ctx.type_map[var_type]
-        elif QUOTE_HUGGED_STRING.match(var_type):
-            re_patt = var_type[1:-1]
-            _assert_no_group_syntax(re_patt)
-            re_patt = "(?:" + re_patt + ")"
-            self.cb = None
-        else:
-            supported = json.dumps(list(ctx.type_map.keys()))
-            raise SparserSyntaxError("%s not a known type (%r supported)" % (var_type, supported))
+        members = self.dict.members
+        loop_idxs = [i for i, member in enumerate(members) if isinstance(member, Loop)]
+        # a record with a loop or switch in it can run on for any number of lines
+        if len(loop_idxs) != 1 or members[loop_idxs[0]].nested:
+            return
+        idx = loop_idxs[0]
+        # the loop has to have lines of its own. Otherwise a var on its first or last line could take text
+        # that a record was already settled with, or leave text for one
+        before = members[idx - 1] if idx else None
+        after = members[idx + 1] if idx + 1 < len(members) else None
+        if (before is not None and not (isinstance(before, Text) and before.text.endswith('\n')) or
+                after is not None and not (isinstance(after, Text) and after.text.startswith('\n'))):
+            return
+        head = Dict.from_members(members[:idx], anchored=False)
+        rest = Dict.from_members(members[idx:])
+        head_runs = _max_newline_runs(sre_parse.parse(head.translated_patt, re.DOTALL))
+        tail_runs = _max_newline_runs(sre_parse.parse(rest.translated_patt[len(members[idx].translate()[0]):],
+                                                      re.DOTALL))
+        if head_runs == UNBOUNDED or tail_runs == UNBOUNDED:
+            return
+        self.loop, self.head, self.rest = members[idx], head, rest
+        self.tail = Dict.from_members(members[idx + 1:])
+        # the head is always settled once the runs after it have started
+        self._head_window = int(head_runs)
+        # the tail can start in the last (tail_runs + 1) runs. One more because "$" can leave a newline
+        # unmatched and another because the last line that was pushed might not have ended in one
+        self._tail_window = int(tail_runs) + 3
 
-        if self.cb is None:
-            self.cb = lambda x: x
+    def push_line(self, line):
+        """
+        :param str line: with or without its line ending. Several whole lines at once are fine too
+        :rtype: [(str name, value), ...] everything that has been settled by this line
+        """
+        self._last_line_ended = line.endswith(('\n', '\r'))
+        if self._last_line_ended:
+            line = line[:-2] if line.endswith('\r\n') else line[:-1]
+        sub_lines = NEWLINE_RE.split(line) if '\r' in line or '\n' in line else (line,)
+        if self.loop is None:
+            self._lines.extend(sub_lines)
+            return []
+        n_chars = len(self._buf)
+        for sub_line in sub_lines:
+            if sub_line or not self._n_lines:
+                self._runs.append(n_chars + len(sub_line))
+            n_chars += len(sub_line) + 1
+            self._n_lines += 1
+        # one copy of the buffer however many lines there are
+        self._buf += '\n'.join(sub_lines) + '\n'
+        return self._advance()
 
-        if self.var_name is not None:
-            self.patt = "(?P<%s>%s)" % (self.var_name, re_patt)
-        else:
-            self.patt = re_patt
+    def feed(self, text):
+        """
+        Push a chunk of input that can start and end anywhere, like what has been appended to a file since
+        it was last read. The lines that it completes are parsed and the rest waits for the next chunk, so
+        each chunk costs about as much as its own length however much has been fed already
+        :param str text:
+        :rtype: [(str name, value), ...] everything that has been settled by this chunk
+        """
+        text = self._partial + text
+        # a "\r" at the very end could be the first half of a "\r\n"
+        end = len(text) - 1 if text.endswith('\r') else len(text)
+        complete = max(text.rfind('\n', 0, end), text.rfind('\r', 0, end)) + 1
+        self._partial = text[complete:]
+        if not complete:
+            return []
+        return self.push_line(text[:complete])
 
-    def translate(self):
+    def close(self):
         """
-        :rtype: (str regex, str var_name, func cb)
+        Finish parsing once there is no more input
+        :rtype: [(str name, value), ...] everything that was left
         """
-        return self.patt, self.var_name, self.cb
+        ret = []
+        if self._partial:
+            ret = self.push_line(self._partial)
+            self._partial = ''
+        return ret + self._close()
 
+    def _close(self):
+        """
+        :rtype: [(str name, value), ...]
+        """
+        if self.loop is None:
+            text = '\n'.join(self._lines) + ('\n' if self._last_line_ended else '')
+            return self._items(self.dict.parse(text, loop_output='rows'))
 
-class SparserCompilationContext(object):
-    def __init__(self, custom_types):
+        text = self._buf if self._last_line_ended else self._buf[:-1]
+        if self._head_fields is None:
+            return self._items(self.dict.parse(text, loop_output='rows'))
+        match = self.rest.match(text, self._pos)
+        if not match:
+            raise SparserValueError("%r is unmatched" % text[self._pos:])
+
+        ret = []
+        start, end = match.span(1)
+        if self._loop_has_content or NON_NEWLINE_RE.search(text, start, end):
+            ret = [(self.loop.loop_name, record) for record in self.loop.iter_records(text, start, end)]
+        fields = dict(self._head_fields)
+        fields.update(self.tail.convert(self.tail.match(text, end), text))
+        return ret + self._items(fields)
+
+    def _items(self, result):
         """
-        :param {type_name: (regex, cb)} custom_types:
+        :param dict result: a parsed result
+        :rtype: [(str name, value), ...] loop records first and then the other fields in pattern order
         """
-        if custom_types is not None:
-            for type_name, (pattern, cb) in custom_types.items():
-                _assert_no_group_syntax(pattern)
+        loops = [d_entry.name for d_entry in self.dict.d_entries if isinstance(d_entry.container, Loop)]
+        ret = [(name, record) for name in loops if name in result for record in result[name]]
+        ret.extend((d_entry.name, result[d_entry.name]) for d_entry in self.dict.d_entries
+                   if d_entry.name not in loops and d_entry.name in result)
+        return ret
 
-            self.type_map = dict(list(BUILT_IN_TYPE_MAP.items()))
-            self.type_map.update(custom_types)
-        else:
-            self.type_map = BUILT_IN_TYPE_MAP
+    def _advance(self):
+        """
+        :rtype: [(str name, value), ...] newly settled records
+        """
+        buf, runs = self._buf, self._runs
+        if self._head_fields is None:
+            if len(runs) <= self._head_window:
+                return []
+            match = self.head.match(buf, 0, runs[self._head_window])
+            if not match:
+                raise SparserValueError("%r is unmatched for string %r" % (self.head.translated_patt, buf))
+            self._head_fields = self.head.convert(match, buf)
+            self._pos = match.end()
+
+        if len(runs) < self._tail_window:
+            return []
+        safe_end = runs[-self._tail_window]
+        if safe_end < self._pos:
+            return []
+        if not self._loop_has_content:
+            # a loop with nothing but newlines in it is empty so wait until there is something
+            if not NON_NEWLINE_RE.search(buf, self._pos, safe_end):
+                return []
+            self._loop_has_content = True
 
+        cases, matches = [], []
+        pos = self._pos
+        while pos <= safe_end:
+            record_end, case_obj, match = self.loop._scan(buf, pos, safe_end)
+            if case_obj is None:
+                if buf.count('\n', pos, safe_end) > self.loop.max_newlines:
+                    raise self.loop.unmatched_error(buf[pos:])
+                break
+            cases.append(case_obj)
+            matches.append(match)
+            pos = record_end + 1
+        self._pos = pos
+        # the callbacks run a whole variable at a time, like they do for parse
+        ret = [(self.loop.loop_name, row) for row in self.loop._batch_rows(buf, cases, matches)] if cases else []
 
-class SparserCompiledObject(object):
+        if pos > self.COMPACT_SIZE and pos * 2 > len(buf):
+            self._buf = buf[pos:]
+            while runs and runs[0] < pos:
+                runs.popleft()
+            self._runs = deque(run - pos for run in runs)
+            self._pos = 0
+        return ret
+
+
+Template = namedtuple("Template", ["name", "compiled", "prefix", "required"])
+
+
+class TemplateSet(object):
     """
-    This is just for the sake of a nicer interface object
+    Named patterns that are tried in order until one of them parses the input, like a top-level switch.
+    Only the templates whose literal prefix starts the input, and whose longest piece of literal text
+    is somewhere in it, are tried
     """
-    def __init__(self, tokens, custom_types):
+    def __init__(self, patterns, custom_types=None, includes=None, loop_output='rows', records=False):
         """
-        :param [TOKEN, ...] tokens:
-        :param {type_name: (regex, cb)} custom_types:
+        :param patterns: {name: pattern, ...} or [(name, pattern), ...] in the order to try them
+        :param {type_name: (regex, cb)} custom_types: shared by all of the patterns
+        :param {include_name: include_pattern, ...} includes: shared by all of the patterns
+        :param str loop_output: "rows", "columns" or "lazy"
+        :param bool records: parse into Records instead of dicts. See compile
         """
-        ctx = SparserCompilationContext(custom_types)
-        self.dict = Dict(tokens, ctx)
+        self.templates = []
+        for name, patt in (patterns.items() if hasattr(patterns, 'items') else patterns):
+            compiled = compile(patt, custom_types, includes, loop_output, records=records)
+            translated_patt = compiled.dict.translated_patt
+            self.templates.append(Template(name, compiled, _pattern_literal_prefix(translated_patt),
+                                           _pattern_required_literal(translated_patt)))
+        if not self.templates:
+            raise SparserValueError("A TemplateSet needs at least one pattern")
+        self.names = [template.name for template in self.templates]
+        self.index = CaseIndex.for_cases(self.templates)
+        self._stats_enabled = False
+
+    def enable_stats(self):
+        """
+        See SparserCompiledObject.enable_stats. A template is only counted when it is one of the candidates
+        """
+        for template in self.templates:
+            template.compiled.enable_stats()
+        self._stats_enabled = True
+
+    def disable_stats(self):
+        for template in self.templates:
+            template.compiled.disable_stats()
+        self._stats_enabled = False
 
-    def parse(self, string):
+    def stats(self):
+        """
+        :rtype: OrderedDict {name: dict, ...} or None if stats aren't enabled. See SparserStats
+        """
+        if not self._stats_enabled:
+            return None
+        return OrderedDict((template.name, template.compiled.stats()) for template in self.templates)
+
+    def candidates(self, string):
         """
         :param str string:
-        :rtype: dict
+        :rtype: [Template, ...] the templates that could match string, in order
         """
-        return self.dict.parse(str(string))
+        templates = self.templates
+        if self.index is not None:
+            templates = self.index.candidates(string, 0, len(string))
+        return [template for template in templates if template.required in string]
 
-    def match(self, string):
+    def parse(self, string, timeout=None, max_steps=None, alarm=False):
         """
+        Raises a SparserValueError if no template parses string
         :param str string:
-        :rtype: bool
+        :param float timeout: for all of the templates together. See SparserCompiledObject.parse
+        :param int max_steps: for all of the templates together. See SparserCompiledObject.parse
+        :param bool alarm: see SparserCompiledObject.parse
+        :rtype: (str name, dict result) for the first template that parses string
+        """
+        string = str(string)
+        if timeout is None and max_steps is None and not self._stats_enabled:
+            return self._parse(string)
+        with SparserBudget(timeout, max_steps, alarm=alarm):
+            return self._parse(string)
+
+    def _parse(self, string):
+        """
+        :param str string:
+        :rtype: (str name, dict result)
+        """
+        budget = _current_budget()
+        for template in self.candidates(string):
+            if budget is not None:
+                budget.step()
+            result = self._parse_template(template, string, budget)
+            if result is not None:
+                return template.name, result
+        raise SparserValueError("%r is unmatched for templates %r" % (string, self.names))
+
+    @staticmethod
+    def _parse_template(template, string, budget):
+        """
+        :param Template template:
+        :param str string:
+        :param SparserBudget budget: the current one, if any
+        :rtype: dict or None if the template doesn't parse string
         """
+        dict_ = template.compiled.dict
+        stats = template.compiled._stats
+        if budget is not None:
+            budget.stats = stats
+        if stats is not None:
+            match = stats.match(dict_, string)
+            if match is None:
+                return None
+            try:
+                return stats.convert(dict_, match, string)
+            except SparserValueError:
+                return None
+        match = dict_.match(string)
+        if match is None:
+            return None
         try:
-            self.parse(string)
-            return True
+            return dict_.convert(match, string)
         except SparserValueError:
-            return False
+            return None
+
+    def match(self, string, timeout=None, max_steps=None, alarm=False):
+        """
+        See SparserCompiledObject.match
+        :param str string:
+        :param float timeout:
+        :param int max_steps:
+        :param bool alarm:
+        :rtype: str name of the first template that matches string or None
+        """
+        string = str(string)
+        if timeout is None and max_steps is None and not self._stats_enabled:
+            return self._match(string)
+        with SparserBudget(timeout, max_steps, alarm=alarm):
+            return self._match(string)
+
+    def _match(self, string):
+        """
+        :param str string:
+        :rtype: str or None
+        """
+        budget = _current_budget()
+        for template in self.candidates(string):
+            stats = template.compiled._stats
+            if template.compiled.has_custom_callbacks:
+                # a callback could reject a value that fits its regex
+                if budget is not None:
+                    budget.step()
+                matched = self._parse_template(template, string, budget) is not None
+            else:
+                if budget is not None:
+                    budget.stats = stats
+                if stats is not None:
+                    matched = stats.matches(template.compiled.dict, string)
+                else:
+                    matched = template.compiled.dict.matches(string)
+            if matched:
+                return template.name
+        return None
 
 
 def _assert_no_group_syntax(patt):
@@ -592,37 +3787,299 @@ def _assert_no_group_syntax(patt):
         raise SparserSyntaxError("Matching groups are not allowed in custom types. Use (?: ) style non-matching groups")
 
 
-def compile(patt, custom_types=None, includes=None):
+def _resolve_callback(name):
     """
-    Compile a sparser pattern, returning a SparserCompiledObject
+    :param str name: an importable function as "package.module:function" or "package.module.function"
+    :rtype: func
+    """
+    if ':' in name:
+        module_name, attr_path = name.split(':', 1)
+    else:
+        module_name, _, attr_path = name.rpartition('.')
+    try:
+        ret = importlib.import_module(module_name)
+        for attr in attr_path.split('.'):
+            ret = getattr(ret, attr)
+    except (ImportError, AttributeError, ValueError):
+        raise SparserSyntaxError("Could not import the custom type callback %r" % name)
+    if not callable(ret):
+        raise SparserSyntaxError("The custom type callback %r is not callable" % name)
+    return ret
+
+
+def _callback_name(cb):
+    """
+    The name that _resolve_callback would import cb from
+    :param func|str cb:
+    :rtype: str
+    """
+    if cb is None or not callable(cb):
+        return cb
+    owner = getattr(cb, '__objclass__', None)  # methods of built-in types like str.strip
+    module_name = getattr(cb, '__module__', None) or getattr(owner, '__module__', None)
+    name = "%s:%s" % (module_name, getattr(cb, '__qualname__', getattr(cb, '__name__', None)))
+    try:
+        if _resolve_callback(name) is cb:
+            return name
+    except SparserSyntaxError:
+        pass
+    raise SparserValueError("The custom type callback %r can't be found by name. Use a module-level function "
+                            "or a \"module:function\" string" % (cb,))
+
+
+def dumps(compiled):
+    """
+    Serialize a compiled pattern so that loads can bring it back without compiling it again.
+    Custom type callbacks are saved by name so they have to be module-level functions
+    :param SparserCompiledObject compiled:
+    :rtype: bytes
+    """
+    try:
+        return pickle.dumps((SERIAL_VERSION, compiled), pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise SparserValueError("Could not serialize the compiled pattern (%s). Custom type callbacks have to be "
+                                "module-level functions or \"module:function\" strings" % e)
+
+
+def loads(data):
+    """
+    :param bytes data: from dumps
+    :rtype: SparserCompiledObject
+    """
+    payload = pickle.loads(data)
+    if not isinstance(payload, tuple) or len(payload) != 2 or payload[0] != SERIAL_VERSION:
+        raise SparserValueError("Not a compiled pattern serialized by this version of sparser")
+    return payload[1]
+
+
+def _disk_cache_path(cache_dir, patt, custom_types, includes, loop_output, encoding=None, records=False):
+    """
+    Unlike _cache_key, the file name has to be the same from one process to the next
+    so callbacks are fingerprinted by name instead of by identity
+    :param str cache_dir:
+    :param str patt:
+    :param {type_name: (regex, cb)} custom_types:
+    :param {include_name: include_pattern, ...} includes:
+    :param str loop_output:
+    :param str encoding:
+    :param bool records:
+    :rtype: str
+    """
+    types_fingerprint = None
+    if custom_types is not None:
+        types_fingerprint = sorted([type_name, type_patt, _callback_name(cb)]
+                                   for type_name, (type_patt, cb) in custom_types.items())
+    includes_fingerprint = None
+    if includes is not None:
+        includes_fingerprint = sorted(includes.items())
+    fingerprint = json.dumps([SERIAL_VERSION, patt, types_fingerprint, includes_fingerprint, loop_output, encoding,
+                              bool(records)])
+    return os.path.join(cache_dir, hashlib.sha256(fingerprint.encode('utf-8')).hexdigest() + ".sparser")
+
+
+def _disk_cache_compile(cache_dir, patt, custom_types, includes, loop_output, encoding=None, records=False):
+    """
+    :param str cache_dir:
+    :param str patt:
+    :param {type_name: (regex, cb)} custom_types:
+    :param {include_name: include_pattern, ...} includes:
+    :param str loop_output:
+    :param str encoding:
+    :param bool records:
+    :rtype: SparserCompiledObject
+    """
+    path = _disk_cache_path(cache_dir, patt, custom_types, includes, loop_output, encoding, records)
+    try:
+        with open(path, 'rb') as f:
+            return loads(f.read())
+    except Exception:
+        pass  # missing, stale and corrupt files are all just compiled again
+
+    compiled = compile(patt, custom_types, includes, loop_output, encoding=encoding, records=records)
+    data = dumps(compiled)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):  # unless another process just made it
+                raise
+    # write to a temporary file first so that other processes never see half of a file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return compiled
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+
+class SparserTemplateCache(object):
+    """
+    A thread-safe LRU cache of compiled patterns. This is what keeps the module-level
+    parse and match from recompiling the same pattern on every call
+    """
+    def __init__(self, maxsize):
+        """
+        :param int maxsize: 0 disables caching
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def compile(self, patt, custom_types=None, includes=None, loop_output='rows', encoding=None, records=False):
+        """
+        Same as sparser.compile but returns the cached SparserCompiledObject when there is one
+        :param str patt:
+        :param {type_name: (regex, cb)} custom_types:
+        :param {include_name: include_pattern, ...} includes:
+        :param str loop_output:
+        :param str encoding:
+        :param bool records:
+        :rtype: SparserCompiledObject
+        """
+        key = _cache_key(patt, custom_types, includes) + (loop_output, encoding, bool(records))
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self.hits += 1
+                self._entries[key] = self._entries.pop(key)  # move to the most-recently-used end
+                return compiled
+            self.misses += 1
+
+        # compile outside of the lock so that a slow pattern doesn't hold up every other thread
+        compiled = compile(patt, custom_types, includes, loop_output, encoding=encoding, records=records)
+        with self._lock:
+            if self.maxsize > 0 and key not in self._entries:
+                self._entries[key] = compiled
+                self._evict()
+        return compiled
+
+    def resize(self, maxsize):
+        """
+        :param int maxsize:
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
 
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """
+        :rtype: CacheInfo
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._entries))
+
+    def _evict(self):
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+def _cache_key(patt, custom_types, includes):
+    """
+    custom_types and includes are dicts so they need to be fingerprinted to be part of a key.
+    Type regexes and callback names are compared by value. Callbacks are compared by identity because
+    they may not be hashable. This is safe because a cached template keeps the callbacks it uses alive
+    so their ids can't be reused while the entry exists
     :param str patt:
     :param {type_name: (regex, cb)} custom_types:
     :param {include_name: include_pattern, ...} includes:
+    :rtype: tuple
+    """
+    types_fingerprint = None
+    if custom_types is not None:
+        types_fingerprint = tuple(sorted((type_name, type_patt, id(cb) if callable(cb) else cb)
+                                         for type_name, (type_patt, cb) in custom_types.items()))
+    includes_fingerprint = None
+    if includes is not None:
+        includes_fingerprint = tuple(sorted(includes.items()))
+    return patt, types_fingerprint, includes_fingerprint
+
+
+def compile(patt, custom_types=None, includes=None, loop_output='rows', cache_dir=None, encoding=None, records=False):
+    """
+    Compile a sparser pattern, returning a SparserCompiledObject
+
+    :param str patt:
+    :param {type_name: (regex, cb)} custom_types: cb can also be the name of an importable function
+                                                  as a "package.module:function" string
+    :param {include_name: include_pattern, ...} includes:
+    :param str loop_output: "rows" to parse each loop into a list of dicts, "columns" to
+                            parse it into a dict of columns (see Loop.parse_columns) or "lazy" to
+                            parse its records as they are iterated over (see LazyLoop)
+    :param str cache_dir: if set, compiled patterns are saved to and loaded from files in this directory
+    :param str encoding: if set, the pattern parses bytes, bytearrays, memoryviews and mmaps of text in this
+                         encoding instead of str. Only the values that it captures are decoded
+    :param bool records: if set, the pattern and each of its cases parse into Records, read-only dicts backed
+                         by a tuple, instead of dicts. They take a fraction of the memory and are faster to make
     :rtype: SparserCompiledObject
     """
+    if cache_dir is not None:
+        return _disk_cache_compile(cache_dir, patt, custom_types, includes, loop_output, encoding, records)
     tokens = _root_tokenize(patt, includes_dict=includes)
-    return SparserCompiledObject(tokens, custom_types)
+    return SparserCompiledObject(tokens, custom_types, loop_output, encoding, records)
 
 
-def parse(pattern, string, custom_types=None, includes=None):
+def parse(pattern, string, custom_types=None, includes=None, loop_output='rows', timeout=None, max_steps=None,
+          diagnostics='basic', encoding=None, records=False, alarm=False):
     """
     Try to match the pattern to the string, returning
     a dictionary of values pulled from the string.
     This raises a SparserValueError on no match
+    and a SparserTimeoutError if timeout or max_steps runs out first
 
     :param str patt:
     :param str string:
     :param {type_name: (regex, cb)} custom_types:
     :param {include_name: include_pattern, ...} includes:
-    :rtype: dict
+    :param str loop_output: "rows", "columns" or "lazy"
+    :param float timeout: seconds
+    :param int max_steps: see SparserCompiledObject.parse
+    :param str diagnostics: "full" to say which part of the pattern is missing from the string when it
+                            doesn't match, which takes some more searching
+    :param str encoding: to parse bytes-like input. See compile
+    :param bool records: to parse into Records instead of dicts. See compile
+    :param bool alarm: to have the timeout interrupt a single regex match or callback too.
+                       See SparserCompiledObject.parse
+    :rtype: dict or Record
     """
-    compiled = compile(pattern, custom_types, includes)
-    ret = compiled.parse(string)
+    compiled = _cache.compile(pattern, custom_types, includes, loop_output, encoding, records)
+    ret = compiled.parse(string, timeout, max_steps, diagnostics, alarm)
     return ret
 
 
-def match(pattern, string, custom_types=None, includes=None):
+def parse_parallel(pattern, string, custom_types=None, includes=None, loop_output='rows', workers=None,
+                   records=False):
+    """
+    The same as parse but big top-level loops are parsed by a pool of worker processes.
+    See SparserCompiledObject.parse_parallel
+
+    :param str pattern:
+    :param str string:
+    :param {type_name: (regex, cb)} custom_types:
+    :param {include_name: include_pattern, ...} includes:
+    :param str loop_output: "rows", "columns" or "lazy"
+    :param int workers: defaults to the number of CPUs
+    :param bool records: to parse into Records instead of dicts. See compile
+    :rtype: dict or Record
+    """
+    compiled = _cache.compile(pattern, custom_types, includes, loop_output, records=records)
+    return compiled.parse_parallel(string, workers)
+
+
+def match(pattern, string, custom_types=None, includes=None, timeout=None, max_steps=None, encoding=None,
+          alarm=False):
     """
     Try to match the pattern to the start of the
     string, returning True or False
@@ -630,16 +4087,208 @@ def match(pattern, string, custom_types=None, includes=None):
     :param str pattern:
     :param str string:
     :param {type_name: (regex, cb)} custom_types:
+    :param float timeout: seconds
+    :param int max_steps: see SparserCompiledObject.parse
+    :param str encoding: to match bytes-like input. See compile
+    :param bool alarm: see SparserCompiledObject.parse
     :rtype: bool
     """
-    compiled = compile(pattern, custom_types, includes)
-    return compiled.match(string)
+    compiled = _cache.compile(pattern, custom_types, includes, encoding=encoding)
+    return compiled.match(string, timeout, max_steps, alarm)
+
+
+def search(pattern, string, custom_types=None, includes=None, loop_output='rows', timeout=None, max_steps=None,
+           encoding=None, records=False, alarm=False):
+    """
+    Find the first place in the string that the pattern parses,
+    returning its (start, end) span and the dictionary of values
+    pulled from it, or None
+
+    :param str pattern:
+    :param str string:
+    :param {type_name: (regex, cb)} custom_types:
+    :param {include_name: include_pattern, ...} includes:
+    :param str loop_output: "rows", "columns" or "lazy"
+    :param float timeout: seconds
+    :param int max_steps: see SparserCompiledObject.parse
+    :param str encoding: to search bytes-like input. See compile
+    :param bool records: to parse into Records instead of dicts. See compile
+    :param bool alarm: see SparserCompiledObject.parse
+    :rtype: ((int, int), dict) or None
+    """
+    compiled = _cache.compile(pattern, custom_types, includes, loop_output, encoding, records)
+    return compiled.search(string, timeout, max_steps, alarm)
+
+
+def finditer(pattern, string, custom_types=None, includes=None, loop_output='rows', timeout=None, max_steps=None,
+             encoding=None, records=False, alarm=False):
+    """
+    Yield a ((start, end), dict) pair for every
+    non-overlapping place in the string that the pattern parses
+
+    :param str pattern:
+    :param str string:
+    :param {type_name: (regex, cb)} custom_types:
+    :param {include_name: include_pattern, ...} includes:
+    :param str loop_output: "rows", "columns" or "lazy"
+    :param float timeout: seconds spent scanning, for the whole scan
+    :param int max_steps: see SparserCompiledObject.parse
+    :param str encoding: to search bytes-like input. See compile
+    :param bool records: to parse into Records instead of dicts. See compile
+    :param bool alarm: see SparserCompiledObject.parse
+    :rtype: generator of ((int, int), dict)
+    """
+    compiled = _cache.compile(pattern, custom_types, includes, loop_output, encoding, records)
+    return compiled.finditer(string, timeout, max_steps, alarm)
+
+
+def purge():
+    """
+    Clear the cache of patterns compiled by parse and match and reset its counters
+    """
+    _cache.clear()
+
+
+def set_cache_size(maxsize):
+    """
+    Set how many compiled patterns parse and match keep around. 0 turns caching off
+    :param int maxsize:
+    """
+    _cache.resize(maxsize)
+
+
+def cache_info():
+    """
+    :rtype: CacheInfo(hits, misses, evictions, maxsize, currsize)
+    """
+    return _cache.info()
+
+
+_cache = SparserTemplateCache(DEFAULT_CACHE_SIZE)
+
+
+_cli_worker = {}
+
+
+def _init_cli_worker(compiled, on_error):
+    """
+    Runs once in each worker process of the command line's --jobs pool
+    :param SparserCompiledObject compiled:
+    :param str on_error:
+    """
+    _cli_worker['compiled'] = compiled
+    _cli_worker['on_error'] = on_error
+
+
+def _cli_parse(task):
+    """
+    :param (str|int, str|None) task: see _parse_cli_input
+    :rtype: (str|int, str|None, str|None)
+    """
+    return _parse_cli_input(_cli_worker['compiled'], task, _cli_worker['on_error'])
+
+
+def _parse_cli_input(compiled, task, on_error):
+    """
+    Parse one input of the command line. The result is serialized here so that with --jobs the
+    JSON encoding happens in the workers too
+    :param SparserCompiledObject compiled:
+    :param (str|int, str|None) task: (path, None) for a file or (position, record) for a record of stdin
+    :param str on_error: as in parse_many
+    :rtype: (str|int name, str|None result as JSON, str|None error message)
+    """
+    name, record = task
+    try:
+        if record is None:
+            result = _parse_file(compiled, name)
+        else:
+            result = compiled.parse(record)
+    except (SparserValueError, EnvironmentError, UnicodeDecodeError) as e:
+        if on_error == 'raise':
+            raise
+        return name, None, str(e)
+    return name, json.dumps(result), None
+
+
+def _parse_file(compiled, path):
+    """
+    Without an encoding, the file is read as UTF-8 text. With one, it's parsed by memory-mapping it
+    instead of reading it, except that files with \r\n or \r line endings are read into memory with them
+    turned into \n, the same as reading the file in text mode would
+    :param SparserCompiledObject compiled:
+    :param str path:
+    :rtype: dict
+    """
+    if compiled.encoding is None:
+        with io.open(path, encoding='utf-8') as f:
+            return compiled.parse(f.read())
+    with open(path, 'rb') as f:
+        try:
+            string = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            string = b''
+    try:
+        if string.find(BYTES_LINE_CHARS.carriage_return) != -1:
+            mapped, string = string, BYTES_LINE_CHARS.newline_re.sub(BYTES_LINE_CHARS.newline, string)
+            mapped.close()
+        return compiled.parse(string)
+    finally:
+        if isinstance(string, mmap.mmap):
+            string.close()
+
+
+def _expand_input_files(paths):
+    """
+    :param [str, ...] paths: files, directories (for the files directly inside them) and glob patterns
+    :rtype: [str, ...]
+    """
+    ret = []
+    for path in paths:
+        if os.path.isdir(path):
+            ret.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                              if os.path.isfile(os.path.join(path, name))))
+        elif os.path.exists(path):
+            ret.append(path)
+        else:
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise SparserValueError("No such file or directory, and no files match %r" % path)
+            ret.extend(match for match in matches if os.path.isfile(match))
+    return ret
+
+
+def _split_records(stream, delimiter, chunk_size=1 << 16):
+    """
+    Read stream a chunk at a time and yield the records between the delimiters. An empty record after
+    the last delimiter is dropped, so a trailing newline doesn't make a record
+    :param file stream:
+    :param str delimiter:
+    :param int chunk_size:
+    :rtype: generator of str
+    """
+    pending = []
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        # only look for the delimiter where it can be, so that a long record isn't joined once per chunk
+        tail = pending[-1][1 - len(delimiter):] if pending and len(delimiter) > 1 else ''
+        if delimiter not in tail + chunk:
+            pending.append(chunk)
+            continue
+        records = ("".join(pending) + chunk).split(delimiter)
+        pending = [records.pop()]
+        for record in records:
+            yield record
+    if pending and pending != ['']:
+        yield "".join(pending)
 
 
-def _main(args, out=sys.stdout):
+def _main(args, out=sys.stdout, stdin=None):
     from argparse import ArgumentParser
 
-    arg_parser = ArgumentParser(description='Sparser is string parsing and regular expressions for humans')
+    arg_parser = ArgumentParser(description='Sparser is string parsing and regular expressions for humans. '
+                                            'Results are written as newline-delimited JSON, one line per input')
 
     pattern_group = arg_parser.add_mutually_exclusive_group(required=True)
     pattern_group.add_argument(
@@ -654,8 +4303,31 @@ def _main(args, out=sys.stdout):
         '--input-string', dest="input_string",
         help='The string to be matched against')
     input_group.add_argument(
-        '--input-file', dest="input_file",
-        help='The string to be matched against as a text file')
+        '--input-file', dest="input_files", nargs='+', metavar='INPUT_FILE',
+        help='Text files to be matched against, directories of them or glob patterns. '
+             'Files are read as UTF-8 unless --encoding is given')
+    input_group.add_argument(
+        '--stdin', dest="stdin", action='store_true',
+        help='Match against each record of stdin, split by --delimiter')
+
+    arg_parser.add_argument(
+        '--delimiter', dest="delimiter", default='\\n',
+        help='What separates the records of --stdin, with backslash escapes (default: \\n)')
+    arg_parser.add_argument(
+        '--encoding', dest="encoding",
+        help='Memory-map --input-file and match it as bytes in this encoding instead of reading it as text. '
+             'Only ASCII whitespace counts as whitespace then')
+    arg_parser.add_argument(
+        '--jobs', dest="jobs", type=int, default=1,
+        help='How many processes parse --input-file or --stdin inputs, or 0 for one per CPU (default: 1)')
+    arg_parser.add_argument(
+        '--on-error', dest="on_error", choices=ON_ERROR_OPTIONS, default='raise',
+        help='For an input that doesn\'t parse, "raise" its error, "skip" it, or "collect" it '
+             'as an {"error": message} line (default: raise)')
+    arg_parser.add_argument(
+        '--names', dest="names", action='store_true',
+        help='Write {"input": name, "result": result} lines, where name is the file path '
+             'or the position of the stdin record counting from 1')
 
     args = arg_parser.parse_args(args)
 
@@ -666,12 +4338,45 @@ def _main(args, out=sys.stdout):
             patt = f.read()
 
     if args.input_string is not None:
-        string = args.input_string
-    elif args.input_file is not None:
-        with open(args.input_file) as f:
-            string = f.read()
+        out.write(json.dumps(parse(patt, args.input_string)) + "\n")
+        return
 
-    out.write(json.dumps(parse(patt, string)) + "\n")
+    # the pattern is compiled once for all of the inputs, and sent once to each worker
+    if args.stdin:
+        delimiter = args.delimiter.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+        if not delimiter:
+            raise SparserValueError("--delimiter must not be empty")
+        compiled = compile(patt)
+        tasks = enumerate(_split_records(stdin or sys.stdin, delimiter), 1)
+        chunk_size = 256
+    else:
+        compiled = compile(patt, encoding=args.encoding)
+        tasks = ((path, None) for path in _expand_input_files(args.input_files))
+        chunk_size = 1
+
+    jobs = args.jobs or multiprocessing.cpu_count()
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_cli_worker, (compiled, args.on_error))
+        results = pool.imap(_cli_parse, tasks, chunk_size)
+    else:
+        results = (_parse_cli_input(compiled, task, args.on_error) for task in tasks)
+    try:
+        for name, line, error in results:
+            if error is not None:
+                if args.on_error == 'skip':
+                    continue
+                if args.names:
+                    line = '{"input": %s, "error": %s}' % (json.dumps(name), json.dumps(error))
+                else:
+                    line = '{"error": %s}' % json.dumps(error)
+            elif args.names:
+                line = '{"input": %s, "result": %s}' % (json.dumps(name), line)
+            out.write(line + "\n")
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
 
 if __name__ == "__main__":
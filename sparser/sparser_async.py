@@ -0,0 +1,84 @@
+"""
+asyncio front ends for SparserCompiledObject.parse and SparserCompiledObject.iter_parse.
+Kept apart from sparser.py because async syntax doesn't import on python 2
+"""
+
+import asyncio
+import functools
+
+from .sparser import SparserStream
+from .sparser_exceptions import SparserValueError
+
+# inputs shorter than this are parsed on the event loop. Anything longer goes to an executor
+INLINE_PARSE_SIZE = 1 << 16
+
+# how many lines aiter_parse pushes before letting other tasks run
+LINES_PER_YIELD = 256
+
+
+def _running_loop():
+    """
+    :rtype: asyncio.AbstractEventLoop
+    """
+    # asyncio.get_running_loop is new in python 3.7
+    get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+    return get_running_loop()
+
+
+async def _read_chunks(chunks):
+    """
+    :param async iterable chunks: of str or of bytes
+    :rtype: str|bytes
+    """
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+    if not parts:
+        return ''
+    return parts[0][:0].join(parts)
+
+
+async def parse_async(compiled, string, timeout=None, max_steps=None, diagnostics='basic', executor=None):
+    """
+    :param SparserCompiledObject compiled:
+    :param str|bytes|async iterable string: or an async iterable of chunks, which are joined before parsing
+    :param float timeout:
+    :param int max_steps:
+    :param str diagnostics:
+    :param concurrent.futures.Executor executor: None for the event loop's default executor
+    :rtype: dict
+    """
+    if hasattr(string, '__aiter__'):
+        string = await _read_chunks(string)
+    if len(string) < INLINE_PARSE_SIZE:
+        return compiled.parse(string, timeout=timeout, max_steps=max_steps, diagnostics=diagnostics)
+    # the budget is thread-local so timeout and max_steps still hold in the executor's thread
+    parse = functools.partial(compiled.parse, string, timeout=timeout, max_steps=max_steps, diagnostics=diagnostics)
+    return await _running_loop().run_in_executor(executor, parse)
+
+
+async def aiter_parse(compiled, lines, encoding='utf-8', executor=None):
+    """
+    :param SparserCompiledObject compiled:
+    :param async iterable lines: of str, or of bytes like an asyncio.StreamReader yields
+    :param str encoding: what bytes lines are decoded with
+    :param concurrent.futures.Executor executor: None for the event loop's default executor
+    :rtype: async generator of (str name, value)
+    """
+    stream = SparserStream(compiled)
+    n_lines = 0
+    # the next line is only read once the records before it have been consumed,
+    # so a slow consumer holds the reader back rather than filling up memory
+    async for line in lines:
+        if isinstance(line, (bytes, bytearray)):
+            line = line.decode(encoding)
+        elif not isinstance(line, str):
+            raise SparserValueError("aiter_parse expects lines of str or bytes, not %s" % type(line).__name__)
+        for item in stream.push_line(line):
+            yield item
+        n_lines += 1
+        if not n_lines % LINES_PER_YIELD:
+            await asyncio.sleep(0)
+    # a pattern that can't be streamed is parsed in one go here
+    for item in await _running_loop().run_in_executor(executor, stream.close):
+        yield item
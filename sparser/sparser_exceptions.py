@@ -12,3 +12,7 @@ class SparserValueError(SparserError, ValueError):
 
 class SparserUnexpectedError(SparserError, AssertionError):
     pass
+
+
+class SparserTimeoutError(SparserError):
+    pass
@@ -0,0 +1,63 @@
+"""
+The coroutines behind python_tests.TestSparser.test_async. Async syntax doesn't compile on python 2,
+so they can't go in python_tests.py itself
+"""
+
+import asyncio
+
+import sparser.sparser as sp
+from sparser.sparser_exceptions import SparserValueError
+
+
+async def check_async(test):
+    """
+    :param unittest.TestCase test:
+    """
+    patt = "Header {{int h}}\n{*loop rows*}{*case*}{{int a}} {{str b}}{*endcase*}{*endloop*}\nTotal {{int t}}"
+    compiled = sp.compile(patt)
+    string = "Header 5\n" + "".join("%d x\n" % i for i in range(20000)) + "Total 9"
+    expected = compiled.parse(string)
+    read = []
+
+    async def lines(as_bytes=False):
+        for line in string.splitlines(True):
+            read.append(line)
+            yield line.encode("utf-8") if as_bytes else line
+            await asyncio.sleep(0)
+
+    async def ticker(ticks):
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0)
+
+    test.assertEqual(await compiled.parse_async("Header 1\n2 y\nTotal 3"),
+                     {"h": 1, "rows": [{"a": 2, "b": "y"}], "t": 3})
+    # long inputs are parsed off the event loop, so other tasks keep running
+    ticks = []
+    task = asyncio.ensure_future(ticker(ticks))
+    test.assertEqual(await compiled.parse_async(string), expected)
+    test.assertEqual(await compiled.parse_async(lines()), expected)
+    task.cancel()
+    test.assertTrue(ticks)
+    with test.assertRaises(SparserValueError):
+        await compiled.parse_async(string + "\noops")
+
+    # lines are only read as fast as records are taken
+    del read[:]
+    items = compiled.aiter_parse(lines(as_bytes=True))
+    test.assertEqual([await items.__anext__() for _ in range(3)],
+                     [("rows", {"a": i, "b": "x"}) for i in range(3)])
+    test.assertLess(len(read), 10)
+    rows = [record async for name, record in items if name == "rows"]
+    test.assertEqual(len(rows), 20000 - 3)
+
+    # patterns that can't be streamed are parsed in the executor once the input runs out
+    patt = "{*loop a*}{*case*}{{int x}}{*endcase*}{*endloop*}\n--\n{*loop b*}{*case*}{{alpha y}}{*endcase*}{*endloop*}"
+
+    async def few():
+        for line in ["1", "2", "--", "p"]:
+            yield line
+    test.assertEqual([item async for item in sp.compile(patt).aiter_parse(few())],
+                     [("a", {"x": 1}), ("a", {"x": 2}), ("b", {"y": "p"})])
+    with test.assertRaises(SparserValueError):
+        sp.compile(patt, encoding="utf-8").aiter_parse(few())
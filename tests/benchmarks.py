@@ -0,0 +1,677 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for sparser. These are not part of the test suite.
+
+    python benchmarks.py                # run everything
+    python benchmarks.py pattern_lookups
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --compare baseline.json [--threshold 0.25]
+
+--compare exits with status 1 when a tracked number (see metric_direction) got worse than the
+saved run by more than the threshold, so a baseline saved before a change catches its regressions
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import math
+import os
+import re
+import sys
+import time
+
+if __name__ == "__main__":
+    sys.path.append('..')
+    import sparser.sparser as sp
+
+
+BENCHMARKS = []
+
+# exercises Dict, Loop, Switch, Text and every built-in type
+TEMPLATE = """\
+Report {{alphanum report_id}} for {{spalpha owner}}
+Status: {*switch status*}{*case ok*}all good{*endcase*}{*case bad*}{{spstr reason}}{*endcase*}{*endswitch*} (checked)
+{*loop rows*}
+    {*case item*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}
+    {*case note*}# {{spstr note}}{*endcase*}
+    {*case rate*}rate {{float rate}} {{alpha unit}}{*endcase*}
+{*endloop*}
+Total: {{currency total}}"""
+
+STRING = """\
+Report r42 for Ada Lovelace
+Status: all good (checked)
+3 x ab-12 @ $4.50
+# paid in full
+1 x cd-9 @ $10
+rate 0.25 pct
+Total: $23.50"""
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def count_pattern_lookups(func):
+    """
+    Call func and count how many times it went through the re module's pattern cache
+    :param func func:
+    :rtype: int
+    """
+    calls = [0]
+    re_compile = re._compile
+
+    def counting_compile(*args, **kwargs):
+        calls[0] += 1
+        return re_compile(*args, **kwargs)
+
+    re._compile = counting_compile
+    try:
+        func()
+    finally:
+        re._compile = re_compile
+    return calls[0]
+
+
+def best_of(func, repeat=5):
+    """
+    :param func func:
+    :param int repeat:
+    :rtype: float seconds
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(func):
+    """
+    :param func func:
+    :rtype: float megabytes allocated at once while func ran, as tracemalloc sees it
+    """
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1e6, 1)
+
+
+def load_test_cases():
+    """
+    The cases in tests.txt, in the same format python_tests.py reads them in
+    :rtype: [(str title, str pattern, str string, bool should_parse), ...]
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests.txt')) as f:
+        raw_tests = f.read()
+    raw_tests = '\n'.join([l for l in raw_tests.splitlines() if not l.strip().startswith('#')])
+    ret = []
+    for raw_test in raw_tests.strip().split('\n\n\n\n'):
+        title = raw_test.split('\n')[0][2:]
+        pattern = re.search("PATTERN\n(.*?)\n?STRING", raw_test, re.DOTALL).group(1)
+        string = re.search("STRING\n(.*?)\n?(OUTPUT|RAISES)", raw_test, re.DOTALL).group(1)
+        ret.append((title, pattern, string, "OUTPUT" in raw_test))
+    return ret
+
+
+@benchmark
+def pattern_lookups(n=5000):
+    """Steady-state SparserCompiledObject.parse never goes through the re module cache"""
+    compiled = sp.compile(TEMPLATE)
+
+    def parse_all():
+        for _ in range(n):
+            compiled.parse(STRING)
+
+    lookups = count_pattern_lookups(parse_all)
+    seconds = best_of(parse_all)
+    return [("parses", n),
+            ("re cache lookups", lookups),
+            ("parses/s", int(n / seconds))]
+
+
+@benchmark
+def parse_many(n=100000):
+    """SparserCompiledObject.parse_many against a plain loop over parse, with 10% bad records"""
+    compiled = sp.compile("{{int id}}: {{alpha level}} {{spstr message}}")
+    strings = ["%d: %s message number %d" % (i, "warn" if i % 3 else "error", i) for i in range(n)]
+    for i in range(0, n, 10):
+        strings[i] = "garbage %d" % i
+
+    def parse_loop():
+        ret = []
+        for string in strings:
+            try:
+                ret.append(compiled.parse(string))
+            except sp.SparserValueError:
+                pass
+        return ret
+
+    loop_seconds = best_of(parse_loop, repeat=7)
+    many_seconds = best_of(lambda: compiled.parse_many(strings, on_error='skip'), repeat=7)
+    return [("strings", n),
+            ("parse loop s", round(loop_seconds, 3)),
+            ("parse_many s", round(many_seconds, 3)),
+            ("speedup", round(loop_seconds / many_seconds, 2))]
+
+
+@benchmark
+def loop_columns(n=200000):
+    """Peak memory of a large loop parsed into rows against the same loop parsed into columns"""
+    patt = "{*loop rows*}{*case item*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}{*endloop*}"
+    string = "\n".join("%d x sku-%d @ $%d.25" % (i % 50, i, i % 1000) for i in range(n))
+    ret = [("records", n)]
+    for loop_output in ('rows', 'columns'):
+        compiled = sp.compile(patt, loop_output=loop_output)
+        ret.append(("%s peak MB" % loop_output, peak_memory(lambda: compiled.parse(string))))
+        ret.append(("%s s" % loop_output, round(best_of(lambda: compiled.parse(string), repeat=3), 3)))
+    return ret
+
+
+@benchmark
+def parse_parallel(n=300000, workers=4):
+    """SparserCompiledObject.parse_parallel against parse on one big loop"""
+    compiled = sp.compile("Header\n{*loop rows*}{*case*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}"
+                          "{*endloop*}\nTotal: {{currency total}}")
+    string = "Header\n%s\nTotal: $1" % "\n".join("%d x sku-%d @ $%d.25" % (i % 50, i, i % 1000) for i in range(n))
+    serial_seconds = best_of(lambda: compiled.parse(string), repeat=3)
+    parallel_seconds = best_of(lambda: compiled.parse_parallel(string, workers=workers), repeat=3)
+    return [("records", n),
+            ("workers", workers),
+            ("parse s", round(serial_seconds, 3)),
+            ("parse_parallel s", round(parallel_seconds, 3)),
+            ("speedup", round(serial_seconds / parallel_seconds, 2))]
+
+
+@benchmark
+def loop_conversion(n=200000):
+    """Parsing a loop of typed fields, where the callbacks run a whole batch of records at a time"""
+    patt = ("{*loop rows*}{*case item*}{{int qty}} x {{str sku}} @ {{currency price}} {{float rate}}{*endcase*}"
+            "{*case note*}# {{spstr note}}{*endcase*}{*endloop*}")
+    string = "\n".join("%d x sku-%d @ $%d.25 0.%d" % (i % 50, i, i % 1000, i) if i % 10 else "# note %d" % i
+                       for i in range(n))
+    ret = [("records", n)]
+    for loop_output in ('rows', 'columns'):
+        compiled = sp.compile(patt, loop_output=loop_output)
+        ret.append(("%s s" % loop_output, round(best_of(lambda: compiled.parse(string), repeat=3), 3)))
+    return ret
+
+
+@benchmark
+def case_dispatch(n=20000, n_cases=150):
+    """A loop and a switch with many cases that each start with their own literal text"""
+    cases = "".join("{*case c%d*}EVT%03d {{int code}} {{spstr message}}{*endcase*}" % (i, i) for i in range(n_cases))
+    loop = sp.compile("{*loop rows*}%s{*endloop*}" % cases)
+    switch = sp.compile("{*switch event*}%s{*endswitch*}" % cases)
+    lines = ["EVT%03d %d something happened" % (i % n_cases, i) for i in range(n)]
+    string = "\n".join(lines)
+    return [("cases", n_cases),
+            ("loop records/s", int(n / best_of(lambda: loop.parse(string), repeat=3))),
+            ("switch parses/s", int(n / best_of(lambda: [switch.parse(line) for line in lines], repeat=3)))]
+
+
+@benchmark
+def near_miss(n=200):
+    """Input that only fails to match at the very end, with 1 to 3 loops in a row that it could be split between"""
+    loop = "{*loop %s*}{*case*}{{int qty}} {{str sku}}{*endcase*}{*endloop*}"
+    string = "Header\n%s\nTotal: none" % "\n".join("%d sku-%d" % (i, i) for i in range(n))
+    ret = [("lines", n)]
+    for n_loops in (1, 2, 3):
+        loops = "\n".join(loop % ("rows%d" % i) for i in range(n_loops))
+        compiled = sp.compile("Header\n%s\nTotal: {{int total}}" % loops)
+
+        def parse():
+            try:
+                compiled.parse(string)
+            except sp.SparserValueError:
+                pass
+        ret.append(("%d loops s" % n_loops, round(best_of(parse, repeat=3), 4)))
+    return ret
+
+
+@benchmark
+def match_misses(n=5000):
+    """SparserCompiledObject.match on strings that don't match against catching parse's error"""
+    compiled = sp.compile(TEMPLATE)
+    strings = [STRING.replace("Total", "Sum %d" % i) for i in range(n)]
+
+    def parse_all():
+        for string in strings:
+            try:
+                compiled.parse(string)
+            except sp.SparserValueError:
+                pass
+
+    def parse_all_full():
+        for string in strings:
+            try:
+                compiled.parse(string, diagnostics='full')
+            except sp.SparserValueError:
+                pass
+    return [("strings", n),
+            ("match/s", int(n / best_of(lambda: [compiled.match(string) for string in strings], repeat=3))),
+            ("parse/s", int(n / best_of(parse_all, repeat=3))),
+            ("parse full diagnostics/s", int(n / best_of(parse_all_full, repeat=3)))]
+
+
+@benchmark
+def template_set(n=5000, n_templates=100):
+    """TemplateSet.parse against trying compiled patterns one at a time until one matches"""
+    patterns = [("t%d" % i, "LOG%03d {{int code}}: {{spstr message}}" % i) for i in range(n_templates)]
+    templates = sp.TemplateSet(patterns)
+    compiled = [(name, sp.compile(patt)) for name, patt in patterns]
+    strings = ["LOG%03d %d: something happened" % (i % n_templates, i) for i in range(n)]
+
+    def try_each(string):
+        for name, patt in compiled:
+            if patt.match(string):
+                return name, patt.parse(string)
+
+    return [("templates", n_templates),
+            ("try each parses/s", int(n / best_of(lambda: [try_each(string) for string in strings], repeat=3))),
+            ("TemplateSet parses/s", int(n / best_of(lambda: [templates.parse(string) for string in strings],
+                                                     repeat=3)))]
+
+
+@benchmark
+def finditer(n=20000):
+    """SparserCompiledObject.finditer over a log with records on some of its lines against parsing each line"""
+    compiled = sp.compile("ERROR {{int code}}: {{spstr message}}")
+    lines = ["ERROR %d: disk %d is full" % (i, i) if i % 10 == 0 else "INFO %d: all good" % i for i in range(n)]
+    string = "\n".join(lines)
+
+    def parse_lines():
+        ret = []
+        for line in string.split("\n"):
+            try:
+                ret.append(compiled.parse(line))
+            except sp.SparserValueError:
+                pass
+        return ret
+
+    return [("lines", n),
+            ("parse each line s", round(best_of(parse_lines, repeat=3), 3)),
+            ("finditer s", round(best_of(lambda: list(compiled.finditer(string)), repeat=3), 3))]
+
+
+@benchmark
+def mmap_input(n=300000):
+    """Parsing a file read into a str against parsing the same file memory-mapped, with an encoding"""
+    import mmap
+    import tempfile
+    patt = "Header\n{*loop rows*}{*case*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}{*endloop*}"
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(("Header\n" + "\n".join("%d x sku-%d @ $%d.25" % (i % 50, i, i % 1000) for i in range(n))).encode())
+    str_compiled = sp.compile(patt, loop_output='columns')
+    bytes_compiled = sp.compile(patt, loop_output='columns', encoding='utf-8')
+
+    def parse_read():
+        with open(path) as f:
+            return str_compiled.parse(f.read())
+
+    def parse_mapped():
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return bytes_compiled.parse(mapped)
+        finally:
+            mapped.close()
+
+    ret = [("file MB", round(os.path.getsize(path) / 1e6, 1))]
+    try:
+        for label, func in (("read", parse_read), ("mmap", parse_mapped)):
+            ret.append(("%s peak MB" % label, peak_memory(func)))
+            ret.append(("%s s" % label, round(best_of(func, repeat=3), 3)))
+    finally:
+        os.remove(path)
+    return ret
+
+
+@benchmark
+def lazy_loop(n=200000):
+    """The first record and a sum over one column of a big loop, parsed into rows against parsed lazily"""
+    patt = "{*loop rows*}{*case item*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}{*endloop*}"
+    string = "\n".join("%d x sku-%d @ $%d.25" % (i % 50, i, i % 1000) for i in range(n))
+    rows = sp.compile(patt)
+    lazy = sp.compile(patt, loop_output='lazy')
+    return [("records", n),
+            ("rows first record s", round(best_of(lambda: rows.parse(string)["rows"][0], repeat=3), 4)),
+            ("lazy first record s", round(best_of(lambda: next(iter(lazy.parse(string)["rows"])), repeat=3), 4)),
+            ("rows sum s", round(best_of(lambda: sum(row["qty"] for row in rows.parse(string)["rows"]), repeat=3), 3)),
+            ("lazy sum s", round(best_of(lambda: sum(row["qty"] for row in lazy.parse(string)["rows"]), repeat=3), 3))]
+
+
+@benchmark
+def tail_feed(n_updates=100, lines_per_update=200):
+    """Keeping up with a growing log by parsing all of it after each update against feeding a stream"""
+    compiled = sp.compile("Header\n{*loop rows*}{*case*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}"
+                          "{*endloop*}")
+    updates = ["".join("%d x sku-%d @ $%d.25\n" % (i % 50, i, i % 1000)
+                       for i in range(j * lines_per_update, (j + 1) * lines_per_update)) for j in range(n_updates)]
+
+    def reparse():
+        text = "Header\n"
+        for update in updates:
+            text += update
+            compiled.parse(text)
+
+    def feed():
+        stream = compiled.stream()
+        stream.feed("Header\n")
+        for update in updates:
+            stream.feed(update)
+        stream.close()
+
+    return [("updates", n_updates), ("lines", n_updates * lines_per_update),
+            ("reparse s", round(best_of(reparse, repeat=1), 3)),
+            ("feed s", round(best_of(feed, repeat=3), 3))]
+
+
+@benchmark
+def stats_overhead(n=5000):
+    """SparserCompiledObject.parse with stats off against with stats on"""
+    compiled = sp.compile(TEMPLATE)
+
+    def parse_all():
+        for _ in range(n):
+            compiled.parse(STRING)
+
+    off_seconds = best_of(parse_all)
+    compiled.enable_stats()
+    on_seconds = best_of(parse_all)
+    compiled.disable_stats()
+    return [("parses", n),
+            ("stats off parses/s", int(n / off_seconds)),
+            ("stats on parses/s", int(n / on_seconds))]
+
+
+@benchmark
+def records(n=200000):
+    """A big loop parsed into dicts against parsed into Records"""
+    patt = "{*loop rows*}{*case item*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}{*endloop*}"
+    string = "\n".join("%d x sku-%d @ $%d.25" % (i % 50, i, i % 1000) for i in range(n))
+    ret = [("records", n)]
+    for label, as_records in (("dicts", False), ("records", True)):
+        compiled = sp.compile(patt, records=as_records)
+        ret.append(("%s peak MB" % label, peak_memory(lambda: compiled.parse(string))))
+        ret.append(("%s s" % label, round(best_of(lambda: compiled.parse(string), repeat=3), 3)))
+    return ret
+
+
+@benchmark
+def nested_loops(n=2000, n_items=20):
+    """A loop of sections that each have a loop of items, parsed in one pass against splitting the input
+    into sections and parsing each one on its own"""
+    items = "{*loop items*}{*case*}  - {{str sku}}: {{int qty}}{*endcase*}{*endloop*}"
+    nested = sp.compile("{*loop sections*}{*case*}Section {{int section}}\n%s{*endcase*}{*endloop*}" % items)
+    section = sp.compile("Section {{int section}}\n%s" % items)
+    string = "\n".join("Section %d\n%s" % (i, "\n".join("  - sku-%d: %d" % (j, j) for j in range(n_items)))
+                       for i in range(n))
+
+    def two_pass():
+        return [section.parse(chunk) for chunk in re.split("\n(?=Section )", string)]
+    assert nested.parse(string)["sections"] == two_pass()
+    return [("sections", n), ("items", n * n_items),
+            ("nested s", round(best_of(lambda: nested.parse(string), repeat=3), 3)),
+            ("two-pass s", round(best_of(two_pass, repeat=3), 3))]
+
+
+@benchmark
+def tests_txt(passes=200):
+    """Compiling and parsing every case in tests.txt, the ones that should parse and the ones that shouldn't"""
+    cases = []
+    for title, pattern, string, should_parse in load_test_cases():
+        try:
+            sp.compile(pattern)
+        except sp.SparserSyntaxError:
+            continue
+        cases.append((pattern, string, should_parse))
+    compiled = [(sp.compile(pattern), string, should_parse) for pattern, string, should_parse in cases]
+    good = [(patt, string) for patt, string, should_parse in compiled if should_parse]
+    bad = [(patt, string) for patt, string, should_parse in compiled if not should_parse]
+
+    def compile_all():
+        for _ in range(passes // 10):
+            for pattern, _string, _should_parse in cases:
+                sp.compile(pattern)
+
+    def parse_good():
+        for _ in range(passes):
+            for patt, string in good:
+                patt.parse(string)
+
+    def parse_bad():
+        for _ in range(passes):
+            for patt, string in bad:
+                try:
+                    patt.parse(string)
+                except sp.SparserValueError:
+                    pass
+
+    return [("cases", len(cases)),
+            ("compiles/s", int(len(cases) * (passes // 10) / best_of(compile_all, repeat=3))),
+            ("compile peak MB", peak_memory(compile_all)),
+            ("parses/s", int(len(good) * passes / best_of(parse_good, repeat=3))),
+            ("failed parses/s", int(len(bad) * passes / best_of(parse_bad, repeat=3)))]
+
+
+def growth_exponent(sizes, seconds):
+    """
+    How the time grows with the size of the input, between the smallest and the largest input.
+    1 is linear, 2 is quadratic
+    :param [int] sizes:
+    :param [float] seconds:
+    :rtype: float
+    """
+    if seconds[0] <= 0 or seconds[-1] <= 0:
+        return None
+    return round(math.log(seconds[-1] / seconds[0]) / math.log(float(sizes[-1]) / sizes[0]), 2)
+
+
+@benchmark
+def loop_scaling(max_rows=10 ** 6):
+    """Parse time, throughput and peak memory of one loop from a thousand records up to max_rows"""
+    compiled = sp.compile("Header\n{*loop rows*}{*case item*}{{int qty}} x {{str sku}} @ {{currency price}}"
+                          "{*endcase*}{*case note*}# {{spstr note}}{*endcase*}{*endloop*}\nTotal: {{currency total}}")
+    ret = []
+    sizes, seconds = [], []
+    n = 1000
+    while n <= max_rows:
+        string = "Header\n%s\nTotal: $1" % "\n".join("%d x sku-%d @ $%d.25" % (i % 50, i, i % 1000) if i % 10
+                                                        else "# note %d" % i for i in range(n))
+        elapsed = best_of(lambda: compiled.parse(string), repeat=3 if n < 10 ** 5 else 1)
+        sizes.append(n)
+        seconds.append(elapsed)
+        label = "10^%d" % round(math.log10(n))
+        ret.append(("%s records s" % label, round(elapsed, 3)))
+        ret.append(("%s records/s" % label, int(n / elapsed)))
+        ret.append(("%s peak MB" % label, peak_memory(lambda: compiled.parse(string))))
+        n *= 10
+    ret.append(("growth exponent", growth_exponent(sizes, seconds)))
+    return ret
+
+
+@benchmark
+def switch_scaling(n=20000, case_counts=(10, 100, 1000)):
+    """Compiling and parsing a switch and a loop as the number of cases they choose between grows"""
+    ret = []
+    for n_cases in case_counts:
+        cases = "".join("{*case c%d*}EVT%04d {{int code}} {{spstr message}}{*endcase*}" % (i, i)
+                        for i in range(n_cases))
+        lines = ["EVT%04d %d something happened" % (i % n_cases, i) for i in range(n)]
+        string = "\n".join(lines)
+        compile_seconds = best_of(lambda: sp.compile("{*switch event*}%s{*endswitch*}" % cases), repeat=3)
+        switch = sp.compile("{*switch event*}%s{*endswitch*}" % cases)
+        loop = sp.compile("{*loop rows*}%s{*endloop*}" % cases)
+        ret.append(("%d cases compile s" % n_cases, round(compile_seconds, 3)))
+        ret.append(("%d cases switch parses/s" % n_cases,
+                    int(n / best_of(lambda: [switch.parse(line) for line in lines], repeat=3))))
+        ret.append(("%d cases loop records/s" % n_cases, int(n / best_of(lambda: loop.parse(string), repeat=3))))
+    return ret
+
+
+@benchmark
+def deep_includes(depths=(1, 10, 100)):
+    """Compiling and parsing a pattern that is a chain of includes, each including the next"""
+    ret = []
+    for depth in depths:
+        includes = dict(("level%d" % i, "L%d {{int v%d}}\n{*include level%d*}" % (i, i, i + 1)) for i in range(depth))
+        includes["level%d" % depth] = "End {{str end}}"
+        string = "".join("L%d %d\n" % (i, i) for i in range(depth)) + "End here"
+        compiled = sp.compile("{*include level0*}", includes=includes)
+        assert len(compiled.parse(string)) == depth + 1
+        ret.append(("depth %d compile s" % depth,
+                    round(best_of(lambda: sp.compile("{*include level0*}", includes=includes), repeat=3), 4)))
+        ret.append(("depth %d parses/s" % depth,
+                    int(1000 / best_of(lambda: [compiled.parse(string) for _ in range(1000)], repeat=3))))
+    return ret
+
+
+@benchmark
+def near_miss_scaling(sizes=(1000, 10000, 100000)):
+    """Input that only fails to match on its last line as it grows, split between 1 to 3 loops"""
+    loop = "{*loop %s*}{*case*}{{int qty}} {{str sku}}{*endcase*}{*endloop*}"
+    ret = []
+    for n_loops in (1, 2, 3):
+        loops = "\n".join(loop % ("rows%d" % i) for i in range(n_loops))
+        compiled = sp.compile("Header\n%s\nTotal: {{int total}}" % loops)
+        seconds = []
+        for n in sizes:
+            string = "Header\n%s\nTotal: none" % "\n".join("%d sku-%d" % (i, i) for i in range(n))
+
+            def parse():
+                try:
+                    compiled.parse(string)
+                except sp.SparserValueError:
+                    pass
+            seconds.append(best_of(parse, repeat=3))
+            ret.append(("%d loops %d lines s" % (n_loops, n), round(seconds[-1], 4)))
+        ret.append(("%d loops growth exponent" % n_loops, growth_exponent(sizes, seconds)))
+    return ret
+
+
+@benchmark
+def cli_many_files(n=2000, n_spawned=50):
+    """The command line over a directory of small files against starting one interpreter per file"""
+    import io
+    import shutil
+    import subprocess
+    import tempfile
+    directory = tempfile.mkdtemp()
+    for i in range(n):
+        with open(os.path.join(directory, "%05d.txt" % i), "w") as f:
+            f.write(STRING)
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(sp.__file__)))
+
+    def spawn_each():
+        for path in paths[:n_spawned]:
+            subprocess.check_output([sys.executable, "-c", "import sys; from sparser.sparser import _main; "
+                                     "_main(sys.argv[1:])", "--pattern-string", TEMPLATE, "--input-file", path],
+                                    cwd=package_dir)
+
+    def run_once(jobs):
+        sp._main(["--pattern-string", TEMPLATE, "--input-file", directory, "--jobs", str(jobs)], io.StringIO())
+
+    try:
+        return [("files", n),
+                ("one process each ms/file", round(1000 * best_of(spawn_each, repeat=1) / n_spawned, 2)),
+                ("one run ms/file", round(1000 * best_of(lambda: run_once(1), repeat=3) / n, 3)),
+                ("one run, 2 jobs ms/file", round(1000 * best_of(lambda: run_once(2), repeat=3) / n, 3))]
+    finally:
+        shutil.rmtree(directory)
+
+
+def metric_direction(label):
+    """
+    Which numbers --compare tracks, going by their units. Counts, ratios and growth exponents aren't tracked
+    :param str label:
+    :rtype: int 1 if bigger is better, -1 if smaller is better or 0 if it isn't tracked
+    """
+    if label.endswith("/s"):
+        return 1
+    if label.endswith((" s", " ms/file", " MB")):
+        return -1
+    return 0
+
+
+def find_regressions(baseline, results, threshold):
+    """
+    :param {str benchmark: {str label: value}} baseline:
+    :param {str benchmark: {str label: value}} results:
+    :param float threshold: how much worse than the baseline a number can get, e.g. 0.25 for 25%
+    :rtype: [(str benchmark, str label, old value, new value), ...]
+    """
+    ret = []
+    for name, values in results.items():
+        for label, new in values.items():
+            old = baseline.get(name, {}).get(label)
+            direction = metric_direction(label)
+            if not direction or not old or new is None:
+                continue
+            # timings this short are mostly noise
+            if label.endswith(" s") and old < MIN_TRACKED_SECONDS:
+                continue
+            if (direction > 0 and new * (1 + threshold) < old) or (direction < 0 and new > old * (1 + threshold)):
+                ret.append((name, label, old, new))
+    return ret
+
+
+MIN_TRACKED_SECONDS = 0.01
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Run sparser's benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run. All of them by default")
+    parser.add_argument("--save", metavar="PATH", help="write the results to a json file")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="a json file from --save. Exits with status 1 if a tracked number regressed")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="how much worse a tracked number can get before it counts as a regression")
+    args = parser.parse_args(args)
+
+    unknown = set(args.names) - set(func.__name__ for func in BENCHMARKS)
+    if unknown:
+        parser.error("no benchmark named %s" % ", ".join(sorted(unknown)))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for func in BENCHMARKS:
+        if args.names and func.__name__ not in args.names:
+            continue
+        print("%s: %s" % (func.__name__, func.__doc__))
+        results[func.__name__] = values = {}
+        for label, value in func():
+            values[label] = value
+            old = baseline.get(func.__name__, {}).get(label) if baseline else None
+            print("    %-32s %s" % (label, value) + ("   (was %s)" % old if old is not None else ""))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline is None:
+        return 0
+    regressions = find_regressions(baseline, results, args.threshold)
+    for name, label, old, new in regressions:
+        print("REGRESSION %s: %s went from %s to %s" % (name, label, old, new))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -4,8 +4,17 @@ from __future__ import print_function
 from builtins import zip
 from builtins import str
 
+import binascii
 import json
+import mmap
+import os
+import pickle
 import re
+import shutil
+import signal
+import tempfile
+import threading
+import time
 import unittest
 import sys
 import difflib
@@ -18,7 +27,7 @@ else:
 if __name__ == "__main__":
     sys.path.append('..')
     import sparser.sparser as sp
-    from sparser.sparser_exceptions import SparserValueError, SparserSyntaxError, SparserError
+    from sparser.sparser_exceptions import SparserValueError, SparserSyntaxError, SparserTimeoutError, SparserError
 
 
 exception_map = {
@@ -171,6 +180,786 @@ class TestSparser(unittest.TestCase):
         self.assertTrue(sp.match(patt, good_string))
         self.assertFalse(sp.match(patt, bad_string))
 
+    def test_loop_newline_types(self):
+        patt = "{*loop rows*}{*case*}{{int a}}-{{int b}}{*endcase*}" \
+               "{*case two*}{{alpha x}};\n;{{alpha y}}{*endcase*}{*endloop*}"
+        compiled = sp.compile(patt)
+        expected = {"rows": [{"a": 1, "b": 2}, {"case": "two", "x": "ab", "y": "cd"}, {"a": 3, "b": 4}]}
+        for newline in ("\n", "\r\n", "\r"):
+            self.assertEqual(compiled.parse(newline.join(["1-2", "ab;", ";cd", "3-4"])), expected)
+
+    def test_loop_line_spans(self):
+        patt = "{*loop rows*}{*case*}{{int a}}{*endcase*}{*case*}{{alpha x}} {{alpha y}}{*endcase*}{*endloop*}"
+        loop = sp.compile(patt).dict.d_entries[0].container
+        self.assertEqual([(c.min_newlines, c.max_newlines) for c in loop.cases], [(0, 1), (0, 1)])
+        self.assertEqual(loop.max_newlines, 1)
+
+        # records are consumed in one pass so long loops stay fast
+        string = '\n'.join("%d" % i for i in range(100000))
+        self.assertEqual(len(sp.parse(patt, string)["rows"]), 100000)
+
+        # newlines in the case text and spstr can both run over any number of lines
+        for case in ("{{alpha x}};\nend", "{{spstr x}}"):
+            loop = sp.compile("{*loop rows*}{*case*}%s{*endcase*}{*endloop*}" % case).dict.d_entries[0].container
+            self.assertEqual(loop.max_newlines, sp.UNBOUNDED)
+
+    def test_no_pattern_lookups(self):
+        # everything is compiled up front so parsing never goes through the re module cache
+        patt = "{{str a}}: {*switch s*}{*case*}{{int b}}{*endcase*}{*endswitch*}!\n" \
+               "{*loop rows*}{*case*}{{float c}} {{spstr d}}{*endcase*}{*endloop*}"
+        compiled = sp.compile(patt)
+        lookups = []
+        re_compile = re._compile
+        re._compile = lambda *args: lookups.append(args) or re_compile(*args)
+        try:
+            ret = compiled.parse("x: 5!\n1.5 a b\n2 c")
+        finally:
+            re._compile = re_compile
+        self.assertEqual(ret, {"a": "x", "s": {"b": 5}, "rows": [{"c": 1.5, "d": "a b"}, {"c": 2.0, "d": "c"}]})
+        self.assertEqual(lookups, [])
+
+    def test_template_cache(self):
+        sp.purge()
+        sp.set_cache_size(2)
+        try:
+            self.assertEqual(sp.parse("a {{int b}}", "a 1"), {"b": 1})
+            self.assertEqual(sp.parse("a {{int b}}", "a 2"), {"b": 2})
+            self.assertTrue(sp.match("a {{int b}}", "a 3"))
+            self.assertEqual(sp.cache_info(), (2, 1, 0, 2, 1))
+
+            # custom_types are fingerprinted by regex and by callback identity
+            upper_types = {"animal": ("cat|dog", str.upper)}
+            lower_types = {"animal": ("cat|dog", str.lower)}
+            self.assertEqual(sp.parse("{{animal a}}", "cat", custom_types=upper_types), {"a": "CAT"})
+            self.assertEqual(sp.parse("{{animal a}}", "cat", custom_types=lower_types), {"a": "cat"})
+            self.assertEqual(sp.parse("{{animal a}}", "cat", custom_types=dict(upper_types)), {"a": "CAT"})
+            self.assertEqual(sp.cache_info(), (3, 3, 1, 2, 2))
+
+            sp.set_cache_size(0)
+            sp.parse("a {{int b}}", "a 1")
+            self.assertEqual(sp.cache_info().currsize, 0)
+
+            sp.purge()
+            self.assertEqual(sp.cache_info(), (0, 0, 0, 0, 0))
+        finally:
+            sp.set_cache_size(sp.DEFAULT_CACHE_SIZE)
+            sp.purge()
+
+    def test_iter_parse(self):
+        patt = "Header {{int h}}\n" \
+               "{*loop rows*}{*case*}{{int a}} {{str b}}{*endcase*}{*case blank*}{*endcase*}{*endloop*}\n" \
+               "Total {{int t}}"
+        string = "Header 5\n1 a\n2 b\n\n3 c\nTotal 9\n"
+        compiled = sp.compile(patt)
+        expected = [("rows", {"a": 1, "b": "a"}), ("rows", {"a": 2, "b": "b"}), ("rows", {"case": "blank"}),
+                    ("rows", {"a": 3, "b": "c"}), ("h", 5), ("t", 9)]
+        self.assertEqual(list(compiled.iter_parse(StringIO(string))), expected)
+        self.assertEqual(list(compiled.iter_parse(string.splitlines())), expected)
+
+        # records come out before the input is exhausted
+        def lines():
+            yield "Header 5"
+            for i in range(1000):
+                yield "%d x" % i
+            raise AssertionError("read too far")
+        items = compiled.iter_parse(lines())
+        self.assertEqual([next(items) for _ in range(3)], [("rows", {"a": i, "b": "x"}) for i in range(3)])
+
+        # patterns that can't be streamed are still parsed, just not until the end
+        patt = "{*loop a*}{*case*}{{int x}}{*endcase*}{*endloop*}\n--\n" \
+               "{*loop b*}{*case*}{{alpha y}}{*endcase*}{*endloop*}"
+        self.assertEqual(list(sp.compile(patt).iter_parse(["1", "2", "--", "p"])),
+                         [("a", {"x": 1}), ("a", {"x": 2}), ("b", {"y": "p"})])
+
+        # nor are loops that share a line with the rest of the pattern
+        patt = "k:{{str t1}}{*loop n2*}{*case c1*}k:{{alphanum v0}}{*endcase*}{*endloop*}x"
+        self.assertEqual(list(sp.compile(patt).iter_parse(["k:x1x"])), [("t1", "x1")])
+
+        with self.assertRaises(SparserValueError):
+            list(compiled.iter_parse(["Header 5", "1 a", "oops oops oops", "2 b", "3 c", "4 d", "Total 9"]))
+
+    def test_stream_feed(self):
+        patt = "Header {{int h}}\n" \
+               "{*loop rows*}{*case*}{{int a}} {{str b}}{*endcase*}{*case blank*}{*endcase*}{*endloop*}\n" \
+               "Total {{int t}}"
+        compiled = sp.compile(patt)
+        string = "Header 5\r\n" + "".join("%d x\r\n" % i if i % 7 else "\r\n" for i in range(300)) + "Total 9"
+        expected = list(compiled.iter_parse(string))
+        # chunks can split lines anywhere, even between the \r and \n of a line ending
+        for chunk_size in (1, 2, 7, 100):
+            stream = compiled.stream()
+            items = []
+            for i in range(0, len(string), chunk_size):
+                items.extend(stream.feed(string[i:i + chunk_size]))
+            self.assertEqual(items + stream.close(), expected)
+
+        # a file that is being appended to gets its new records on each read
+        stream = compiled.stream()
+        self.assertEqual(stream.feed("Header 5\n1 a\n2 "), [])
+        self.assertEqual(stream.feed("b\n3 c\n4 d\n5 e\n"),
+                         [("rows", {"a": 1, "b": "a"}), ("rows", {"a": 2, "b": "b"})])
+        self.assertEqual(stream.feed("Total 9\n"), [("rows", {"a": 3, "b": "c"})])
+        self.assertEqual(stream.close(),
+                         [("rows", {"a": 4, "b": "d"}), ("rows", {"a": 5, "b": "e"}), ("h", 5), ("t", 9)])
+
+        # only the part that hasn't been settled is kept around
+        stream = compiled.stream()
+        stream.feed("Header 5\n")
+        for _ in range(100):
+            stream.feed("".join("%d x\n" % i for i in range(1000)))
+        self.assertLess(len(stream._buf), 2 * sp.SparserStream.COMPACT_SIZE)
+
+        # patterns that are buffered until close get the same lines however the input was chunked
+        buffered = sp.compile("{*loop a*}{*case*}{{int x}}{*endcase*}{*endloop*}\n--\n{{spstr tail}}")
+        string = "1\n2\n--\nfoo\r\nbar\r\nbaz"
+        results = []
+        for size in (1, 2, 3, 100):
+            stream = buffered.stream()
+            items = []
+            for idx in range(0, len(string), size):
+                items.extend(stream.feed(string[idx:idx + size]))
+            results.append(items + stream.close())
+        self.assertEqual(results[0], [("a", {"x": 1}), ("a", {"x": 2}), ("tail", "foo\nbar\nbaz")])
+        self.assertEqual(results, [results[0]] * 4)
+
+        # a loop that shares a line with a greedy var is buffered too, so the var can't take its text
+        stream = sp.compile("k:{{str t1}}{*loop n2*}{*case c1*}k:{{alphanum v0}}{*endcase*}{*endloop*}x").stream()
+        self.assertEqual(stream.feed("k:x1x") + stream.close(), [("t1", "x1")])
+
+        with self.assertRaises(SparserValueError):
+            sp.compile(patt, encoding="utf-8").stream()
+
+    def test_parse_many(self):
+        compiled = sp.compile("{{int id}}: {{spstr message}}")
+        strings = ["1: hello", "nope", "2: world"]
+        self.assertEqual(compiled.parse_many(strings, on_error="skip"),
+                         [{"id": 1, "message": "hello"}, {"id": 2, "message": "world"}])
+        collected = compiled.parse_many(strings, on_error="collect")
+        self.assertEqual(collected[::2], [{"id": 1, "message": "hello"}, {"id": 2, "message": "world"}])
+        self.assertIsInstance(collected[1], SparserValueError)
+        with self.assertRaises(SparserValueError):
+            compiled.parse_many(strings)
+        with self.assertRaises(SparserValueError):
+            compiled.parse_many(strings, on_error="ignore")
+
+        # errors from callbacks are handled the same way
+        compiled = sp.compile("{*loop rows*}{*case*}{{float f}}{*endcase*}{*endloop*}")
+        collected = compiled.parse_many(["1.5\n2", "1.2.3"], on_error="collect")
+        self.assertEqual(collected[0], {"rows": [{"f": 1.5}, {"f": 2.0}]})
+        self.assertIsInstance(collected[1], SparserValueError)
+
+    def test_loop_columns(self):
+        patt = ("{*loop rows*}{*case item*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}"
+                "{*case note*}# {{spstr note}}{*endcase*}{*endloop*}\nTotal: {{int total}}")
+        string = "3 x ab @ $4.50\n# paid\n1 x cd @ $10\nTotal: 4"
+        ret = sp.parse(patt, string, loop_output="columns")
+        self.assertEqual(ret["total"], 4)
+        rows = ret["rows"]
+        self.assertEqual(sorted(rows.keys()), ["case", "note", "price", "qty", "sku"])
+        self.assertEqual(rows["qty"], [3, None, 1])
+        self.assertEqual(rows["sku"], ["ab", None, "cd"])
+        self.assertEqual(rows["note"], [None, "paid", None])
+        self.assertEqual(rows["price"].typecode, "d")
+        self.assertEqual(rows["price"][0], 4.5)
+        self.assertNotEqual(rows["price"][1], rows["price"][1])  # NaN
+        self.assertEqual(rows["case"], ["item", "note", "item"])
+        self.assertEqual(list(rows["case"].codes), [0, 1, 0])
+        self.assertEqual(rows["case"].categories, ["item", "note"])
+
+        # the rows output is untouched and the two are cached separately
+        self.assertEqual(sp.parse(patt, string)["rows"][1], {"case": "note", "note": "paid"})
+
+        compiled = sp.compile("{*loop rows*}{*case*}{{int a}} {{float b}}{*endcase*}{*endloop*}",
+                              loop_output="columns")
+        rows = compiled.parse("1 2.5\n3 4")["rows"]
+        self.assertEqual(rows["a"].typecode, "q")
+        self.assertEqual(list(rows["a"]), [1, 3])
+        self.assertEqual(list(rows["b"]), [2.5, 4.0])
+        self.assertNotIn("case", rows)
+        self.assertEqual(len(compiled.parse("\n")["rows"]["a"]), 0)
+        with self.assertRaises(SparserValueError):
+            compiled.parse("1 2.5\nx")
+        with self.assertRaises(SparserValueError):
+            sp.compile("{{int a}}", loop_output="cols")
+
+    def test_parse_parallel(self):
+        patt = ("Report\n{*loop rows*}{*case*}{{int a}} {{str b}}{*endcase*}"
+                "{*case pair*}{{str a}}\n{{str b}}{*endcase*}{*endloop*}\nTotal: {{int total}}")
+        string = "Report\n" + "\n".join("%d s%d\nfoo\nbar" % (i, i) for i in range(40)) + "\nTotal: 40"
+        for loop_output in ("rows", "columns"):
+            compiled = sp.compile(patt, loop_output=loop_output)
+            # chunks this small split records across chunks so they have to be stitched back together
+            for chunk_size in (1, 7, 50):
+                self.assertEqual(repr(compiled.parse_parallel(string, workers=2, chunk_size=chunk_size)),
+                                 repr(compiled.parse(string)))
+
+        compiled = sp.compile(patt)
+        bad_string = string.replace("17 s17", "17 s17 x")
+        with self.assertRaises(SparserValueError) as serial_error:
+            compiled.parse(bad_string)
+        with self.assertRaises(SparserValueError) as parallel_error:
+            compiled.parse_parallel(bad_string, workers=2, chunk_size=10)
+        self.assertEqual(str(parallel_error.exception), str(serial_error.exception))
+        self.assertEqual(sp.parse_parallel(patt, string, workers=1), compiled.parse(string))
+
+    def test_loop_bulk_conversion(self):
+        patt = ("{*loop rows*}{*case item*}{{int qty}} x {{str sku}} @ {{currency price}}{*endcase*}"
+                "{*case note*}# {{spstr note}}{*endcase*}{*endloop*}")
+        lines = ["%d x sku-%d @ $%d,0%d.5" % (i, i, i, i % 10) if i % 7 else "# note  %d " % i
+                 for i in range(sp.BATCH_SIZE * 2 + 5)]
+        string = "\n".join(lines)
+        loop = sp.compile(patt).dict.d_entries[0].container
+        self.assertEqual(sp.parse(patt, string)["rows"], list(loop.iter_records(string, 0, len(string))))
+
+        # the first bad value is reported even when a later line doesn't match
+        lines[sp.BATCH_SIZE + 3] = "1 x sku @ $1.2.3"
+        lines[sp.BATCH_SIZE + 9] = "unmatched"
+        with self.assertRaises(SparserValueError) as context:
+            sp.parse(patt, "\n".join(lines))
+        self.assertEqual(str(context.exception), 'Could not perform sparser float on "$1.2.3"')
+
+        def bad_cb(raw):
+            raise TypeError("bad_cb")
+        with self.assertRaises(TypeError):
+            sp.parse("{*loop rows*}{*case*}{{bad b}}{*endcase*}{*endloop*}", "a\nb",
+                     custom_types={"bad": ("[a-z]", bad_cb)})
+
+    def test_include_expansion(self):
+        # the same include used more than once, next to text that gets merged into it
+        includes = {"sep": " -- ", "num": "<{{int}}>", "pair": "{*include num*},{*include num*}"}
+        self.assertEqual(sp.parse("{{int a}}{*include sep*}{{int b}}{*include sep*}x", "1 -- 2 -- x",
+                                  includes=includes),
+                         {"a": 1, "b": 2})
+        self.assertEqual([type(token) for token in sp._root_tokenize("({*include pair*})", includes)],
+                         [sp.TEXT, sp.VAR, sp.TEXT, sp.VAR, sp.TEXT])
+
+        # chains of includes deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 100
+        includes = dict(("i%d" % i, "x{*include i%d*}" % (i + 1)) for i in range(depth))
+        includes["i%d" % depth] = "{{int end}}"
+        self.assertEqual(sp.parse("{*include i0*}", "x" * depth + "5", includes=includes), {"end": 5})
+
+        with self.assertRaises(SparserSyntaxError) as context:
+            sp.compile("{*include a*}", includes={"a": "{*include b*}", "b": "x{*include a*}"})
+        self.assertEqual(str(context.exception), "{*include*} cycle: a -> b -> a")
+        with self.assertRaises(SparserSyntaxError):
+            sp.compile("{*include a*}", includes={"a": "a{*include a*}"})
+
+    def test_serialization(self):
+        patt = ("Report {{int n}}\n{*loop rows*}{*case*}{{hex a}} {{str b}}{*endcase*}{*endloop*}\nStatus: "
+                "{*switch s*}{*case ok*}ok{*endcase*}{*case bad*}{{spstr why}}{*endcase*}{*endswitch*}")
+        string = "Report 2\nff x\n10 y\nStatus: ok"
+        compiled = sp.compile(patt, custom_types={"hex": ("[0-9a-f]+", "binascii:unhexlify")})
+        expected = {"n": 2, "rows": [{"a": b"\xff", "b": "x"}, {"a": b"\x10", "b": "y"}], "s": {"case": "ok"}}
+        self.assertEqual(compiled.parse(string), expected)
+        self.assertEqual(sp.loads(sp.dumps(compiled)).parse(string), expected)
+        self.assertEqual(pickle.loads(pickle.dumps(compiled)).parse(string), expected)
+        with self.assertRaises(SparserValueError):
+            sp.loads(pickle.dumps((sp.SERIAL_VERSION + 1, compiled)))
+        with self.assertRaises(SparserSyntaxError):
+            sp.compile(patt, custom_types={"hex": ("[0-9a-f]+", "binascii:no_such_function")})
+
+        # callbacks that can't be imported by name can't be serialized
+        compiled = sp.compile("{{hex a}}", custom_types={"hex": ("[0-9a-f]+", lambda raw: int(raw, 16))})
+        with self.assertRaises(SparserValueError):
+            sp.dumps(compiled)
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            custom_types = {"hex": ("[0-9a-f]+", binascii.unhexlify)}
+            self.assertEqual(sp.compile(patt, custom_types, cache_dir=cache_dir).parse(string), expected)
+            cache_files = os.listdir(cache_dir)
+            self.assertEqual(len(cache_files), 1)
+            self.assertEqual(sp.compile(patt, custom_types, cache_dir=cache_dir).parse(string), expected)
+            self.assertEqual(os.listdir(cache_dir), cache_files)
+            # a different pattern gets its own file and a corrupt file is compiled again
+            sp.compile("{{int a}}", cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            with open(os.path.join(cache_dir, cache_files[0]), "wb") as f:
+                f.write(b"garbage")
+            self.assertEqual(sp.compile(patt, custom_types, cache_dir=cache_dir).parse(string), expected)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_case_index(self):
+        cases = ["{*case c%d*}EVT%d {{int code}}{*endcase*}" % (i, i) for i in range(20)]
+        # first match still wins when prefixes overlap or a case has no prefix
+        cases[3:3] = ["{*case any*}{{\"E[A-Z]+\"}}1 {{int code}} {{alpha extra}}{*endcase*}",
+                      "{*case long*}EVT1 {{int code}} !{*endcase*}"]
+        loop = sp.compile("{*loop rows*}%s{*endloop*}" % "".join(cases)).dict.d_entries[0].container
+        self.assertEqual([case_obj.prefix for case_obj in loop.cases[2:5]], ["EVT2", "E", "EVT1"])
+        self.assertEqual([case_obj.var_name for case_obj in loop.case_index.candidates("EVT12 1", 0, 7)],
+                         ["c1", "any", "long", "c12"])
+        self.assertEqual(loop.case_index.candidates("EVT12 1", 0, 4), loop.cases[1:2] + loop.cases[3:5])
+        self.assertEqual(loop.case_index.candidates("x", 0, 1), [])
+
+        string = "EVT1 1 !\nEVT12 2\nEVT1 3 abc\nEVT19 4"
+        self.assertEqual(sp.parse("{*loop rows*}%s{*endloop*}" % "".join(cases), string)["rows"],
+                         [{"case": "long", "code": 1}, {"case": "c12", "code": 2},
+                          {"case": "any", "code": 3, "extra": "abc"}, {"case": "c19", "code": 4}])
+        switch = "{*switch s*}%s{*endswitch*}" % "".join(cases)
+        self.assertEqual(sp.parse(switch, "EVT1 3"), {"s": {"case": "c1", "code": 3}})
+        self.assertEqual(sp.parse(switch, "EVA1 3 abc"), {"s": {"case": "any", "code": 3, "extra": "abc"}})
+        with self.assertRaises(SparserValueError):
+            sp.parse(switch, "EVT")
+
+    def test_container_sections(self):
+        loop = "{*loop %s*}{*case*}{{int a}}{*endcase*}{*case*}{{str b}}{*endcase*}{*endloop*}"
+        patt = "Head\n%s\n{*switch s*}{*case*}End{*endcase*}{*endswitch*}\nTotal: {{int t}}"
+        compiled = sp.compile(patt % "\n".join(loop % name for name in "abc"))
+        dict_ = compiled.dict
+        # loops and switches get the same part of the input as with the full regex
+        for string in ("Head\n1\nx\n2\nEnd\nTotal: 5", "Head\n\n\nEnd\nTotal: 5\n", "Head\nEnd\nEnd\nTotal: 5",
+                       "Head\n1\nEnd\nTotal: 5\nEnd\nTotal: 6", "Head\n1\nTotal: 5"):
+            full_match, match = dict_.regex.match(string), dict_.match(string)
+            self.assertEqual(match is None, full_match is None)
+            if match is not None:
+                self.assertEqual([match.span(idx) for idx in range(len(dict_.d_entries) + 1)],
+                                 [full_match.span(idx) for idx in range(len(dict_.d_entries) + 1)])
+
+        # input that almost matches doesn't get split between the loops every possible way
+        string = "Head\n%s\nEnd\nTotal: none" % "\n".join("%d" % i for i in range(5000))
+        with self.assertRaises(SparserValueError):
+            compiled.parse(string)
+        self.assertIsNotNone(dict_.match(string.replace("none", "5")))
+
+        # a section that looks past its end is matched with the full regex
+        custom_types = {"word": ("[a-z]+(?=\n)", None)}
+        compiled = sp.compile("{{word w}}\n%s\nEnd" % (loop % "rows"), custom_types)
+        self.assertEqual(compiled.parse("x\n1\ny\nEnd"), {"w": "x", "rows": [{"a": 1}, {"b": "y"}]})
+
+    def test_budget(self):
+        patt = "Head\n{*loop rows*}{*case*}{{int a}}{*endcase*}{*case*}{{alpha b}}{*endcase*}{*endloop*}\nEnd"
+        compiled = sp.compile(patt)
+        string = "Head\n%s\nEnd" % "\n".join("x" for _ in range(50))
+        self.assertEqual(compiled.parse(string, timeout=60, max_steps=1000), compiled.parse(string))
+        # the second case of each line is a step on top of the whole pattern
+        self.assertEqual(len(sp.parse(patt, string, max_steps=101)["rows"]), 50)
+        with self.assertRaises(SparserTimeoutError):
+            sp.parse(patt, string, max_steps=100)
+        with self.assertRaises(SparserTimeoutError):
+            compiled.match(string, max_steps=5)
+        self.assertFalse(sp.match(patt, "nope", max_steps=5))
+        with self.assertRaises(SparserValueError):
+            compiled.parse(string, timeout=0)
+
+        # with alarm, a single regex match or callback that runs too long is interrupted too
+        for custom_types, string in (({"slow": ("(?:a+)+b", None)}, "a" * 40),
+                                     ({"slow": ("a", lambda raw: time.sleep(30))}, "a")):
+            started = time.time()
+            with self.assertRaises(SparserTimeoutError):
+                sp.parse("{{slow x}}", string, custom_types, timeout=0.2, alarm=True)
+            self.assertLess(time.time() - started, 5)
+            self.assertEqual(signal.getsignal(signal.SIGALRM), signal.SIG_DFL)
+        # including in a loop, whose records aren't converted again one at a time after the alarm
+        started = time.time()
+        with self.assertRaises(SparserTimeoutError):
+            sp.parse("Head\n{*loop rows*}{*case*}{{slow x}}{*endcase*}{*endloop*}", "Head\na\na",
+                     {"slow": ("a", lambda raw: time.sleep(30))}, timeout=0.2, alarm=True)
+        self.assertLess(time.time() - started, 5)
+
+        # without it, or outside of the main thread, nothing is done with SIGALRM and callbacks aren't interrupted
+        handlers = []
+        slow = sp.compile("{{slow x}}", {"slow": ("a", lambda raw: handlers.append(signal.getsignal(signal.SIGALRM)))})
+        self.assertEqual(slow.parse("a", timeout=0.2), {"x": None})
+        thread = threading.Thread(target=slow.parse, args=("a",), kwargs={"timeout": 0.2, "alarm": True})
+        thread.start()
+        thread.join()
+        self.assertEqual(handlers, [signal.SIG_DFL, signal.SIG_DFL])
+
+    def test_match_without_callbacks(self):
+        calls = []
+
+        def word(raw):
+            calls.append(raw)
+            raise SparserValueError("no words")
+        patt = "Total: {{float total}}\n{*loop rows*}{*case*}{{int a}}{*endcase*}{*endloop*}\n{{word w}}"
+        compiled = sp.compile(patt, {"word": ("[a-z]+", str)})
+        self.assertTrue(compiled.match("Total: 1.5\n1\n2\nabc"))
+        self.assertFalse(compiled.match("Total: 1.5\n1\nx\nabc"))
+        # values of the built-in number types are still checked
+        self.assertFalse(compiled.match("Total: 1.2.3\n1\nabc"))
+        # with a custom callback, whatever parse rejects doesn't match either
+        compiled = sp.compile(patt, {"word": ("[a-z]+", word)})
+        self.assertFalse(compiled.match("Total: 1.5\n1\nabc"))
+        self.assertEqual(calls, ["abc"])
+        templates = sp.TemplateSet([("words", patt), ("any", "Total: {{float t}}\n{{int a}}\n{{str s}}")],
+                                     {"word": ("[a-z]+", word)})
+        self.assertEqual(templates.match("Total: 1.5\n1\nabc"), "any")
+        self.assertEqual(calls, ["abc", "abc"])
+        # a custom type without a callback is only its regex
+        self.assertTrue(sp.compile(patt, {"word": ("[a-z]+", None)}).match("Total: 1.5\n1\nabc"))
+
+        # searching for the part of the pattern that's missing is opt-in
+        with self.assertRaises(SparserValueError) as context:
+            sp.parse("{{int a}} and {{int b}}", "1 or 2")
+        self.assertEqual(str(context.exception), "'1 or 2' is unmatched")
+        with self.assertRaises(SparserValueError) as context:
+            sp.parse("{{int a}} and {{int b}}", "1 or 2", diagnostics="full")
+        self.assertEqual(str(context.exception), "'(?P<a>-? ?[0-9,]+) +and +(?P<b>-? ?[0-9,]+)$' is unmatched "
+                                                 "for string '1 or 2'")
+        with self.assertRaises(SparserValueError):
+            sp.parse("{{int a}}", "1", diagnostics="verbose")
+
+    def test_template_set(self):
+        patterns = [("error", "ERROR {{int code}}: {{spstr message}}"),
+                    ("warning", "WARN {{spstr message}}"),
+                    ("number", "{{int n}}"),
+                    ("total", "{{alpha label}} total: {{float total}}"),
+                    ("anything", "{{spstr text}}")]
+        templates = sp.TemplateSet(patterns)
+        self.assertEqual([(t.prefix, t.required) for t in templates.templates][:4],
+                         [("ERROR", "ERROR"), ("WARN", "WARN"), ("", ""), ("", "total:")])
+        self.assertEqual(templates.parse("ERROR 42: disk full"), ("error", {"code": 42, "message": "disk full"}))
+        self.assertEqual(templates.parse("12"), ("number", {"n": 12}))
+        self.assertEqual(templates.parse("Grand total: 5.5"), ("total", {"label": "Grand", "total": 5.5}))
+        # a template whose callback rejects the value doesn't stop the ones after it
+        self.assertEqual(templates.parse("Grand total: 1.2.3"), ("anything", {"text": "Grand total: 1.2.3"}))
+        self.assertEqual([t.name for t in templates.candidates("WARN low")], ["warning", "number", "anything"])
+        self.assertEqual(templates.match("WARN low"), "warning")
+        self.assertIsNone(templates.match(""))
+        with self.assertRaises(SparserValueError):
+            templates.parse("")
+        with self.assertRaises(SparserTimeoutError):
+            templates.parse("x", max_steps=1)
+        self.assertEqual(sp.TemplateSet(dict(patterns[:1])).parse("ERROR 1: x"), ("error", {"code": 1, "message": "x"}))
+
+    def test_search(self):
+        doc = "noise ERROR 4: disk full\n ERROR x: bad\nERROR 7: second one 1.5.5\n"
+        compiled = sp.compile("ERROR {{int code}}: {{spstr message}}")
+        self.assertEqual(compiled.search(doc), ((6, 24), {"code": 4, "message": "disk full"}))
+        self.assertEqual(list(compiled.finditer(doc)),
+                         [((6, 24), {"code": 4, "message": "disk full"}),
+                          ((39, 64), {"code": 7, "message": "second one 1.5.5"})])
+        self.assertIsNone(compiled.search("no errors here"))
+        self.assertEqual(compiled.search(doc, max_steps=1), ((6, 24), {"code": 4, "message": "disk full"}))
+        # values that don't convert aren't occurrences
+        self.assertEqual(list(sp.finditer("{{int a}}-{{float b}}", "1-2.5.5;3-4;5-x")),
+                         [((8, 11), {"a": 3, "b": 4.0})])
+        # an empty pattern has no non-empty occurrences
+        self.assertIsNone(sp.compile("").search("abc"))
+        self.assertEqual(list(sp.compile("").finditer("abc")), [])
+
+        patt = "Start\n{*loop rows*}{*case*}{{int n}} {{str s}}{*endcase*}{*endloop*}\nEnd"
+        doc = "header\nStart\n1 a\n2 b\nEnd\nStart\nbad\nEnd\nStart\n3 c\nEnd\nfooter"
+        self.assertEqual([(doc[start:end], result) for (start, end), result in sp.finditer(patt, doc)],
+                         [("Start\n1 a\n2 b\nEnd", {"rows": [{"n": 1, "s": "a"}, {"n": 2, "s": "b"}]}),
+                          ("Start\n3 c\nEnd", {"rows": [{"n": 3, "s": "c"}]})])
+        self.assertEqual(sp.search(patt, doc, loop_output="columns")[1]["rows"]["n"].tolist(), [1, 2])
+        with self.assertRaises(SparserTimeoutError):
+            sp.search(patt, doc, max_steps=1)
+        # finditer's budget is for the whole scan, and only while it's scanning
+        occurrences = sp.finditer(patt, doc, max_steps=1)
+        with self.assertRaises(SparserTimeoutError):
+            list(occurrences)
+        occurrences = sp.finditer(patt, doc, timeout=0.5)
+        self.assertEqual(next(occurrences)[0], (7, 24))
+        time.sleep(0.6)
+        self.assertEqual(len(list(occurrences)), 1)
+        # a loop at the end takes every record in a row
+        self.assertEqual([result for _, result in sp.finditer("{*loop rows*}{*case*}{{int n}} {{str s}}{*endcase*}"
+                                                              "{*endloop*}", doc)],
+                         [{"rows": [{"n": 1, "s": "a"}, {"n": 2, "s": "b"}]}, {"rows": [{"n": 3, "s": "c"}]}])
+        # starting at any of the records before the bad one gets stuck on it
+        doc = "\n".join("%d x" % i for i in range(2000)) + "\nbad\n1 y\nEnd"
+        self.assertEqual(sp.search("{*loop rows*}{*case*}{{int n}} {{str s}}{*endcase*}{*endloop*}\nEnd", doc,
+                                   max_steps=10000), ((len(doc) - 7, len(doc)), {"rows": [{"n": 1, "s": "y"}]}))
+        # a switch or loop in the middle gets more of the input when the first split doesn't parse
+        patt = "{*switch s*}{*case*}{{int a}} {{int b}}{*endcase*}{*endswitch*} {{int c}}"
+        self.assertEqual(sp.search(patt, "1 2 3"), ((0, 5), sp.parse(patt, "1 2 3")))
+        self.assertEqual([result for _, result in sp.finditer(patt, "1 2 3\n4 5 6")],
+                         [{"s": {"a": 1, "b": 2}, "c": 3}, {"s": {"a": 4, "b": 5}, "c": 6}])
+        patt = "Header {{int h}}\n{*loop rows*}{*case*}{{int a}} {{int b}}{*endcase*}{*endloop*} {{int c}}"
+        self.assertEqual(sp.search(patt, "x\nHeader 1\n2 3\n4 5 9\nmore"),
+                         ((2, 20), sp.parse(patt, "Header 1\n2 3\n4 5 9")))
+
+    def test_bytes_input(self):
+        patt = ("Report for {{str owner}}\n{*loop rows*}{*case item*}{{int qty}} x {{str sku}}{*endcase*}"
+                "{*case note*}# {{spstr note}}{*endcase*}{*endloop*}\nTotal: {{currency total}}")
+        string = u"Report for J\u00fcrgen\n3 x ab\r\n# caf\u00e9\r\n1 x cd\nTotal: $4"
+        expected = sp.parse(patt, string)
+        self.assertEqual(expected["owner"], u"J\u00fcrgen")
+        compiled = sp.compile(patt, encoding="utf-8")
+        data = string.encode("utf-8")
+        self.assertEqual(compiled.parse(data), expected)
+        self.assertEqual(compiled.parse(bytearray(data)), expected)
+        self.assertEqual(compiled.parse(memoryview(data)), expected)
+        self.assertEqual(compiled.parse(string), expected)
+        self.assertEqual(sp.parse(patt, data, encoding="utf-8", loop_output="columns")["rows"]["note"],
+                         [None, u"caf\u00e9", None])
+        self.assertTrue(compiled.match(data))
+        self.assertEqual(compiled.parse_many([data, b"nope"], on_error="skip"), [expected])
+        self.assertEqual(sp.search("# {{spstr note}}", data, encoding="utf-8"), ((27, 35), {"note": u"caf\u00e9"}))
+
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.assertEqual(compiled.parse(mapped), expected)
+                self.assertEqual(compiled.parse(memoryview(mapped)), expected)
+            finally:
+                mapped.close()
+
+        with self.assertRaises(SparserValueError):
+            sp.parse(patt, data)  # bytes need an encoding
+        with self.assertRaises(SparserValueError):
+            compiled.parse(data.replace(b"caf\xc3\xa9", b"caf\xc3"))
+        with self.assertRaises(SparserValueError):
+            sp.compile(patt, encoding="utf-16")
+        with self.assertRaises(SparserValueError):
+            compiled.parse_parallel(data)
+
+        path = os.path.join(tempfile.mkdtemp(), "input.txt")
+        try:
+            with open(path, "wb") as f:
+                f.write(u"hello w\u00f6rld".encode("latin-1"))
+            string_io = StringIO()
+            sp._main(['--pattern-string', '{{str what}} {{str where}}', '--input-file', path, '--encoding', 'latin-1'],
+                     string_io)
+            self.assertEqual(json.loads(string_io.getvalue()), {"what": "hello", "where": u"w\u00f6rld"})
+
+            # mapped files get the same newline translation as files read in text mode
+            with open(path, "wb") as f:
+                f.write(b"Name: bob\r\nAge: 5\r\n")
+            for args in ([], ['--encoding', 'utf-8']):
+                string_io = StringIO()
+                sp._main(['--pattern-string', 'Name: {{str n}}\nAge: {{int a}}', '--input-file', path] + args,
+                         string_io)
+                self.assertEqual(json.loads(string_io.getvalue()), {"n": "bob", "a": 5})
+            with open(path, "wb") as f:
+                f.write(b"Name: bob\rAge: x\r")
+            for args in ([], ['--encoding', 'utf-8']):
+                with self.assertRaises(SparserValueError) as cm:
+                    sp._main(['--pattern-string', 'Name: {{str n}}\nAge: {{int a}}', '--input-file', path] + args,
+                             StringIO())
+                self.assertIn("Name: bob\\nAge: x\\n' is unmatched", str(cm.exception))
+
+            # files are read as text unless there's an encoding, which only counts ASCII whitespace
+            with open(path, "wb") as f:
+                f.write(u"x: a\u00a0b".encode("utf-8"))
+            string_io = StringIO()
+            sp._main(['--pattern-string', 'x: {{spstr v}}', '--input-file', path], string_io)
+            self.assertEqual(json.loads(string_io.getvalue()), {"v": u"a\u00a0b"})
+            with self.assertRaises(SparserValueError):
+                sp._main(['--pattern-string', 'x: {{str v}}', '--input-file', path], StringIO())
+            string_io = StringIO()
+            sp._main(['--pattern-string', 'x: {{str v}}', '--input-file', path, '--encoding', 'utf-8'], string_io)
+            self.assertEqual(json.loads(string_io.getvalue()), {"v": u"a\u00a0b"})
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_cli_many_inputs(self):
+        patt = "{{str what}} world"
+        directory = tempfile.mkdtemp()
+        try:
+            for name, contents in (("a.txt", "hello world"), ("b.txt", "bye world"), ("c.log", "nope")):
+                with open(os.path.join(directory, name), "w") as f:
+                    f.write(contents)
+
+            def run(*args, **kwargs):
+                string_io = StringIO()
+                sp._main(['--pattern-string', patt] + list(args), string_io, **kwargs)
+                return [json.loads(line) for line in string_io.getvalue().splitlines()]
+
+            self.assertEqual(run('--input-file', os.path.join(directory, "*.txt")),
+                             [{"what": "hello"}, {"what": "bye"}])
+            with self.assertRaises(SparserValueError):
+                run('--input-file', directory)
+            ret = run('--input-file', directory, '--on-error', 'collect', '--names', '--jobs', '2')
+            self.assertEqual([line["input"] for line in ret],
+                             [os.path.join(directory, name) for name in ("a.txt", "b.txt", "c.log")])
+            self.assertEqual([line.get("result") for line in ret], [{"what": "hello"}, {"what": "bye"}, None])
+            self.assertIn("error", ret[2])
+            with self.assertRaises(SparserValueError):
+                run('--input-file', os.path.join(directory, "*.csv"))
+
+            stdin = StringIO(u"a world\nb world\nnope\nc world\n")
+            self.assertEqual(run('--stdin', '--on-error', 'skip', '--names', stdin=stdin),
+                             [{"input": 1, "result": {"what": "a"}}, {"input": 2, "result": {"what": "b"}},
+                              {"input": 4, "result": {"what": "c"}}])
+            stdin = StringIO(u"a world;;b world;;c world")
+            self.assertEqual(run('--stdin', '--delimiter', ';;', '--jobs', '2', stdin=stdin),
+                             [{"what": "a"}, {"what": "b"}, {"what": "c"}])
+            self.assertEqual(list(sp._split_records(StringIO(u"ab;;cd;;;;e"), ";;", chunk_size=1)),
+                             ["ab", "cd", "", "e"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_lazy_loop(self):
+        patt = "Header\n{*loop rows*}{*case item*}{{int qty}} x {{str sku}}{*endcase*}" \
+               "{*case*}# {{spstr note}}{*endcase*}{*endloop*}\nTotal: {{int total}}"
+        string = "Header\n%s\nTotal: 7" % "\n".join("%d x sku-%d" % (i, i) if i % 5 else "# note %d" % i
+                                                   for i in range(3000))
+        compiled = sp.compile(patt, loop_output="lazy")
+        ret = compiled.parse(string)
+        self.assertIsInstance(ret["rows"], sp.LazyLoop)
+        self.assertEqual(ret["total"], 7)
+        self.assertEqual(list(ret["rows"]), sp.parse(patt, string)["rows"])
+        self.assertEqual(ret["rows"].tolist(), list(ret["rows"]))  # each iteration parses the records again
+        self.assertEqual(sum(row.get("qty", 0) for row in ret["rows"]), sum(i for i in range(3000) if i % 5))
+
+        # records are parsed as they are needed, so the records before a bad one still come out
+        ret = compiled.parse(string.replace("\n7 x sku-7\n", "\nnot a record\n"))
+        rows = iter(ret["rows"])
+        self.assertEqual(next(rows), {"note": "note 0"})
+        self.assertEqual([next(rows) for _ in range(6)][-1], {"case": "item", "qty": 6, "sku": "sku-6"})
+        with self.assertRaises(SparserValueError):
+            next(rows)
+
+        self.assertEqual(list(compiled.parse("Header\n\nTotal: 7")["rows"]), [])
+        ret = sp.compile(patt, loop_output="lazy", encoding="utf-8").parse(string.encode("utf-8"))
+        self.assertEqual(next(iter(ret["rows"])), {"note": "note 0"})
+
+    def test_stats(self):
+        patt = "{*loop rows*}{*case item*}{{int qty}} x {{str sku}}{*endcase*}{*case*}# {{spstr note}}{*endcase*}" \
+               "{*case a*}A {{int a}}{*endcase*}{*case b*}B {{int b}}{*endcase*}{*endloop*}\n" \
+               "Status: {*switch status*}{*case ok*}ok{*endcase*}{*case bad*}bad {{int code}}{*endcase*}{*endswitch*}"
+        string = "1 x sku-1\n# a note\nA 2\nB 3\n4 x sku-4\nStatus: bad 7"
+        compiled = sp.compile(patt)
+        self.assertIsNone(compiled.stats())
+        expected = compiled.parse(string)
+
+        compiled.enable_stats()
+        self.assertEqual(compiled.parse(string), expected)
+        self.assertTrue(compiled.match(string))
+        self.assertFalse(compiled.match("nope"))
+        with self.assertRaises(SparserValueError):
+            compiled.parse("nope")
+        self.assertEqual(len(compiled.parse_many([string, "nope"], on_error="skip")), 1)
+        stats = compiled.stats()
+        self.assertEqual((stats["calls"], stats["matched"], stats["parsed"]), (6, 3, 2))
+        self.assertGreater(stats["match_seconds"], 0)
+        self.assertGreater(stats["convert_seconds"], 0)
+
+        cases = dict(((case["container"], case["index"]), case) for case in stats["cases"])
+        self.assertEqual(len(cases), 6)
+        self.assertEqual(cases[("rows", 0)]["case"], "item")
+        # parse, parse_many and match each go through the loop's 5 records once.
+        # "item" has no literal prefix so it's tried first on every line
+        self.assertEqual((cases[("rows", 0)]["attempts"], cases[("rows", 0)]["hits"]), (15, 6))
+        self.assertEqual((cases[("rows", 2)]["attempts"], cases[("rows", 2)]["hits"]), (3, 3))
+        self.assertEqual(cases[("rows", 2)]["skipped"], 12)  # by the prefix index, on every line but "A 2"
+        self.assertGreater(cases[("rows", 0)]["convert_seconds"], 0)
+        self.assertGreater(cases[("rows", 2)]["match_seconds"], 0)
+        self.assertEqual((cases[("status", 1)]["attempts"], cases[("status", 1)]["hits"]), (3, 3))
+
+        compiled.enable_stats()  # starts over
+        self.assertEqual(compiled.stats()["calls"], 0)
+        # a search or finditer is one call, and each place it finds is a match that parsed
+        doc = "junk\n%s\nmore\n%s" % (string, string)
+        self.assertEqual(compiled.search(doc)[1], expected)
+        self.assertIsNone(compiled.search("nope"))
+        self.assertEqual([result for _, result in compiled.finditer(doc)], [expected, expected])
+        stats = compiled.stats()
+        self.assertEqual((stats["calls"], stats["matched"], stats["parsed"]), (3, 3, 3))
+        self.assertGreater(stats["match_seconds"], 0)
+        self.assertGreater(sum(case["attempts"] for case in stats["cases"]), 0)
+        self.assertIsNone(sp.loads(sp.dumps(compiled)).stats())
+        compiled.disable_stats()
+        self.assertIsNone(compiled.stats())
+
+        templates = sp.TemplateSet([("a", "A {{int a}}"), ("b", "B {{int b}}")])
+        templates.enable_stats()
+        self.assertEqual(templates.parse("B 2", max_steps=10), ("b", {"b": 2}))
+        self.assertEqual(templates.match("A 1"), "a")
+        self.assertEqual([(stats["calls"], stats["parsed"]) for stats in templates.stats().values()], [(1, 0), (1, 1)])
+
+    def test_nested(self):
+        patt = "{*loop orders*}{*case*}Order {{int order}}\n{*loop items*}" \
+               "{*case*}  {{int qty}} x {{str sku}}{*endcase*}{*case*}  # {{spstr note}}{*endcase*}{*endloop*}\n" \
+               "Paid: {*switch paid*}{*case*}no{*endcase*}{*case card*}card {{int last4}}{*endcase*}{*endswitch*}" \
+               "{*endcase*}{*endloop*}"
+        string = "Order 1\n  2 x ab-1\n  # gift\n  1 x cd-2\nPaid: card 1234\n" \
+                 "Order 2\nPaid: no\nOrder 3\n  5 x ef-3\nPaid: no"
+        expected = [{"order": 1, "items": [{"qty": 2, "sku": "ab-1"}, {"note": "gift"}, {"qty": 1, "sku": "cd-2"}],
+                     "paid": {"case": "card", "last4": 1234}},
+                    {"order": 2, "items": [], "paid": {}},
+                    {"order": 3, "items": [{"qty": 5, "sku": "ef-3"}], "paid": {}}]
+        compiled = sp.compile(patt)
+        self.assertEqual(compiled.parse(string), {"orders": expected})
+        self.assertEqual(compiled.parse(string.replace("\n", "\r\n")), {"orders": expected})
+        self.assertEqual(sp.loads(sp.dumps(compiled)).parse(string), {"orders": expected})
+        self.assertEqual(sp.compile(patt, encoding="utf-8").parse(string.encode("utf-8")), {"orders": expected})
+        lazy = sp.compile(patt, loop_output="lazy").parse(string)["orders"]
+        self.assertEqual([list(order["items"]) for order in lazy], [order["items"] for order in expected])
+        columns = sp.compile(patt, loop_output="columns").parse(string)["orders"]
+        self.assertEqual(list(columns["order"]), [1, 2, 3])
+        self.assertEqual(list(columns["items"][0]["qty"]), [2, None, 1])
+
+        # a nested loop takes every record that it can, and a switch the fewest lines
+        self.assertTrue(compiled.match(string))
+        self.assertFalse(compiled.match(string.replace("Paid: no\nOrder 3", "Order 3")))
+        with self.assertRaises(SparserValueError):
+            compiled.parse(string.replace("  # gift", "gift"))
+
+        # as deep as it goes, and each case of a switch only matches when what is nested in it does too
+        patt = "{*loop a*}{*case*}A{*loop b*}{*case*}\nB{*loop c*}{*case*}\nC {{int c}}{*endcase*}{*endloop*}" \
+               "{*endcase*}{*endloop*}{*endcase*}{*endloop*}"
+        self.assertEqual(sp.parse(patt, "A\nB\nC 1\nC 2\nB\nA\nB\nC 3"),
+                         {"a": [{"b": [{"c": [{"c": 1}, {"c": 2}]}, {"c": []}]}, {"b": [{"c": [{"c": 3}]}]}]})
+        patt = "{*switch s*}{*case*}{*loop ints*}{*case*}{{int i}}{*endcase*}{*endloop*}{*endcase*}" \
+               "{*case*}{*loop words*}{*case*}{{alpha w}}{*endcase*}{*endloop*}{*endcase*}{*endswitch*}"
+        self.assertEqual(sp.parse(patt, "1\n2"), {"s": {"ints": [{"i": 1}, {"i": 2}]}})
+        self.assertEqual(sp.parse(patt, "a\nb"), {"s": {"words": [{"w": "a"}, {"w": "b"}]}})
+
+    def test_records(self):
+        patt = "Order {{int order}}\n" \
+               "{*loop items*}{*case item*}  - {{str sku}}: {{int qty}}{*endcase*}" \
+               "{*case*}  # {{spstr note}}{*endcase*}{*endloop*}\n" \
+               "Paid: {*switch paid*}{*case card*}card {{int last4}}{*endcase*}{*case*}no{*endcase*}{*endswitch*}"
+        string = "Order 1\n  - ab: 2\n  # gift\n  - cd: 1\nPaid: card 1234"
+        expected = sp.compile(patt).parse(string)
+        compiled = sp.compile(patt, records=True)
+        result = compiled.parse(string)
+        self.assertIsInstance(result, sp.Record)
+        self.assertIsInstance(result["items"][0], sp.Record)
+        self.assertEqual(result, expected)
+        self.assertEqual(result.todict(), expected)
+        self.assertEqual(json.loads(json.dumps(result.todict())), expected)
+        self.assertIs(type(result.todict()["items"][0]), dict)
+
+        # reads like a dict
+        item = result["items"][0]
+        self.assertEqual(item["case"], "item")
+        self.assertEqual(sorted(item), ["case", "qty", "sku"])
+        self.assertEqual(len(item), 3)
+        self.assertEqual(dict(item), {"sku": "ab", "qty": 2, "case": "item"})
+        self.assertEqual(item.items(), [("sku", "ab"), ("qty", 2), ("case", "item")])
+        self.assertIn("qty", item)
+        self.assertNotIn("note", item)
+        self.assertNotIn("case", result["items"][1])
+        self.assertIsNone(item.get("note"))
+        with self.assertRaises(KeyError):
+            item["note"]
+        # the records of a case share a class
+        self.assertIs(type(result["items"][2]), type(item))
+
+        # every way of parsing makes the same records
+        self.assertEqual(pickle.loads(pickle.dumps(result)), result)
+        self.assertEqual(sp.loads(sp.dumps(compiled)).parse(string), expected)
+        self.assertEqual(sp.parse(patt, string, records=True), expected)
+        self.assertEqual(list(sp.compile(patt, records=True, loop_output="lazy").parse(string)["items"]),
+                         expected["items"])
+        self.assertEqual(compiled.search("x\n" + string)[1], expected)
+        self.assertEqual(compiled.parse_many([string, string]), [expected, expected])
+        self.assertEqual(list(compiled.iter_parse(string.splitlines())), list(sp.compile(patt).iter_parse(string)))
+        patt = "{*loop rows*}{*case*}{{int a}} {{str b}}{*endcase*}{*endloop*}"
+        string = "\n".join("%d x" % i for i in range(1000))
+        self.assertEqual(sp.compile(patt, records=True).parse_parallel(string, workers=2, chunk_size=1000),
+                         sp.parse(patt, string))
+
+    @unittest.skipIf(sys.version_info < (3, 6), "asyncio parsing needs python 3.6")
+    def test_async(self):
+        # async syntax doesn't compile on python 2 so the coroutines live in their own module
+        import asyncio
+        from async_checks import check_async
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(check_async(self))
+        finally:
+            loop.close()
+
     def test_custom_types(self):
         patt = "the {{animal who}} says {{str sound}}"
         custom_types = {"animal": ("(?:cat|dog|horse)", str.upper)}